@@ -0,0 +1,183 @@
+"""Scriptable stand-ins for lsusb, lsblk, dfu-util, wdi-simple and ipodscsi.
+
+benchmark.py installs a small wrapper per tool that runs
+`python3 benchfakes.py <tool> <args...>`. All of them share one simulated
+iPod through the JSON state file named by LEUNBRICK_BENCH_STATE:
+
+    {"config": {...latencies, rates, failures...},
+     "phases": [[at, usb vid:pid or null, disk visible], ...],
+     "calls": {tool: count}, "disk_image": path, "disk_name": "sdz"}
+
+The device is in whichever phase has the latest `at` that has passed, so
+a flash schedules "drop off the bus, come back as the next PID" by
+appending phases. Every delay is multiplied by config["scale"].
+"""
+import json
+import os
+import sys
+import time
+
+import paths
+
+STATE_ENV = 'LEUNBRICK_BENCH_STATE'
+APPLE_NAMES = {
+    "05ac:1232": "Apple, Inc. iPod nano 6G (DFU mode)",
+    "05ac:1234": "Apple, Inc. iPod nano 7G (DFU mode)",
+    "05ac:1248": "Apple, Inc. iPod nano 6G (WTF mode)",
+    "05ac:1249": "Apple, Inc. iPod nano 7G 2012 (WTF mode)",
+    "05ac:124a": "Apple, Inc. iPod nano 7G 2015 (WTF mode)",
+}
+
+# ---- Shared state ----
+def load_state():
+    with open(os.environ[STATE_ENV]) as f:
+        return json.load(f)
+
+def save_state(state):
+    paths.atomic_write(os.environ[STATE_ENV], json.dumps(state))
+
+def current(state, now=None):
+    """(usb vid:pid or None, disk visible) at `now`."""
+    now = time.time() if now is None else now
+    usb, disk = None, False
+    for at, phase_usb, phase_disk in sorted(state['phases'], key=lambda phase: phase[0]):
+        if at <= now:
+            usb, disk = phase_usb, phase_disk
+    return usb, disk
+
+def delay(state, key):
+    return state['config'].get(key, 0) * state['config'].get('scale', 1.0)
+
+def count_call(state, tool):
+    """Bump the tool's call counter; True if this call is configured to fail."""
+    calls = state.setdefault('calls', {})
+    calls[tool] = calls.get(tool, 0) + 1
+    save_state(state)
+    return calls[tool] in state['config'].get('fail', {}).get(tool, [])
+
+def next_phase(state, vid_pid):
+    """What a device in `vid_pid` turns into once its image has been flashed."""
+    return state['config']['transitions'].get(vid_pid)
+
+# ---- Tools ----
+def lsusb(state, args):
+    time.sleep(delay(state, 'lsusb_latency'))
+    print("Bus 001 Device 001: ID 1d6b:0002 Linux Foundation 2.0 root hub")
+    usb, _ = current(state)
+    if usb:
+        print(f"Bus 001 Device 007: ID {usb} {APPLE_NAMES.get(usb, 'Apple, Inc.')}")
+    return 0
+
+def lsblk(state, args):
+    time.sleep(delay(state, 'lsblk_latency'))
+    columns = args[args.index('-o') + 1].split(',') if '-o' in args else ["NAME", "SIZE", "MODEL"]
+    rows = [{"NAME": "sda", "SIZE": "476.9G", "MODEL": "Samsung SSD 860"}]
+    _, disk = current(state)
+    if disk:
+        rows.append({"NAME": state['disk_name'], "SIZE": "14.8G", "MODEL": "iPod"})
+    if '-n' not in args:
+        print(" ".join(f"{column:<8}" for column in columns).rstrip())
+    for row in rows:
+        print(" ".join(f"{row[column]:<8}" for column in columns).rstrip())
+    return 0
+
+def wdi_simple(state, args):
+    failing = count_call(state, 'wdi-simple')
+    time.sleep(delay(state, 'wdi_latency'))
+    if failing:
+        print("Could not install driver", file=sys.stderr)
+        return 1
+    print("Installing driver(s)...\nSuccess")
+    return 0
+
+def dfu_util(state, args):
+    usb, _ = current(state)
+    if '-l' in args:
+        time.sleep(delay(state, 'lsusb_latency'))
+        if usb:
+            print(f'Found DFU: [{usb}] ver=0000, devnum=7, cfg=1, intf=0, path="1-1", alt=0, '
+                  f'name="UNKNOWN", serial="UNKNOWN"')
+        return 0
+
+    device = args[args.index('-d') + 1].lower()
+    image = args[args.index('-D') + 1]
+    failing = count_call(state, 'dfu-util')
+    print("dfu-util 0.11\n\nCopyright 2005-2009 Weston Schmidt, Harald Welte and OpenMoko Inc.")
+    print("Copyright 2010-2021 Tormod Volden and Stefan Schmidt")
+    print("This program is Free Software and has ABSOLUTELY NO WARRANTY\n")
+    time.sleep(delay(state, 'dfu_setup'))
+    if usb != device:
+        print("dfu-util: No DFU capable USB device available", file=sys.stderr)
+        return 74
+    print("Opening DFU capable USB device...")
+    print(f"Device ID {device}\nDevice DFU version 0110")
+    print("Claiming USB DFU Interface...\nSetting Alternate Interface #0 ...")
+    print("Determining device status...\nDFU state(2) = dfuIDLE, status(0) = No error condition is present")
+    print("DFU mode device DFU version 0110\nDevice returned transfer size 2048")
+    sys.stdout.flush()
+
+    total = os.path.getsize(image)
+    rate = state['config'].get('dfu_kib_s', 350) * 1024
+    sent = 0
+    while sent < total:
+        chunk = min(total - sent, max(total // 10, 2048))
+        time.sleep(chunk / rate * state['config'].get('scale', 1.0))
+        sent += chunk
+        percent = sent * 100 // total
+        print(f"Download\t[{'=' * (percent // 4):<25}] {percent:3d}% {sent:>12} bytes", flush=True)
+        if failing and percent >= 50:
+            print("dfu-util: Error during download (LIBUSB_ERROR_PIPE)", file=sys.stderr)
+            return 74
+
+    print("Download done.")
+    print("DFU state(7) = dfuMANIFEST, status(0) = No error condition is present")
+    print("dfu-util: unable to read DFU status after completion (LIBUSB_ERROR_NO_DEVICE)")
+    # The device boots the image: it drops off the bus and re-enumerates as the next mode
+    now = time.time()
+    after = next_phase(state, device)
+    state = load_state()
+    state['phases'].append([now + delay(state, 'drop_delay'), None, False])
+    if after == "disk":
+        state['phases'].append([now + delay(state, 'disk_delay'), None, True])
+    elif after:
+        state['phases'].append([now + delay(state, 'reenum_delay'), after, False])
+    save_state(state)
+    return 0
+
+def ipodscsi(state, args):
+    failing = count_call(state, 'ipodscsi')
+    drive, image = args[0], args[-1]
+    _, disk = current(state)
+    time.sleep(delay(state, 'scsi_setup'))
+    if not disk or drive.rsplit('/', 1)[-1] != state['disk_name']:
+        print(f"Error: could not open {drive}", file=sys.stderr)
+        return 1
+    rate = state['config'].get('scsi_mib_s', 8) * (1 << 20)
+    written = 0
+    with open(image, 'rb') as src, open(state['disk_image'], 'r+b') as dst:
+        for chunk in iter(lambda: src.read(1 << 20), b''):
+            if failing and written >= (1 << 20):
+                print("Error: SCSI write failed (sense 03/0c/00)", file=sys.stderr)
+                return 1
+            dst.write(chunk)
+            written += len(chunk)
+            time.sleep(len(chunk) / rate * state['config'].get('scale', 1.0))
+    print(f"Wrote {written} bytes of firmware")
+    return 0
+
+TOOLS = {
+    'lsusb': lsusb,
+    'lsblk': lsblk,
+    'dfu-util': dfu_util,
+    'wdi-simple': wdi_simple,
+    'ipodscsi': ipodscsi,
+}
+
+def main(argv):
+    if not argv or argv[0] not in TOOLS:
+        print(f"Usage: benchfakes.py {{{'|'.join(TOOLS)}}} [args...]", file=sys.stderr)
+        return 2
+    return TOOLS[argv[0]](load_state(), argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,274 @@
+"""End-to-end benchmark of the unbrick flows against simulated tools.
+
+Runs the real menu flow (main.unbrick) with lsusb, lsblk, dfu-util,
+wdi-simple and ipodscsi replaced by the stand-ins in benchfakes.py, which
+share one simulated iPod: it enters DFU mode, re-enumerates after each
+flash, boots into Disk Mode and takes Firmware.MSE onto a file-backed
+disk image. Latencies, transfer rates and injected failures come from the
+scenario; --scale shrinks every delay for quick runs.
+
+    python3 benchmark.py                       # every scenario, 3 runs each
+    python3 benchmark.py 7g-2015 -n 10 --scale 0.1
+    python3 benchmark.py --save baseline.json
+    python3 benchmark.py --baseline baseline.json --tolerance 0.2   # exit 1 on a regression
+
+Stage timings come from the session traces (stagetrace.py).
+"""
+import argparse
+import builtins
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKES = os.path.join(SCRIPT_DIR, "benchfakes.py")
+SOURCE_FIRMWARES = os.path.join(SCRIPT_DIR, "misc", "firmwares")
+# tool name in the pipeline -> benchfakes.py tool
+TOOL_FILES = {
+    'lsusb': 'lsusb', 'lsblk': 'lsblk',
+    'dfu-util.exe': 'dfu-util', 'wdi-simple.exe': 'wdi-simple', 'ipodscsi.exe': 'ipodscsi',
+}
+
+# Rough timings of a real bench; everything is in seconds, KiB/s or MiB/s
+DEFAULT_CONFIG = {
+    'scale': 1.0,
+    'dfu_appear': 0.5,       # operator has the iPod in DFU mode this long after the start
+    'lsusb_latency': 0.02,
+    'lsblk_latency': 0.02,
+    'wdi_latency': 0.4,
+    'dfu_setup': 0.15,
+    'dfu_kib_s': 400,
+    'drop_delay': 0.3,       # flash done -> device gone from the bus
+    'reenum_delay': 1.2,     # flash done -> back in the next mode
+    'disk_delay': 2.5,       # Disk Mode flash done -> disk with media
+    'scsi_setup': 0.2,
+    'scsi_mib_s': 10,
+    'mse_bytes': 4 << 20,
+    'fail': {},              # tool -> [call numbers that fail], e.g. {"dfu-util": [1]}
+}
+
+SCENARIOS = {
+    "6g": {'family': "6G", 'dfu': "05ac:1232",
+           'transitions': {"05ac:1232": "05ac:1248", "05ac:1248": "disk"}},
+    "7g-2012": {'family': "7G", 'dfu': "05ac:1234",
+                'transitions': {"05ac:1234": "05ac:1249", "05ac:1249": "disk"}},
+    "7g-2015": {'family': "7G", 'dfu': "05ac:1234",
+                'transitions': {"05ac:1234": "05ac:124a", "05ac:124a": "disk"}},
+}
+
+MSE_DIRS = ("6G", "2012", "2015")
+
+class Bench:
+    """A scratch tree with the stand-in tools, firmware copies and the shared state."""
+
+    def __init__(self, root, config):
+        self.root = root
+        self.config = config
+        self.tools = os.path.join(root, "tools")
+        self.firmwares = os.path.join(root, "firmwares")
+        self.state_path = os.path.join(root, "state.json")
+        self.disk_image = os.path.join(root, "ipod-disk.img")
+        self.traces = os.path.join(root, "traces")
+
+    def setup(self):
+        os.makedirs(self.tools)
+        for name, tool in TOOL_FILES.items():
+            path = os.path.join(self.tools, name)
+            with open(path, 'w') as f:
+                f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKES}" {tool} "$@"\n')
+            os.chmod(path, 0o755)
+        shutil.copytree(SOURCE_FIRMWARES, self.firmwares,
+                        ignore=shutil.ignore_patterns(".index.json", "*.lub"))
+        for short in MSE_DIRS:
+            os.makedirs(os.path.join(self.firmwares, short), exist_ok=True)
+            with open(os.path.join(self.firmwares, short, "Firmware.MSE"), 'wb') as f:
+                f.write(os.urandom(self.config['mse_bytes']))
+        os.environ.update({
+            'LEUNBRICK_TOOLS_DIR': self.tools,
+            'LEUNBRICK_FIRMWARES_DIR': self.firmwares,
+            'LEUNBRICK_CACHE': os.path.join(self.root, "cache"),
+            'LEUNBRICK_TRACE_DIR': self.traces,
+            'LEUNBRICK_BENCH_STATE': self.state_path,
+            'LEUNBRICK_USBWATCH': '0',
+            'LEUNBRICK_DFU': 'dfu-util',
+            'LEUNBRICK_SCSI': 'ipodscsi',
+            'NO_COLOR': '1',
+            'PATH': self.tools + os.pathsep + os.environ.get('PATH', ''),
+        })
+
+    def reset(self, scenario):
+        """Fresh device: not plugged in yet, DFU mode after dfu_appear seconds."""
+        config = dict(self.config, transitions=scenario['transitions'])
+        now = time.time()
+        state = {
+            'config': config, 'calls': {}, 'disk_image': self.disk_image, 'disk_name': "sdz",
+            'phases': [[now + config['dfu_appear'] * config['scale'], scenario['dfu'], False]],
+        }
+        with open(self.disk_image, 'wb') as f:
+            f.truncate(config['mse_bytes'])
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
+
+def answer(prompt=""):
+    """Operator stand-in: confirm everything, name the simulated disk if asked."""
+    if "YES" in prompt:
+        return "YES"
+    if "device" in prompt or "drive" in prompt:
+        return "sdz"
+    if "(y/n)" in prompt:
+        return "y"
+    return ""
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the flow and the tools it spawns (they write to fd 1 directly)."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+def run_once(bench, name, main):
+    """One end-to-end session. Returns {'ok', 'total', 'stages': {stage: seconds}, 'error'}."""
+    import stagetrace
+    bench.reset(SCENARIOS[name])
+    family = SCENARIOS[name]['family']
+    trace = stagetrace.Tracer(family, trace_dir=bench.traces)
+    error = None
+    started = time.monotonic()
+    real_input = builtins.input
+    builtins.input = answer
+    try:
+        with quiet():
+            main.unbrick(family, trace)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        builtins.input = real_input
+    total = time.monotonic() - started
+    trace.close()
+
+    variant = SCENARIOS[name]['transitions'][SCENARIOS[name]['dfu']]
+    short = {"05ac:1248": "6G", "05ac:1249": "2012", "05ac:124a": "2015"}[variant]
+    with open(os.path.join(bench.firmwares, short, "Firmware.MSE"), 'rb') as f:
+        expected = hashlib.sha256(f.read()).hexdigest()
+    with open(bench.disk_image, 'rb') as f:
+        written = hashlib.sha256(f.read()).hexdigest() == expected
+    stages = {}
+    for stage in trace.stages:
+        stages[stage['stage']] = stages.get(stage['stage'], 0.0) + stage['seconds']
+    failed = [stage for stage in trace.stages if stage['outcome'] != "ok"]
+    if error is None and failed:
+        error = f"stage {failed[0]['stage']} {failed[0]['outcome']}"
+    if error is None and not written:
+        error = "Firmware.MSE did not reach the disk image"
+    return {'ok': error is None, 'total': total, 'stages': stages, 'error': error}
+
+def summarize(runs):
+    import stagetrace
+    stages = {}
+    for run in runs:
+        for stage, seconds in run['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+    totals = [run['total'] for run in runs]
+    return {
+        'runs': len(runs), 'failed': sum(1 for run in runs if not run['ok']),
+        'errors': sorted({run['error'] for run in runs if run['error']}),
+        'total': {'p50': stagetrace.percentile(totals, 50), 'p95': stagetrace.percentile(totals, 95)},
+        'stages': {stage: {'p50': stagetrace.percentile(values, 50), 'p95': stagetrace.percentile(values, 95)}
+                   for stage, values in stages.items()},
+    }
+
+def print_report(results):
+    for name, result in results.items():
+        print(f"\n== {name}: {result['runs']} runs, {result['failed']} failed ==")
+        for error in result['errors']:
+            print(f"   ! {error}")
+        print(f"   {'STAGE':<20} {'P50':>9} {'P95':>9}")
+        for stage, row in sorted(result['stages'].items(), key=lambda item: -item[1]['p50']):
+            print(f"   {stage:<20} {row['p50']:>8.2f}s {row['p95']:>8.2f}s")
+        print(f"   {'TOTAL':<20} {result['total']['p50']:>8.2f}s {result['total']['p95']:>8.2f}s")
+
+def regressions(results, baseline, tolerance, floor=0.05):
+    """Stages/totals whose p50 grew more than `tolerance` (ignoring sub-`floor` noise)."""
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        pairs = [("TOTAL", result['total'], base['total'])]
+        pairs += [(stage, row, base['stages'][stage])
+                  for stage, row in result['stages'].items() if stage in base['stages']]
+        for stage, row, base_row in pairs:
+            if row['p50'] - base_row['p50'] > max(floor, base_row['p50'] * tolerance):
+                found.append(f"{name}/{stage}: p50 {base_row['p50']:.2f}s -> {row['p50']:.2f}s")
+        if result['failed'] > base.get('failed', 0):
+            found.append(f"{name}: {result['failed']} failed runs (baseline {base.get('failed', 0)})")
+    return found
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the unbrick pipeline against simulated tools.")
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"{', '.join(sorted(SCENARIOS))} (default: all)")
+    parser.add_argument('-n', '--runs', type=int, default=3, help="runs per scenario")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply every simulated delay")
+    parser.add_argument('--config', metavar='FILE', help="JSON overrides for the simulated timings/failures")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--save', metavar='FILE', help="write the results as a baseline")
+    parser.add_argument('--baseline', metavar='FILE', help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p50 slowdown (0.2 = 20%%)")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    config = dict(DEFAULT_CONFIG, scale=args.scale)
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    root = tempfile.mkdtemp(prefix="leunbrick-bench-")
+    bench = Bench(root, config)
+    try:
+        bench.setup()
+        # Imported only now: main.py reads the tool/firmware locations at import time
+        sys.path.insert(0, SCRIPT_DIR)
+        import main as pipeline
+        results = {}
+        for name in args.scenarios or sorted(SCENARIOS):
+            runs = [run_once(bench, name, pipeline) for _ in range(args.runs)]
+            results[name] = summarize(runs)
+    finally:
+        if args.keep:
+            print(f"Scratch directory kept: {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=1, sort_keys=True))
+    else:
+        print_report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+"""Packed firmware bundle: every DFU/MSE image in one deduplicated file.
+
+Layout:
+    magic  b'LUBNDL1\\0'
+    u32    length of the JSON index that follows
+    index  {"blobs": [{"offset", "length", "sha256"}], "entries": {name: blob}}
+    blobs  each starting on a 4 KiB boundary
+
+Identical images (the 2012 and 2015 WTF are byte-for-byte the same) are
+stored once and referenced by several names. Readers mmap the bundle and
+hand out memoryview slices, so an image can be streamed to the device or
+hashed without being copied out first.
+
+    python3 bundle.py build firmwares.lub misc/firmwares
+    python3 bundle.py list firmwares.lub
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'LUBNDL1\0'
+ALIGN = 4096
+IMAGE_SUFFIXES = ('.dfu', '.mse')
+
+class BundleError(Exception):
+    pass
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+def collect(root):
+    """{bundle name: path} for every DFU/MSE image under `root`."""
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_SUFFIXES):
+                path = os.path.join(dirpath, filename)
+                files[os.path.relpath(path, root).replace(os.sep, '/')] = path
+    return files
+
+def build(out_path, files):
+    """Write a bundle holding `files` ({name: path}). Returns (entries, unique blobs)."""
+    blobs, entries, by_digest = [], {}, {}
+    for name, path in sorted(files.items()):
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        if digest not in by_digest:
+            by_digest[digest] = len(blobs)
+            blobs.append({'sha256': digest, 'length': os.path.getsize(path), 'source': path})
+        entries[name] = by_digest[digest]
+
+    # Offsets depend on the index size, which depends on the offsets' digits,
+    # so lay out against a generous upper bound for the header
+    index = {'blobs': [{'offset': 0, 'length': b['length'], 'sha256': b['sha256']} for b in blobs],
+             'entries': entries}
+    header_len = len(MAGIC) + 4 + len(json.dumps(index)) + 24 * len(blobs)
+    offset = _align(header_len)
+    for blob in index['blobs']:
+        blob['offset'] = offset
+        offset = _align(offset + blob['length'])
+    encoded = json.dumps(index, sort_keys=True).encode()
+
+    tmp = out_path + ".tmp"
+    with open(tmp, 'wb') as out:
+        out.write(MAGIC + struct.pack('<L', len(encoded)) + encoded)
+        for blob, source in zip(index['blobs'], blobs):
+            out.write(b'\0' * (blob['offset'] - out.tell()))
+            with open(source['source'], 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    out.write(chunk)
+    os.replace(tmp, out_path)
+    return len(entries), len(blobs)
+
+class Bundle:
+    """Read-only view of a bundle through a single mmap."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise BundleError(f"{path}: empty file")
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise BundleError(f"{path}: not a firmware bundle")
+        (index_len,) = struct.unpack_from('<L', self.map, len(MAGIC))
+        start = len(MAGIC) + 4
+        index = json.loads(self.map[start:start + index_len])
+        self.blobs = index['blobs']
+        self.entries = index['entries']
+        for blob in self.blobs:
+            if blob['offset'] + blob['length'] > len(self.map):
+                self.close()
+                raise BundleError(f"{path}: truncated bundle")
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return sorted(self.entries)
+
+    def info(self, name):
+        return self.blobs[self.entries[name]]
+
+    def sha256(self, name):
+        return self.info(name)['sha256']
+
+    def view(self, name):
+        """Zero-copy memoryview of one image. Release it before close()."""
+        blob = self.info(name)
+        return memoryview(self.map)[blob['offset']:blob['offset'] + blob['length']]
+
+    def verify(self, name):
+        view = self.view(name)
+        try:
+            return hashlib.sha256(view).hexdigest() == self.sha256(name)
+        finally:
+            view.release()
+
+    def extract(self, name, dest):
+        """Write one image out as a regular file (for tools that need a path)."""
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        view = self.view(name)
+        try:
+            with open(dest + ".part", 'wb') as f:
+                f.write(view)
+        finally:
+            view.release()
+        os.replace(dest + ".part", dest)
+
+def main(argv):
+    if len(argv) == 3 and argv[0] == 'build':
+        entries, blobs = build(argv[1], collect(argv[2]))
+        print(f"{argv[1]}: {entries} images, {blobs} unique, {os.path.getsize(argv[1])} bytes")
+        return 0
+    if len(argv) == 2 and argv[0] == 'list':
+        with Bundle(argv[1]) as b:
+            for name in b.names():
+                info = b.info(name)
+                print(f"{info['sha256'][:16]}  {info['length']:>10}  {name}")
+        return 0
+    print("Usage: bundle.py build <out.lub> <firmwares dir>")
+    print("       bundle.py list <bundle.lub>")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
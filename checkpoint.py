@@ -0,0 +1,79 @@
+"""Per-device progress checkpoints, so an interrupted unbrick can resume.
+
+One JSON file (<cache>/checkpoints.json) maps a device key - family plus
+USB port path where the port is known ("7G@1-1.2"), else just the family -
+to the last stage that device completed:
+
+    dfu        in DFU mode, nothing flashed yet
+    wtf        WTF image flashed and booted (the variant is known from here on)
+    disk_mode  Disk Mode firmware flashed, Firmware.MSE not written yet
+    done       Firmware.MSE written
+
+Disk Mode can't be told apart from a healthy iPod's disk by looking at
+the bus, so resuming at the ipodscsi stage is only allowed from a
+"disk_mode" checkpoint.
+"""
+import json
+import os
+import threading
+import time
+
+import paths
+
+CHECKPOINT_FILE = os.path.join(paths.CACHE_DIR, "checkpoints.json")
+STAGES = ("dfu", "wtf", "disk_mode", "done")
+# Checkpoints older than this describe some earlier iPod on the port
+MAX_AGE = 6 * 3600
+
+def device_key(family, port=None):
+    return f"{family}@{port}" if port else family
+
+class Checkpoints:
+    """Checkpoint store shared by threads and processes, written through on every update."""
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, family, port=None):
+        """The device's checkpoint dict, or None if there is none (or it is stale)."""
+        with self.lock:
+            entry = self._load().get(device_key(family, port))
+        if entry and time.time() - entry.get('updated', 0) <= MAX_AGE:
+            return entry
+        return None
+
+    def entries(self, family):
+        """Every fresh checkpoint of `family`, on any port."""
+        with self.lock:
+            data = self._load()
+        now = time.time()
+        return [entry for entry in data.values()
+                if entry.get('family') == family and now - entry.get('updated', 0) <= MAX_AGE]
+
+    def mark(self, family, port, stage, variant=None):
+        if stage not in STAGES:
+            raise ValueError(f"unknown checkpoint stage {stage!r}")
+        key = device_key(family, port)
+        entry = {}
+        with self.lock:
+            try:
+                # Sessions in other processes (agents, stations) update the same file
+                with paths.file_lock(self.path):
+                    data = self._load()
+                    entry = data.get(key, {}) if stage != "dfu" else {}
+                    entry.update({'family': family, 'port': port, 'stage': stage, 'updated': time.time()})
+                    if variant:
+                        entry['variant'] = variant
+                    data[key] = entry
+                    paths.atomic_write(self.path, json.dumps(data, indent=1, sort_keys=True))
+            except OSError:
+                pass
+        return entry
@@ -0,0 +1,444 @@
+"""Hands unbrick jobs out to several bench machines.
+
+Each bench runs an agent (main.py --agent URL) that checks in every couple
+of seconds with its free USB ports, the firmware it has cached (SHA-256
+per image), the jobs it is running, and the results of jobs it finished.
+A queued job goes to the least loaded live agent that already has the
+model's images cached, preferring one with an iPod of that model on a free
+port, and waits while all of those are busy; only when no live agent has
+the images is it sent to one that will have to fetch them. Results are
+kept here (the last daemon.KEEP_FINISHED finished jobs) and appended to
+<cache>/results.jsonl.
+
+Several agents can share one machine when each gets its own ports
+(main.py --agent URL --agent-ports 1-1,1-2); otherwise they would all
+report, and go for, the same iPods.
+
+Agents poll, so the coordinator never connects to a bench. An agent that
+stops checking in, or restarts and no longer runs a job it was handed,
+gets that job taken back and queued again (up to MAX_TRIES times).
+
+    POST /jobs            {"model": "7g", "yes": true[, "target", "port", "agent"]} -> {"ok", "job"}
+    GET  /jobs, /jobs/<id>, /agents, /health
+    POST /agents/<name>   agent check-in -> {"ok", "jobs": [{"id", "spec"}, ...]}
+
+With LEUNBRICK_COORDINATOR_TOKEN set (on the coordinator, every agent and
+every client), requests must carry "Authorization: Bearer <token>".
+Without one, only this machine may POST, and serve refuses to listen on
+anything but a loopback address.
+
+    python3 coordinator.py serve [--host 0.0.0.0] [--port 8470]
+    python3 coordinator.py submit --model 7g --yes [--agent bench2] [--wait]
+    python3 coordinator.py jobs
+    python3 coordinator.py agents
+"""
+import argparse
+import asyncio
+import ipaddress
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import daemon
+import paths
+
+DEFAULT_URL = os.environ.get('LEUNBRICK_COORDINATOR', "http://127.0.0.1:8470")
+TOKEN = os.environ.get('LEUNBRICK_COORDINATOR_TOKEN')
+RESULTS_FILE = os.path.join(paths.CACHE_DIR, "results.jsonl")
+CHECK_IN_INTERVAL = 2.0
+# An agent silent for this long is gone; its jobs are queued again
+AGENT_TIMEOUT = 15.0
+MAX_TRIES = 3
+REQUEST_TIMEOUT = 10
+
+def loopback(host):
+    """Whether `host` (an address, or "localhost") only reaches this machine."""
+    if host == "localhost":
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return (getattr(address, 'ipv4_mapped', None) or address).is_loopback
+
+class Job(daemon.Job):
+    """A daemon.Job plus where it runs. States: queued, assigned (waiting for
+    the agent's next check-in), running, done, failed."""
+
+    def __init__(self, job_id, spec):
+        super().__init__(job_id, spec)
+        self.agent = None
+        self.stage = None
+        self.tries = 0
+
+    def summary(self):
+        return dict(super().summary(), agent=self.agent, stage=self.stage, tries=self.tries)
+
+class Bench:
+    """What the coordinator knows about one agent, from its last check-in."""
+
+    def __init__(self, name):
+        self.name = name
+        self.slots = 1
+        self.ports = {}       # free port path -> model of the iPod on it
+        self.firmware = {}    # model -> {image: sha256}, only models with every image
+        self.failures = {}
+        self.seen = None
+        self.address = None
+
+    def alive(self, now):
+        return self.seen is not None and now - self.seen < AGENT_TIMEOUT
+
+    def summary(self, jobs, now):
+        return {'name': self.name, 'alive': self.alive(now), 'slots': self.slots, 'jobs': jobs,
+                'ports': self.ports, 'firmware': self.firmware, 'failures': self.failures,
+                'address': self.address, 'seen_ago': round(now - self.seen, 1) if self.seen else None}
+
+class Coordinator:
+    def __init__(self, results_path=RESULTS_FILE, token=TOKEN):
+        self.results_path = results_path
+        self.token = token
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.benches = {}
+
+    # ---- Jobs ----
+    def submit(self, spec):
+        """Queue a job. Raises ValueError for a bad spec; the agent checks the rest."""
+        if not isinstance(spec, dict) or not spec.get('model'):
+            raise ValueError("a job needs at least a model")
+        job = Job(next(self.ids), dict(spec, model=str(spec['model']).lower()))
+        self.jobs[job.id] = job
+        self.schedule()
+        return job
+
+    def find(self, job_id):
+        try:
+            return self.jobs[int(job_id)]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(f"no job {job_id}")
+
+    def active(self, name):
+        return [job for job in self.jobs.values()
+                if job.agent == name and job.state in ("assigned", "running")]
+
+    def requeue(self, job, why):
+        """Take a job back from its agent; it fails once it has been handed out MAX_TRIES times."""
+        if job.tries >= MAX_TRIES:
+            self.finish(job, {'result': "failed", 'exit_code': 1, 'error': f"{why} ({job.tries} tries)"})
+        else:
+            job.state, job.agent, job.stage = "queued", None, None
+
+    def finish(self, job, record):
+        job.record = record
+        job.state = "done" if record.get('exit_code') == 0 else "failed"
+        job.stage = None
+        try:
+            os.makedirs(os.path.dirname(self.results_path) or ".", exist_ok=True)
+            with open(self.results_path, 'a') as f:
+                f.write(json.dumps({'job': job.id, 'agent': job.agent, 'spec': job.spec,
+                                    'state': job.state, 'finished_at': round(time.time(), 3),
+                                    'record': record}) + "\n")
+        except OSError:
+            pass
+        daemon.prune_finished(self.jobs)
+
+    # ---- Scheduling ----
+    def candidates(self, job, now):
+        """Live benches `job` may go to: the ones with its model's images
+        cached, or every one only when no live bench has them."""
+        live = [bench for bench in self.benches.values()
+                if bench.alive(now) and job.spec.get('agent') in (None, bench.name)]
+        cached = [bench for bench in live if job.spec['model'] in bench.firmware]
+        return cached or live
+
+    def rank(self, job, bench):
+        """Sort key of `bench` for `job`, None if it is full."""
+        busy = len(self.active(bench.name))
+        if busy >= bench.slots:
+            return None
+        model, port = job.spec['model'], job.spec.get('port')
+        has_device = any(found == model and port in (None, path) for path, found in bench.ports.items())
+        return not has_device, busy / bench.slots, bench.name
+
+    def schedule(self):
+        """Assign queued jobs, oldest first, to the best candidate bench that
+        has room. A job waits while every bench with its images is full."""
+        now = time.monotonic()
+        self.expire(now)
+        for job in sorted((job for job in self.jobs.values() if job.state == "queued"), key=lambda job: job.id):
+            ranked = [(key, bench) for bench in self.candidates(job, now)
+                      for key in [self.rank(job, bench)] if key is not None]
+            if ranked:
+                bench = min(ranked, key=lambda item: item[0])[1]
+                job.state, job.agent = "assigned", bench.name
+                job.tries += 1
+
+    def expire(self, now):
+        for bench in self.benches.values():
+            if not bench.alive(now):
+                for job in self.active(bench.name):
+                    self.requeue(job, f"agent {bench.name} stopped checking in")
+
+    # ---- Agents ----
+    def check_in(self, name, report, address=None):
+        """Take an agent's report; returns the jobs newly handed to it."""
+        bench = self.benches.setdefault(name, Bench(name))
+        bench.slots = max(int(report.get('slots') or 1), 1)
+        bench.ports = dict(report.get('ports') or {})
+        bench.firmware = dict(report.get('firmware') or {})
+        bench.failures = dict(report.get('failures') or {})
+        bench.seen, bench.address = time.monotonic(), address
+        finished = set()
+        for result in report.get('results') or []:
+            job = self.jobs.get(result.get('job'))
+            finished.add(result.get('job'))
+            if job and job.agent == name and not job.finished:
+                self.finish(job, result.get('record') or {})
+        running = {int(job_id): stage for job_id, stage in (report.get('running') or {}).items()}
+        for job in self.active(name):
+            if job.id in running:
+                job.state, job.stage = "running", running[job.id]
+            elif job.state == "running" and job.id not in finished:
+                # Handed out on an earlier check-in but the agent doesn't have it (restarted)
+                self.requeue(job, f"agent {name} lost the job")
+        self.schedule()
+        handed = [job for job in self.active(name) if job.state == "assigned"]
+        for job in handed:
+            job.state = "running"
+        return [{'id': job.id, 'spec': job.spec} for job in handed]
+
+    def agents(self):
+        now = time.monotonic()
+        return [bench.summary([job.id for job in self.active(bench.name)], now)
+                for bench in sorted(self.benches.values(), key=lambda bench: bench.name)]
+
+    # ---- HTTP ----
+    async def handle_http(self, reader, writer):
+        try:
+            request = await daemon.read_http(reader, writer)
+            if request:
+                method, path, _query, headers, body = request
+                peer = writer.get_extra_info('peername')
+                address = peer[0] if peer else None
+                if self.token and not daemon.authorized(headers, self.token):
+                    await daemon.http_reply(writer, 401, {'ok': False, 'error': "bad or missing token"})
+                elif not self.token and method != "GET" and not loopback(address):
+                    await daemon.http_reply(writer, 403, {'ok': False, 'error':
+                                            "only this machine may POST without LEUNBRICK_COORDINATOR_TOKEN"})
+                else:
+                    await self.route(writer, method, path, body, address)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, body, address):
+        parts = path.strip('/').split('/')
+        reply = daemon.http_reply
+        try:
+            if method == "POST" and path == "/jobs":
+                return await reply(writer, 202, {'ok': True, 'job': self.submit(json.loads(body or b'{}')).id})
+            if method == "GET" and path == "/jobs":
+                return await reply(writer, 200, {'ok': True, 'jobs': [job.summary() for job in self.jobs.values()]})
+            if method == "GET" and len(parts) == 2 and parts[0] == "jobs":
+                return await reply(writer, 200, {'ok': True, 'job': self.find(parts[1]).summary()})
+            if method == "POST" and len(parts) == 2 and parts[0] == "agents":
+                jobs = self.check_in(parts[1], json.loads(body or b'{}'), address)
+                return await reply(writer, 200, {'ok': True, 'jobs': jobs})
+            if method == "GET" and path == "/agents":
+                return await reply(writer, 200, {'ok': True, 'agents': self.agents()})
+            if method == "GET" and path == "/health":
+                states = [job.state for job in self.jobs.values()]
+                return await reply(writer, 200, {'ok': True, 'agents': sum(a['alive'] for a in self.agents()),
+                                                 'jobs': {state: states.count(state) for state in set(states)}})
+            return await reply(writer, 404, {'ok': False, 'error': f"no route {method} {path}"})
+        except KeyError as e:
+            return await reply(writer, 404, {'ok': False, 'error': daemon.error_text(e)})
+        except (ValueError, TypeError, AttributeError) as e:
+            return await reply(writer, 400, {'ok': False, 'error': str(e)})
+
+    async def serve(self, host="127.0.0.1", port=8470, ready=None):
+        """Serve until cancelled. ready(server) is called once listening."""
+        server = await asyncio.start_server(self.handle_http, host, port)
+        if ready:
+            ready(server)
+        async def reaper():
+            # Jobs of agents that went silent are re-queued even when nobody checks in
+            while True:
+                await asyncio.sleep(AGENT_TIMEOUT / 3)
+                self.schedule()
+        task = asyncio.ensure_future(reaper())
+        try:
+            await server.serve_forever()
+        finally:
+            task.cancel()
+            server.close()
+
+# ---- Client ----
+def call(url, method, path, body=None, token=TOKEN):
+    """One JSON request to the coordinator. Raises OSError if it can't be reached."""
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url.rstrip('/') + path, data=data, method=method,
+                                     headers={'Content-Type': "application/json"})
+    if token:
+        request.add_header('Authorization', f"Bearer {token}")
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        # Error replies carry {"ok": false, "error": ...} too
+        with e:
+            return json.loads(e.read() or b'{}')
+
+class Agent:
+    """A bench's side: check in, run what the coordinator hands out, report back.
+
+    run_job(spec, emit) -> record runs one job on a worker thread (emit gets
+    its stage events); status() -> {'ports', 'firmware', ...} is merged into
+    every check-in.
+    """
+
+    def __init__(self, url, name, run_job, status, slots=2, log=print, token=TOKEN):
+        self.url = url
+        self.name = name
+        self.run_job = run_job
+        self.status = status
+        self.slots = slots
+        self.log = log
+        self.token = token
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = {}   # job id -> current stage
+        self.results = []   # finished, not yet acknowledged by the coordinator
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="agent-job")
+        reachable = None
+        try:
+            while not stop.is_set():
+                with self.lock:
+                    results = list(self.results)
+                    report = dict(self.status(), slots=self.slots, running=dict(self.running), results=results)
+                try:
+                    reply = call(self.url, "POST", f"/agents/{self.name}", report, self.token)
+                    if not reply.get('ok'):
+                        raise ValueError(reply.get('error'))
+                except (OSError, ValueError) as e:
+                    if reachable is not False:
+                        self.log(f"Coordinator {self.url} unreachable ({e}), retrying...")
+                    reachable = False
+                    stop.wait(CHECK_IN_INTERVAL)
+                    continue
+                if not reachable:
+                    self.log(f"Checked in with {self.url} as {self.name} ({self.slots} slots)")
+                    reachable = True
+                with self.lock:
+                    del self.results[:len(results)]
+                    for job in reply['jobs']:
+                        self.running[job['id']] = "queued"
+                for job in reply['jobs']:
+                    self.log(f"Job {job['id']}: {job['spec'].get('model')} from the coordinator")
+                    pool.submit(self.run_one, job)
+                self.wake.wait(CHECK_IN_INTERVAL)
+                self.wake.clear()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def run_one(self, job):
+        def emit(event):
+            if event.get('event') == "stage_started":
+                with self.lock:
+                    self.running[job['id']] = event['stage']
+        try:
+            record = self.run_job(job['spec'], emit)
+        except Exception as e:
+            record = {'result': "failed", 'exit_code': 1, 'error': f"{type(e).__name__}: {e}"}
+        with self.lock:
+            del self.running[job['id']]
+            self.results.append({'job': job['id'], 'record': record})
+        # Report at once instead of at the next tick
+        self.wake.set()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Coordinate unbrick jobs across bench machines.")
+    parser.add_argument('--url', default=DEFAULT_URL, help="coordinator URL for the client commands")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="run the coordinator")
+    serve.add_argument('--host', default="127.0.0.1", help="address to listen on (0.0.0.0 for other machines, "
+                       "which needs LEUNBRICK_COORDINATOR_TOKEN)")
+    serve.add_argument('--port', type=int, default=8470)
+    serve.add_argument('--results', default=RESULTS_FILE, help="JSON-lines file results are appended to")
+    submit = commands.add_parser('submit', help="queue an unbrick job")
+    submit.add_argument('--model', required=True, type=str.lower)
+    submit.add_argument('--target', default="auto")
+    submit.add_argument('--yes', action='store_true')
+    submit.add_argument('--port', help="USB port path to pin the job to")
+    submit.add_argument('--agent', help="only run it on this agent")
+    submit.add_argument('--wait', action='store_true', help="wait for the result")
+    commands.add_parser('jobs', help="list jobs")
+    commands.add_parser('agents', help="list agents")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        if not TOKEN and not loopback(args.host):
+            print(f"Refusing to listen on {args.host} without LEUNBRICK_COORDINATOR_TOKEN: "
+                  "anyone who can reach it could queue jobs.", file=sys.stderr)
+            return 2
+        coordinator = Coordinator(args.results, token=TOKEN)
+        try:
+            asyncio.run(coordinator.serve(args.host, args.port, ready=lambda server: print(
+                f"Coordinator listening on http://{args.host}:{args.port}", flush=True)))
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(f"Cannot start the coordinator: {e}", file=sys.stderr)
+            return 3
+        return 0
+
+    try:
+        if args.command == 'submit':
+            spec = {'model': args.model, 'target': args.target, 'yes': args.yes}
+            spec.update({key: value for key, value in (('port', args.port), ('agent', args.agent)) if value})
+            reply = call(args.url, "POST", "/jobs", spec)
+            if not reply.get('ok'):
+                print(reply.get('error'), file=sys.stderr)
+                return 2
+            print(f"job {reply['job']} queued")
+            if not args.wait:
+                return 0
+            while True:
+                job = call(args.url, "GET", f"/jobs/{reply['job']}")['job']
+                if job['state'] in ("done", "failed"):
+                    record = job['record'] or {}
+                    print(f"job {job['id']} on {job['agent']}: {job['state']}"
+                          + (f" - {record['error']}" if record.get('error') else ""))
+                    return record.get('exit_code', 1)
+                time.sleep(CHECK_IN_INTERVAL)
+        if args.command == 'jobs':
+            for job in call(args.url, "GET", "/jobs")['jobs']:
+                record = job['record'] or {}
+                print(f"{job['id']:>4}  {job['state']:<8} {job['spec'].get('model', '?'):<4} "
+                      f"{job['agent'] or '-':<16} {job['stage'] or record.get('error') or ''}")
+        else:
+            for agent in call(args.url, "GET", "/agents")['agents']:
+                print(f"{agent['name']:<16} {'up' if agent['alive'] else 'DOWN':<4} "
+                      f"jobs {len(agent['jobs'])}/{agent['slots']}  "
+                      f"firmware {','.join(sorted(agent['firmware'])) or '-':<6} "
+                      f"ports {', '.join(f'{path}={model}' for path, model in sorted(agent['ports'].items())) or '-'}")
+        return 0
+    except OSError as e:
+        print(f"Cannot reach the coordinator at {args.url}: {e}", file=sys.stderr)
+        return 3
+    except KeyboardInterrupt:
+        return 130
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,398 @@
+"""Long-running unbrick service with a local job API.
+
+One process keeps the firmware index, USB watcher and DFU engine warm and
+runs any number of unbrick jobs side by side. Clients talk to it over a
+UNIX socket (one JSON object per line) or, optionally, plain HTTP on
+localhost:
+
+    {"op": "submit", "job": {"model": "7g", "yes": true}}  -> {"ok": true, "job": 3}
+    {"op": "jobs"}                                         -> {"ok": true, "jobs": [...]}
+    {"op": "job", "id": 3}                                 -> {"ok": true, "job": {...}}
+    {"op": "watch", "id": 3}   event stream; without "id" every job's, until the client leaves
+
+    POST /jobs, GET /jobs, GET /jobs/<id>, GET /events[?job=<id>] (text/event-stream),
+    GET /health, GET /metrics (Prometheus, see metrics.py)
+
+Whoever can submit a job can flash any attached iPod. The socket is owner
+and group only; over HTTP, POST /jobs needs LEUNBRICK_DAEMON_TOKEN set on
+the daemon and "Authorization: Bearer <token>" on every request (as for
+the coordinator). Without a token the HTTP API is read-only.
+
+Events are JSON objects with "event", "job" and "time": "queued", "started",
+"stage_started", "progress" (stage, percent), "stage" (a finished stage's
+record) and "finished" (the job's result record). Watching a job replays
+its events so far first; only the latest "progress" of a stage is kept for
+that. The last KEEP_FINISHED finished jobs are remembered, older ones are
+forgotten.
+
+    python3 daemon.py submit --model 7g --yes [--watch]
+    python3 daemon.py watch [job]
+    python3 daemon.py jobs
+"""
+import argparse
+import asyncio
+import hmac
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import paths
+
+SOCKET_PATH = os.environ.get('LEUNBRICK_SOCKET', os.path.join(paths.CACHE_DIR, "leunbrick.sock"))
+TOKEN = os.environ.get('LEUNBRICK_DAEMON_TOKEN')
+MAX_REQUEST = 1 << 20
+KEEP_FINISHED = 200
+METRICS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def error_text(e):
+    # str(KeyError) is the repr of its message
+    return e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+
+# ---- HTTP ----
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+           404: "Not Found", 413: "Payload Too Large"}
+
+async def read_http(reader, writer):
+    """(method, path, query, headers, body) of one request, or None if there
+    wasn't a complete one (a bad Content-Length is answered with 400 and an
+    oversized body with 413 here)."""
+    request_line = (await reader.readline()).decode('latin-1').split()
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if len(request_line) < 2:
+        return None
+    method, target = request_line[0], urlsplit(request_line[1])
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        await http_reply(writer, 400, {'ok': False, 'error': "bad Content-Length"})
+        return None
+    if length > MAX_REQUEST:
+        await http_reply(writer, 413, {'ok': False, 'error': "request too large"})
+        return None
+    body = await reader.readexactly(length) if length else b''
+    return method, target.path.rstrip('/') or '/', parse_qs(target.query), headers, body
+
+def authorized(headers, token):
+    """Whether a request's headers carry "Authorization: Bearer <token>"."""
+    return hmac.compare_digest(headers.get('authorization', ''), f"Bearer {token}")
+
+async def http_reply(writer, status, obj):
+    await http_text(writer, status, json.dumps(obj), "application/json")
+
+async def http_text(writer, status, text, content_type):
+    body = text.encode()
+    writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+
+class Job:
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = spec
+        self.state = "queued"
+        self.record = None
+        self.events = []
+        self.created = time.time()
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed")
+
+    def summary(self):
+        return {'id': self.id, 'state': self.state, 'spec': self.spec, 'created': self.created,
+                'record': self.record}
+
+def prune_finished(jobs):
+    """Forget all but the last KEEP_FINISHED finished jobs of {id: Job}."""
+    finished = [job.id for job in jobs.values() if job.finished]
+    for job_id in finished[:-KEEP_FINISHED]:
+        del jobs[job_id]
+
+class JobServer:
+    """Runs jobs through `run_job(spec, emit) -> record` on worker threads.
+
+    validate(spec) returns the normalized spec or raises ValueError. A
+    record whose 'exit_code' is 0 marks the job done, anything else failed.
+    health(), when given, adds fields to the ping and /health replies;
+    metrics() returns the Prometheus text served on GET /metrics. Without a
+    token, HTTP requests other than GET are refused.
+    """
+
+    def __init__(self, run_job, validate=None, max_jobs=4, health=None, metrics=None, token=TOKEN):
+        self.run_job = run_job
+        self.validate = validate or (lambda spec: spec)
+        self.health = health or dict
+        self.metrics = metrics
+        self.token = token
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.watchers = set()
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
+        self.slots = None
+        self.loop = None
+
+    # ---- Jobs ----
+    def submit(self, spec):
+        """Queue a job (call on the loop). Raises ValueError for a bad spec."""
+        job = Job(next(self.ids), self.validate(spec))
+        self.jobs[job.id] = job
+        self.publish(job, {'event': "queued", 'spec': job.spec})
+        asyncio.ensure_future(self.run(job))
+        return job
+
+    async def run(self, job):
+        async with self.slots:
+            job.state = "running"
+            self.publish(job, {'event': "started"})
+
+            def emit(event):
+                # Called from the job's thread
+                self.loop.call_soon_threadsafe(self.publish, job, event)
+            try:
+                record = await self.loop.run_in_executor(self.executor, self.run_job, job.spec, emit)
+            except Exception as e:
+                record = {'result': "failed", 'exit_code': 1, 'error': f"{type(e).__name__}: {e}"}
+            job.record = record
+            job.state = "done" if record.get('exit_code') == 0 else "failed"
+            self.publish(job, {'event': "finished", 'state': job.state, 'record': record})
+            self.prune()
+
+    def prune(self):
+        prune_finished(self.jobs)
+
+    def publish(self, job, event):
+        event = dict(event, job=job.id, time=round(time.time(), 3))
+        if event['event'] == "progress":
+            # Watchers joining later only need where each stage got to
+            job.events = [old for old in job.events
+                          if old['event'] != "progress" or old.get('stage') != event.get('stage')]
+        job.events.append(event)
+        for job_id, queue in list(self.watchers):
+            if job_id is None or job_id == job.id:
+                queue.put_nowait(event)
+
+    async def watch(self, job_id=None):
+        """Yield events: the job's history first, then live ones until it finishes."""
+        queue = asyncio.Queue()
+        watcher = (job_id, queue)
+        # No await between registering and copying the history, so nothing is missed or doubled
+        self.watchers.add(watcher)
+        history = list(self.jobs[job_id].events) if job_id is not None else []
+        try:
+            for event in history:
+                yield event
+            if history and history[-1]['event'] == "finished":
+                return
+            while True:
+                event = await queue.get()
+                yield event
+                if job_id is not None and event['event'] == "finished":
+                    return
+        finally:
+            self.watchers.discard(watcher)
+
+    def find(self, job_id):
+        try:
+            return self.jobs[int(job_id)]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(f"no job {job_id}")
+
+    # ---- UNIX socket ----
+    async def handle_socket(self, reader, writer):
+        async def send(obj):
+            writer.write((json.dumps(obj) + "\n").encode())
+            await writer.drain()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    op = request.get('op')
+                    if op == "submit":
+                        await send({'ok': True, 'job': self.submit(request.get('job') or {}).id})
+                    elif op == "jobs":
+                        await send({'ok': True, 'jobs': [job.summary() for job in self.jobs.values()]})
+                    elif op == "job":
+                        await send({'ok': True, 'job': self.find(request.get('id')).summary()})
+                    elif op == "watch":
+                        job_id = request.get('id')
+                        job_id = self.find(job_id).id if job_id is not None else None
+                        async for event in self.watch(job_id):
+                            await send(event)
+                        break
+                    elif op == "ping":
+                        await send(dict(self.health(), ok=True, jobs=len(self.jobs), max_jobs=self.max_jobs))
+                    else:
+                        await send({'ok': False, 'error': f"unknown op {op!r}"})
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    await send({'ok': False, 'error': error_text(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # ---- HTTP ----
+    async def handle_http(self, reader, writer):
+        try:
+            request = await read_http(reader, writer)
+            if request:
+                method, path, query, headers, body = request
+                if self.token and not authorized(headers, self.token):
+                    await http_reply(writer, 401, {'ok': False, 'error': "bad or missing token"})
+                elif not self.token and method != "GET":
+                    await http_reply(writer, 403, {'ok': False, 'error':
+                                     "HTTP is read-only without LEUNBRICK_DAEMON_TOKEN; submit over the socket"})
+                else:
+                    await self.route(writer, method, path, query, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, query, body):
+        parts = path.strip('/').split('/')
+        try:
+            if method == "POST" and path == "/jobs":
+                job = self.submit(json.loads(body or b'{}'))
+                return await http_reply(writer, 202, {'ok': True, 'job': job.id})
+            if method == "GET" and path == "/jobs":
+                return await http_reply(writer, 200, {'ok': True, 'jobs': [
+                    job.summary() for job in self.jobs.values()]})
+            if method == "GET" and len(parts) == 2 and parts[0] == "jobs":
+                return await http_reply(writer, 200, {'ok': True, 'job': self.find(parts[1]).summary()})
+            if method == "GET" and path == "/events":
+                job_id = self.find(query['job'][0]).id if 'job' in query else None
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                             b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+                async for event in self.watch(job_id):
+                    writer.write(f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode())
+                    await writer.drain()
+                return
+            if method == "GET" and path == "/metrics" and self.metrics:
+                return await http_text(writer, 200, self.metrics(), METRICS_TYPE)
+            if method == "GET" and path == "/health":
+                return await http_reply(writer, 200, dict(self.health(), ok=True, jobs=len(self.jobs)))
+            return await http_reply(writer, 404, {'ok': False, 'error': f"no route {method} {path}"})
+        except KeyError as e:
+            return await http_reply(writer, 404, {'ok': False, 'error': error_text(e)})
+        except (ValueError, TypeError, AttributeError) as e:
+            return await http_reply(writer, 400, {'ok': False, 'error': str(e)})
+
+    # ---- Serving ----
+    async def serve(self, socket_path=SOCKET_PATH, http_port=None, host="127.0.0.1", ready=None):
+        """Serve until cancelled. ready(servers) is called once listening."""
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.max_jobs)
+        servers = []
+        if socket_path:
+            os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            servers.append(await asyncio.start_unix_server(self.handle_socket, path=socket_path))
+            # Owner and group only: whoever can submit jobs can flash any attached iPod
+            os.chmod(socket_path, 0o660)
+        if http_port is not None:
+            servers.append(await asyncio.start_server(self.handle_http, host, http_port))
+        if ready:
+            ready(servers)
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.executor.shutdown(wait=False)
+
+# ---- Client ----
+def request(obj, socket_path=SOCKET_PATH):
+    """Send one request and yield every reply line (one for most ops, a stream for watch)."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(obj) + "\n").encode())
+        if obj.get('op') != "watch":
+            sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('r') as replies:
+            for line in replies:
+                yield json.loads(line)
+
+def print_event(event):
+    if event['event'] == "progress":
+        print(f"job {event['job']}: {event['stage']} {event['percent']}%")
+    elif event['event'] == "stage":
+        state = "skipped" if event['ok'] is None else "ok" if event['ok'] else "FAILED"
+        print(f"job {event['job']}: {event['stage']} {state} ({event['seconds']:.1f}s) {event['detail']}")
+    elif event['event'] == "finished":
+        record = event['record']
+        print(f"job {event['job']}: {event['state']}"
+              + (f" - {record['error']}" if record.get('error') else f" in {record.get('seconds', 0):.1f}s"))
+    elif event['event'] != "stage_started":
+        print(f"job {event['job']}: {event['event']}")
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Talk to a running LeUnBrIck daemon (main.py --daemon).")
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+    submit = commands.add_parser('submit', help="queue an unbrick job")
+    submit.add_argument('--model', required=True, type=str.lower)
+    submit.add_argument('--target', default="auto")
+    submit.add_argument('--yes', action='store_true')
+    submit.add_argument('--port', help="USB port path to pin the job to")
+    submit.add_argument('--watch', action='store_true', help="follow the job until it finishes")
+    watch = commands.add_parser('watch', help="stream progress events")
+    watch.add_argument('job', nargs='?', type=int)
+    commands.add_parser('jobs', help="list jobs")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'submit':
+            reply = next(request({'op': "submit", 'job': {
+                'model': args.model, 'target': args.target, 'yes': args.yes, 'port': args.port}},
+                args.socket))
+            if not reply['ok']:
+                print(reply['error'], file=sys.stderr)
+                return 2
+            print(f"job {reply['job']} queued")
+            if not args.watch:
+                return 0
+            args.job = reply['job']
+        if args.command in ('submit', 'watch'):
+            code = 0
+            for event in request({'op': "watch", 'id': args.job}, args.socket):
+                if 'event' not in event:
+                    print(event.get('error'), file=sys.stderr)
+                    return 2
+                print_event(event)
+                if event['event'] == "finished":
+                    code = event['record'].get('exit_code', 1)
+            return code
+        for reply in request({'op': "jobs"}, args.socket):
+            for job in reply['jobs']:
+                record = job['record'] or {}
+                print(f"{job['id']:>4}  {job['state']:<8} {job['spec'].get('model', '?'):<4} "
+                      f"{record.get('variant') or '-':<6} {record.get('error') or ''}")
+        return 0
+    except OSError as e:
+        print(f"Cannot reach the daemon on {args.socket}: {e}", file=sys.stderr)
+        return 3
+    except KeyboardInterrupt:
+        return 130
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
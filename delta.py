@@ -0,0 +1,315 @@
+"""Binary deltas between two versions of a firmware file (zip, bundle, MSE).
+
+rsync-style: the old file is cut into fixed-size blocks, each indexed by a
+weak rolling checksum and a strong hash. The new file is scanned byte by
+byte with the rolling checksum; wherever a window matches an old block the
+patch says "copy old blocks i..j", everything else goes in as literal
+bytes. Revised firmware archives share most of their bytes with the old
+ones, so a patch is a few kilobytes instead of the whole archive.
+
+Layout:
+    magic   b'LUBDLT1\\0'
+    u32     length of the JSON header that follows
+    header  {"block_size", "source": {"sha256", "size"}, "target": {"sha256", "size"}}
+    ops     zlib stream of  b'C' u32 first block, u32 block count
+                        or  b'L' u32 length, <length> literal bytes
+
+A patch only applies to the exact source it was made from, and the
+rebuilt file must hash to the target SHA-256 before it replaces anything.
+
+Published patches are listed next to the file they rebuild, in
+<file>.deltas.json (see downloader.update()):
+
+    {"sha256": <target>, "size": <target size>,
+     "patches": [{"from": <source sha256>, "url": <patch, relative to the file>, "sha256", "size"}]}
+
+    python3 delta.py make old.zip new.zip [outdir]    # writes the patch and updates the index
+    python3 delta.py apply old.zip patch.lubdelta new.zip
+    python3 delta.py info patch.lubdelta
+"""
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import paths
+
+MAGIC = b'LUBDLT1\0'
+BLOCK_SIZE = 2048
+INDEX_SUFFIX = ".deltas.json"
+PATCH_SUFFIX = ".lubdelta"
+CHUNK_SIZE = 1 << 20
+COPY = struct.Struct('<cLL')
+LITERAL = struct.Struct('<cL')
+
+class DeltaError(Exception):
+    pass
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def weak_sum(block):
+    """rsync's rolling checksum of a whole block: (a, b), both mod 2**16."""
+    # sum over k of (len - k) * x[k] is the sum of the running prefix sums
+    return sum(block) & 0xffff, sum(itertools.accumulate(block)) & 0xffff
+
+def strong_sum(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def signature(source, block_size):
+    """{weak: {strong: block index}} for every full block of `source`."""
+    table = {}
+    for index in range(len(source) // block_size):
+        block = source[index * block_size:(index + 1) * block_size]
+        a, b = weak_sum(block)
+        table.setdefault(a | b << 16, {}).setdefault(strong_sum(block), index)
+    return table
+
+class _OpWriter:
+    """Merges consecutive block copies and literal runs, then zlib-compresses."""
+
+    def __init__(self, out):
+        self.out = out
+        self.zip = zlib.compressobj(9)
+        self.run = None        # [first block, count]
+        self.literal = bytearray()
+        self.copied = self.literal_bytes = 0
+
+    def copy(self, index):
+        self._flush_literal()
+        if self.run and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+        else:
+            self._flush_copy()
+            self.run = [index, 1]
+        self.copied += 1
+
+    def add_literal(self, data):
+        if data:
+            self._flush_copy()
+            self.literal += data
+            self.literal_bytes += len(data)
+
+    def _flush_copy(self):
+        if self.run:
+            self.out.write(self.zip.compress(COPY.pack(b'C', *self.run)))
+            self.run = None
+
+    def _flush_literal(self):
+        if self.literal:
+            self.out.write(self.zip.compress(LITERAL.pack(b'L', len(self.literal))))
+            self.out.write(self.zip.compress(bytes(self.literal)))
+            self.literal = bytearray()
+
+    def close(self):
+        self._flush_copy()
+        self._flush_literal()
+        self.out.write(self.zip.flush())
+
+def generate(source_path, target_path, patch_path, block_size=BLOCK_SIZE):
+    """Write a patch turning `source_path` into `target_path`. Returns its header
+    plus 'copied' (blocks reused) and 'literal' (new bytes carried in the patch)."""
+    source, target = _read_bytes(source_path), _read_bytes(target_path)
+    header = {'block_size': block_size,
+              'source': {'sha256': hashlib.sha256(source).hexdigest(), 'size': len(source)},
+              'target': {'sha256': hashlib.sha256(target).hexdigest(), 'size': len(target)}}
+    table = signature(source, block_size)
+    encoded = json.dumps(header, sort_keys=True).encode()
+
+    tmp = patch_path + ".part"
+    with open(tmp, 'wb') as out:
+        out.write(MAGIC + struct.pack('<L', len(encoded)) + encoded)
+        ops = _OpWriter(out)
+        end = len(target)
+        pos = literal_start = 0
+        expected = None   # block after the last copy: unchanged stretches match it directly
+        a = b = None
+        while pos + block_size <= end:
+            window = target[pos:pos + block_size]
+            index = None
+            if expected is not None and source[expected * block_size:(expected + 1) * block_size] == window:
+                index = expected
+            else:
+                if a is None:
+                    a, b = weak_sum(window)
+                candidates = table.get(a | b << 16)
+                if candidates:
+                    index = candidates.get(strong_sum(window))
+            if index is not None:
+                ops.add_literal(target[literal_start:pos])
+                ops.copy(index)
+                pos = literal_start = pos + block_size
+                expected = index + 1
+                a = None
+                continue
+            # Roll the window one byte on
+            if pos + block_size < end:
+                if a is None:
+                    a, b = weak_sum(window)
+                out_byte, in_byte = target[pos], target[pos + block_size]
+                a = (a - out_byte + in_byte) & 0xffff
+                b = (b - block_size * out_byte + a) & 0xffff
+            pos += 1
+            expected = None
+        ops.add_literal(target[literal_start:])
+        ops.close()
+    os.replace(tmp, patch_path)
+    return dict(header, copied=ops.copied, literal=ops.literal_bytes)
+
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise DeltaError(f"{getattr(f, 'name', 'patch')}: not a delta patch")
+    try:
+        (length,) = struct.unpack('<L', f.read(4))
+        return json.loads(f.read(length))
+    except (struct.error, ValueError):
+        raise DeltaError(f"{getattr(f, 'name', 'patch')}: corrupt patch header")
+
+def info(patch_path):
+    with open(patch_path, 'rb') as f:
+        return read_header(f)
+
+class _OpReader:
+    """Decompresses the op stream as it is consumed."""
+
+    def __init__(self, f):
+        self.f = f
+        self.unzip = zlib.decompressobj()
+        self.buf = bytearray()
+
+    def read(self, n):
+        while len(self.buf) < n and not self.unzip.eof:
+            chunk = self.f.read(CHUNK_SIZE)
+            try:
+                self.buf += self.unzip.decompress(chunk) if chunk else self.unzip.flush()
+            except zlib.error as e:
+                raise DeltaError(f"corrupt patch data: {e}")
+            if not chunk:
+                break
+        if len(self.buf) < n:
+            raise DeltaError("patch data ends early")
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def ops(self):
+        while True:
+            try:
+                kind = self.read(1)
+            except DeltaError:
+                if self.buf or not self.unzip.eof:
+                    raise
+                return
+            if kind == b'C':
+                yield COPY.unpack(kind + self.read(COPY.size - 1))
+            elif kind == b'L':
+                (_, length) = LITERAL.unpack(kind + self.read(LITERAL.size - 1))
+                yield kind, self.read(length), None
+            else:
+                raise DeltaError(f"unknown patch op {kind!r}")
+
+def apply(source_path, patch_path, out_path):
+    """Rebuild the patch's target from `source_path` into `out_path`. Returns the header.
+
+    Raises DeltaError if the source isn't the one the patch was made from
+    or the result doesn't hash to the target; `out_path` is left untouched then.
+    """
+    with open(patch_path, 'rb') as patch:
+        header = read_header(patch)
+        block_size, source_info, target_info = header['block_size'], header['source'], header['target']
+        if (os.path.getsize(source_path) != source_info['size']
+                or file_sha256(source_path) != source_info['sha256']):
+            raise DeltaError(f"{os.path.basename(patch_path)} was made from a different file "
+                             f"than {os.path.basename(source_path)}")
+        tmp = out_path + ".part"
+        hasher = hashlib.sha256()
+        written = 0
+        with open(source_path, 'rb') as src_file, open(tmp, 'wb') as out:
+            source = mmap.mmap(src_file.fileno(), 0, access=mmap.ACCESS_READ) if source_info['size'] else b''
+            try:
+                for kind, first, count in _OpReader(patch).ops():
+                    if kind == b'C':
+                        start = first * block_size
+                        if start + count * block_size > source_info['size']:
+                            raise DeltaError(f"patch copies blocks {first}+{count} past the end of the source")
+                        data = source[start:start + count * block_size]
+                    else:
+                        data = first
+                    out.write(data)
+                    hasher.update(data)
+                    written += len(data)
+            except DeltaError:
+                out.close()
+                os.remove(tmp)
+                raise
+            finally:
+                if source_info['size']:
+                    source.close()
+    if written != target_info['size'] or hasher.hexdigest() != target_info['sha256']:
+        os.remove(tmp)
+        raise DeltaError(f"rebuilt file doesn't match the patch target ({written} bytes, SHA-256 {hasher.hexdigest()[:16]})")
+    os.replace(tmp, out_path)
+    return header
+
+def publish(source_path, target_path, out_dir, block_size=BLOCK_SIZE):
+    """Make a patch from `source_path` to `target_path` in `out_dir` and list it in
+    <target name>.deltas.json there. Returns (patch path, stats)."""
+    name = os.path.basename(target_path)
+    tmp = os.path.join(out_dir, f".{name}{PATCH_SUFFIX}.tmp")
+    stats = generate(source_path, target_path, tmp, block_size)
+    patch_name = f"{name}.from-{stats['source']['sha256'][:12]}{PATCH_SUFFIX}"
+    patch_path = os.path.join(out_dir, patch_name)
+    os.replace(tmp, patch_path)
+
+    index_path = os.path.join(out_dir, name + INDEX_SUFFIX)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    if index.get('sha256') != stats['target']['sha256']:
+        # A new target: patches to the previous one are useless now
+        index = {'sha256': stats['target']['sha256'], 'size': stats['target']['size'], 'patches': []}
+    index['patches'] = [p for p in index['patches'] if p['from'] != stats['source']['sha256']]
+    index['patches'].append({'from': stats['source']['sha256'], 'url': patch_name,
+                             'sha256': file_sha256(patch_path), 'size': os.path.getsize(patch_path)})
+    paths.atomic_write(index_path, json.dumps(index, indent=1, sort_keys=True))
+    return patch_path, stats
+
+def main(argv):
+    if len(argv) in (3, 4) and argv[0] == 'make':
+        out_dir = argv[3] if len(argv) == 4 else os.path.dirname(os.path.abspath(argv[2]))
+        patch_path, stats = publish(argv[1], argv[2], out_dir)
+        print(f"{patch_path}: {os.path.getsize(patch_path)} bytes for a {stats['target']['size']} byte file "
+              f"({stats['copied']} blocks reused, {stats['literal']} new bytes)")
+        return 0
+    if len(argv) == 4 and argv[0] == 'apply':
+        try:
+            header = apply(argv[1], argv[2], argv[3])
+        except DeltaError as e:
+            print(f"error: {e}")
+            return 1
+        print(f"{argv[3]}: {header['target']['size']} bytes, SHA-256 {header['target']['sha256']}")
+        return 0
+    if len(argv) == 2 and argv[0] == 'info':
+        print(json.dumps(info(argv[1]), indent=1, sort_keys=True))
+        return 0
+    print("Usage: delta.py make <old> <new> [outdir]")
+    print("       delta.py apply <old> <patch> <out>")
+    print("       delta.py info <patch>")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
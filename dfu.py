@@ -0,0 +1,343 @@
+"""In-process USB DFU 1.1 download engine.
+
+Speaks the DFU class requests directly over a pluggable backend instead of
+spawning dfu-util for every stage. The payload is sent as memoryview slices
+of the loaded image, so no per-block copies are made, and every block
+reports progress and timing through a callback.
+
+Backends:
+  PyUsbBackend    - libusb through pyusb, one shared libusb context (optional)
+  SimulatedDevice - in-memory DFU state machine for running without hardware
+"""
+import os
+import struct
+import threading
+import time
+
+# ---- DFU 1.1 constants ----
+DFU_DETACH, DFU_DNLOAD, DFU_UPLOAD, DFU_GETSTATUS, DFU_CLRSTATUS, DFU_GETSTATE, DFU_ABORT = range(7)
+REQ_OUT = 0x21  # host-to-device | class | interface
+REQ_IN = 0xA1   # device-to-host | class | interface
+
+STATE_APP_IDLE = 0
+STATE_APP_DETACH = 1
+STATE_IDLE = 2
+STATE_DNLOAD_SYNC = 3
+STATE_DNBUSY = 4
+STATE_DNLOAD_IDLE = 5
+STATE_MANIFEST_SYNC = 6
+STATE_MANIFEST = 7
+STATE_MANIFEST_WAIT_RESET = 8
+STATE_UPLOAD_IDLE = 9
+STATE_ERROR = 10
+
+STATUS_OK = 0x00
+STATUS_NAMES = {
+    0x00: "OK", 0x01: "errTARGET", 0x02: "errFILE", 0x03: "errWRITE", 0x04: "errERASE",
+    0x05: "errCHECK_ERASED", 0x06: "errPROG", 0x07: "errVERIFY", 0x08: "errADDRESS",
+    0x09: "errNOTDONE", 0x0A: "errFIRMWARE", 0x0B: "errVENDOR", 0x0C: "errUSBR",
+    0x0D: "errPOR", 0x0E: "errUNKNOWN", 0x0F: "errSTALLEDPKT",
+}
+
+DFU_SUFFIX_LEN = 16
+# Only used when the device has no DFU functional descriptor
+DEFAULT_BLOCK_SIZE = 2048
+DFU_FUNCTIONAL = 0x21
+DFU_INTERFACE = (0xFE, 0x01)   # application specific class, DFU subclass
+CONTROL_TIMEOUT = 5000  # ms
+# Safety net so a device that never leaves dfuDNBUSY can't hang a session
+MAX_STATUS_POLLS = 10000
+
+class DfuError(Exception):
+    pass
+
+class DeviceGone(DfuError):
+    """The device dropped off the bus (what dfu-util reports as LIBUSB_ERROR_NO_DEVICE)."""
+
+def strip_suffix(data):
+    """Return the payload of a .dfu image (without its DFU suffix) as a memoryview."""
+    view = memoryview(data)
+    if len(view) >= DFU_SUFFIX_LEN and bytes(view[-8:-5]) == b'UFD':
+        return view[:len(view) - view[-5]]
+    return view
+
+def load_image(path):
+    """Read a .dfu file once and return its payload view (no further copies)."""
+    with open(path, 'rb') as f:
+        return strip_suffix(f.read())
+
+def parse_functional(extra):
+    """wTransferSize from the DFU functional descriptor among `extra`
+    descriptor bytes, or None if there isn't one."""
+    data = bytes(extra or b'')
+    pos = 0
+    while pos + 2 <= len(data) and data[pos] >= 2:
+        length, kind = data[pos], data[pos + 1]
+        if kind == DFU_FUNCTIONAL and length >= 7 and pos + 7 <= len(data):
+            # bmAttributes, wDetachTimeOut, wTransferSize
+            return struct.unpack('<H', data[pos + 5:pos + 7])[0] or None
+        pos += length
+    return None
+
+def parse_status(data):
+    """GETSTATUS reply -> (bStatus, bwPollTimeout in ms, bState)."""
+    status, poll_lo, poll_hi, state = struct.unpack('<BHBB', bytes(data[:5]))
+    return status, poll_lo | (poll_hi << 16), state
+
+# ---- Backends ----
+class PyUsbBackend:
+    """libusb backend via pyusb. One libusb context is shared by every transfer."""
+
+    def __init__(self, libusb_path=None):
+        import usb.backend.libusb1
+        import usb.core
+        self.usb = usb
+        finder = (lambda _name: libusb_path) if libusb_path else None
+        self.backend = usb.backend.libusb1.get_backend(find_library=finder)
+        if self.backend is None:
+            raise DfuError("libusb-1.0 not found")
+
+    def open(self, vid_pid, path=None):
+        vid, pid = (int(part, 16) for part in vid_pid.split(':'))
+        for device in self.usb.core.find(find_all=True, idVendor=vid, idProduct=pid, backend=self.backend):
+            if path is None or port_path(device) == path:
+                return device
+        raise DeviceGone(f"DFU device {vid_pid} not found" + (f" on port {path}" if path else ""))
+
+    def control_out(self, device, request, value, data, timeout=CONTROL_TIMEOUT):
+        try:
+            return device.ctrl_transfer(REQ_OUT, request, value, 0, data, timeout)
+        except self.usb.core.USBError as e:
+            raise self._translate(e)
+
+    def control_in(self, device, request, value, length, timeout=CONTROL_TIMEOUT):
+        try:
+            return device.ctrl_transfer(REQ_IN, request, value, 0, length, timeout)
+        except self.usb.core.USBError as e:
+            raise self._translate(e)
+
+    def transfer_size(self, device):
+        """wTransferSize of the DFU interface's functional descriptor, None if absent."""
+        try:
+            for config in device:
+                for interface in config:
+                    if (interface.bInterfaceClass, interface.bInterfaceSubClass) == DFU_INTERFACE:
+                        size = parse_functional(getattr(interface, 'extra_descriptors', None))
+                        if size:
+                            return size
+                size = parse_functional(getattr(config, 'extra_descriptors', None))
+                if size:
+                    return size
+        except self.usb.core.USBError as e:
+            raise self._translate(e)
+        return None
+
+    def close(self, device):
+        self.usb.util.dispose_resources(device)
+
+    def _translate(self, e):
+        # errno 19 / LIBUSB_ERROR_NO_DEVICE (-4): the device reset itself away
+        if getattr(e, 'backend_error_code', None) == -4 or getattr(e, 'errno', None) == 19:
+            return DeviceGone(str(e))
+        return DfuError(str(e))
+
+def port_path(device):
+    """dfu-util style "bus-port.port" path of a pyusb device."""
+    ports = getattr(device, 'port_numbers', None) or ()
+    return f"{device.bus}-" + ".".join(str(port) for port in ports)
+
+class SimulatedDevice:
+    """A DFU 1.1 device in memory: a backend and its own single device.
+
+    busy_polls/poll_timeout mimic a device that needs time to program each
+    block, fail_at_block injects errWRITE, and detach_on_manifest makes the
+    device vanish after manifestation like a real iPod booting the image.
+    transfer_size is the wTransferSize its functional descriptor reports
+    (None: no descriptor).
+    """
+
+    def __init__(self, vid_pid="05ac:1234", path="1-1", busy_polls=1, poll_timeout=0,
+                 fail_at_block=None, detach_on_manifest=True, max_block=4096, transfer_size=4096):
+        self.vid_pid = vid_pid
+        self.path = path
+        self.busy_polls = busy_polls
+        self.poll_timeout = poll_timeout
+        self.fail_at_block = fail_at_block
+        self.detach_on_manifest = detach_on_manifest
+        self.max_block = max_block
+        self.descriptor = (struct.pack('<BBBHHH', 9, DFU_FUNCTIONAL, 0x0B, 0xFF, transfer_size, 0x0110)
+                           if transfer_size else b'')
+        self.state = STATE_IDLE
+        self.status = STATUS_OK
+        self.received = bytearray()
+        self.blocks = 0
+        self.pending_polls = 0
+        self.manifested = False
+        self.opens = 0
+        self.gone = False
+
+    def open(self, vid_pid, path=None):
+        if self.gone or vid_pid.lower() != self.vid_pid or (path and path != self.path):
+            raise DeviceGone(f"DFU device {vid_pid} not found")
+        self.opens += 1
+        return self
+
+    def transfer_size(self, device):
+        return parse_functional(self.descriptor)
+
+    def close(self, device):
+        pass
+
+    def _error(self, status):
+        self.state = STATE_ERROR
+        self.status = status
+
+    def control_out(self, device, request, value, data, timeout=CONTROL_TIMEOUT):
+        if self.gone:
+            raise DeviceGone("device disconnected")
+        if request == DFU_DNLOAD:
+            if self.state not in (STATE_IDLE, STATE_DNLOAD_IDLE):
+                self._error(0x0F)
+                raise DfuError("DNLOAD in wrong state (stall)")
+            if len(data) == 0:
+                self.state = STATE_MANIFEST_SYNC
+                return 0
+            if len(data) > self.max_block or value != self.blocks:
+                self._error(0x0F)
+                raise DfuError("bad DNLOAD block (stall)")
+            if self.fail_at_block is not None and value == self.fail_at_block:
+                self._error(0x03)
+                return len(data)
+            self.received += data
+            self.blocks += 1
+            self.pending_polls = self.busy_polls
+            self.state = STATE_DNLOAD_SYNC
+            return len(data)
+        if request == DFU_CLRSTATUS:
+            self.state, self.status = STATE_IDLE, STATUS_OK
+            return 0
+        if request == DFU_ABORT:
+            self.state = STATE_IDLE
+            return 0
+        raise DfuError(f"unsupported request {request}")
+
+    def control_in(self, device, request, value, length, timeout=CONTROL_TIMEOUT):
+        if self.gone:
+            raise DeviceGone("device disconnected")
+        if request == DFU_GETSTATE:
+            return bytes([self.state])
+        if request != DFU_GETSTATUS:
+            raise DfuError(f"unsupported request {request}")
+        if self.state in (STATE_DNLOAD_SYNC, STATE_DNBUSY):
+            if self.pending_polls > 0:
+                self.pending_polls -= 1
+                self.state = STATE_DNBUSY
+            else:
+                self.state = STATE_DNLOAD_IDLE
+        elif self.state == STATE_MANIFEST_SYNC:
+            self.state = STATE_MANIFEST
+        elif self.state == STATE_MANIFEST:
+            self.manifested = True
+            if self.detach_on_manifest:
+                self.gone = True
+                raise DeviceGone("device reset after manifestation")
+            self.state = STATE_MANIFEST_WAIT_RESET
+        poll = self.poll_timeout
+        return struct.pack('<BHBB', self.status, poll & 0xFFFF, poll >> 16, self.state) + b'\0'
+
+# ---- Engine ----
+class DfuEngine:
+    """Downloads images to DFU devices over one long-lived backend."""
+
+    def __init__(self, backend, block_size=None, sleep=time.sleep):
+        # block_size None: the device's wTransferSize, else DEFAULT_BLOCK_SIZE
+        self.backend = backend
+        self.block_size = block_size
+        self.sleep = sleep
+
+    def get_status(self, device):
+        return parse_status(self.backend.control_in(device, DFU_GETSTATUS, 0, 6))
+
+    def _wait_idle(self, device, wanted):
+        for _ in range(MAX_STATUS_POLLS):
+            status, poll_timeout, state = self.get_status(device)
+            if status != STATUS_OK or state == STATE_ERROR:
+                raise DfuError(f"device reported {STATUS_NAMES.get(status, hex(status))} in state {state}")
+            if state in wanted:
+                return state
+            self.sleep(poll_timeout / 1000.0)
+        raise DfuError("device stayed busy")
+
+    def _reset_to_idle(self, device):
+        status, _, state = self.get_status(device)
+        if state == STATE_ERROR:
+            self.backend.control_out(device, DFU_CLRSTATUS, 0, b'')
+        elif state != STATE_IDLE:
+            self.backend.control_out(device, DFU_ABORT, 0, b'')
+        status, _, state = self.get_status(device)
+        if state != STATE_IDLE:
+            raise DfuError(f"device not idle (state {state})")
+
+    def download(self, vid_pid, payload, path=None, block_size=None, progress=None):
+        """Send `payload` (bytes/memoryview) and manifest it.
+
+        progress(sent, total, block_seconds) is called after every block.
+        Returns a stats dict; a device that resets away during manifestation
+        counts as success, same as "Download done." from dfu-util.
+        """
+        view = payload if isinstance(payload, memoryview) else memoryview(payload)
+        total = len(view)
+        stats = {'bytes': 0, 'blocks': 0, 'block_times': [], 'manifest': 'done'}
+        device = self.backend.open(vid_pid, path)
+        started = time.monotonic()
+        try:
+            block_size = (block_size or self.block_size or self.backend.transfer_size(device)
+                          or DEFAULT_BLOCK_SIZE)
+            stats['block_size'] = block_size
+            self._reset_to_idle(device)
+            block = 0
+            for offset in range(0, total, block_size):
+                chunk = view[offset:offset + block_size]
+                block_started = time.monotonic()
+                self.backend.control_out(device, DFU_DNLOAD, block & 0xFFFF, chunk)
+                self._wait_idle(device, (STATE_DNLOAD_IDLE,))
+                elapsed = time.monotonic() - block_started
+                block += 1
+                stats['bytes'] += len(chunk)
+                stats['blocks'] = block
+                stats['block_times'].append(elapsed)
+                if progress:
+                    progress(stats['bytes'], total, elapsed)
+
+            self.backend.control_out(device, DFU_DNLOAD, block & 0xFFFF, b'')
+            try:
+                self._wait_idle(device, (STATE_IDLE, STATE_MANIFEST_WAIT_RESET))
+            except DeviceGone:
+                stats['manifest'] = 'device reset'
+        finally:
+            stats['seconds'] = time.monotonic() - started
+            try:
+                self.backend.close(device)
+            except Exception:
+                pass
+        return stats
+
+    def download_file(self, vid_pid, file, **kwargs):
+        return self.download(vid_pid, load_image(file), **kwargs)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def native_engine(libusb_path=None):
+    """Shared engine over pyusb, or None when pyusb/libusb aren't usable here."""
+    global _engine
+    if os.environ.get('LEUNBRICK_DFU') == 'dfu-util':
+        return None
+    # Daemon jobs and Station sessions ask from several threads at once
+    with _engine_lock:
+        if _engine is None:
+            try:
+                _engine = DfuEngine(PyUsbBackend(libusb_path))
+            except (ImportError, DfuError):
+                _engine = False
+    return _engine or None
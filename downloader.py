@@ -0,0 +1,250 @@
+"""Streaming, resumable firmware downloads backed by a SHA-256 keyed cache.
+
+Every archive is streamed straight to a .part file in chunks while its
+SHA-256 is computed, interrupted transfers continue with an HTTP Range
+request, and the finished file is stored under its digest. Repeat runs (or
+several benches pointing LEUNBRICK_CACHE at the same share) get cache hits
+instead of downloading the same bytes again. update() brings a cached
+file up to a revised version through a published binary delta (delta.py)
+when one starts from a version already in the cache.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import delta
+import metrics
+import paths
+
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 30
+
+class DownloadError(Exception):
+    pass
+
+class FirmwareCache:
+    """Content-addressed blob store plus a small url -> digest index."""
+
+    def __init__(self, root=paths.CACHE_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(os.path.join(root, "sha256"), exist_ok=True)
+        os.makedirs(os.path.join(root, "partial"), exist_ok=True)
+
+    def path_for(self, digest):
+        return os.path.join(self.root, "sha256", digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def entry(self, url):
+        """Index entry ({'sha256', 'size', 'etag'}) of `url`, if that blob is still present."""
+        with self.lock:
+            entry = self._load_index().get(url)
+        if entry and self.has(entry['sha256']):
+            return entry
+        return None
+
+    def lookup(self, url):
+        """Digest of the cached copy of `url`, if that blob is still present."""
+        entry = self.entry(url)
+        return entry['sha256'] if entry else None
+
+    def remember(self, url, digest, size, etag=None):
+        with self.lock:
+            index = self._load_index()
+            index[url] = {'sha256': digest, 'size': size, 'etag': etag}
+            paths.atomic_write(self.index_path, json.dumps(index, indent=1, sort_keys=True))
+
+    def partial_path(self, url):
+        return os.path.join(self.root, "partial", hashlib.sha256(url.encode()).hexdigest() + ".part")
+
+    def store(self, part_path, digest):
+        """Move a verified .part file into the store and return its final path."""
+        final_path = self.path_for(digest)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(part_path, final_path)
+        return final_path
+
+def make_session(pool_size=8):
+    """requests.Session that keeps up to pool_size connections per host open,
+    so that many threads (fetch_all(), the firmware-prep pool) can share it."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def fetch_all(urls, cache, session=None, max_workers=4, progress=None, hashes=None):
+    """Start fetching several urls concurrently over one pooled session.
+
+    Returns {url: Future} right away; each future resolves to fetch()'s
+    (path, digest, cache_hit) or raises what fetch() raised, so callers can
+    wait for just the url they need.
+    """
+    hashes = hashes or {}
+    session = session or make_session(max_workers)
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+    futures = {url: pool.submit(fetch, url, cache, session, hashes.get(url), progress)
+               for url in urls}
+    # Queued fetches still run; the workers exit once they are done
+    pool.shutdown(wait=False)
+    return futures
+
+def _hash_existing(path, hasher):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+def _cached(url, cache, sha256, refresh):
+    """(path, digest, True) when `url` (or the blob `sha256`) is already in the cache."""
+    if sha256 and cache.has(sha256):
+        return cache.path_for(sha256), sha256, True
+    digest = None if refresh else cache.lookup(url)
+    if digest and (sha256 is None or digest == sha256):
+        return cache.path_for(digest), digest, True
+    return None
+
+def fetch(url, cache, session=None, sha256=None, progress=None, refresh=False):
+    """Download `url` into the cache and return (path, digest, cache_hit).
+
+    `sha256` is the expected digest when it is known up front; a matching blob
+    already in the cache is returned without touching the network, and a
+    mismatching download raises DownloadError. `refresh` downloads again
+    even if `url` was fetched before.
+
+    The partial file of a url is shared by every process using the cache
+    (agents on one bench), so only one of them downloads it at a time; the
+    others then find it in the cache.
+    """
+    hit = _cached(url, cache, sha256, refresh)
+    if hit:
+        return hit
+    part_path = cache.partial_path(url)
+    with paths.file_lock(part_path):
+        # Whoever held the lock may just have fetched it
+        hit = _cached(url, cache, sha256, refresh)
+        return hit or _download(url, cache, session or make_session(1), sha256, progress, part_path)
+
+def _download(url, cache, session, sha256, progress, part_path):
+    etag_path = part_path + ".etag"
+    hasher = hashlib.sha256()
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    headers = {}
+    if offset:
+        headers['Range'] = f"bytes={offset}-"
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                headers['If-Range'] = f.read().strip()
+
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            # Our partial is at least as long as the file; start over
+            os.remove(part_path)
+            return _download(url, cache, session, sha256, progress, part_path)
+        response.raise_for_status()
+        if response.status_code == 206:
+            _hash_existing(part_path, hasher)
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+        etag = response.headers.get('ETag')
+        if etag:
+            with open(etag_path, 'w') as f:
+                f.write(etag)
+        length = response.headers.get('Content-Length')
+        total = offset + int(length) if length else None
+
+        done = offset
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                hasher.update(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(url, done, total)
+
+    metrics.METRICS.download("delta" if url.endswith(delta.PATCH_SUFFIX) else "full", done - offset)
+    if total is not None and done != total:
+        raise DownloadError(f"{url}: transfer ended at {done} of {total} bytes")
+    digest = hasher.hexdigest()
+    if sha256 and digest != sha256:
+        os.remove(part_path)
+        raise DownloadError(f"{url}: SHA-256 mismatch (got {digest}, expected {sha256})")
+    path = cache.store(part_path, digest)
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    cache.remember(url, digest, done, etag)
+    return path, digest, False
+
+def _delta_index(url, session):
+    """The <url>.deltas.json published next to `url`, or None if there is none."""
+    try:
+        response = session.get(url + delta.INDEX_SUFFIX, timeout=TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        index = response.json()
+        return index if index.get('sha256') else None
+    except ValueError:
+        return None
+
+def update(url, cache, session=None, progress=None):
+    """Bring the cached copy of `url` up to the published version.
+
+    Returns (path, digest, how), how being "current" (nothing to fetch),
+    "delta" (rebuilt from a cached older version plus a patch) or "full".
+    Without a <url>.deltas.json the ETag decides whether to download again.
+    """
+    session = session or make_session(1)
+    entry = cache.entry(url)
+    index = _delta_index(url, session)
+    if index is None:
+        if entry and entry.get('etag'):
+            head = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+            if head.ok and head.headers.get('ETag') == entry['etag']:
+                return cache.path_for(entry['sha256']), entry['sha256'], "current"
+        path, digest, _ = fetch(url, cache, session, progress=progress, refresh=True)
+        return path, digest, "current" if entry and entry['sha256'] == digest else "full"
+
+    target = index['sha256']
+    if cache.has(target):
+        if not entry or entry['sha256'] != target:
+            cache.remember(url, target, index.get('size'))
+        return cache.path_for(target), target, "current"
+    for patch in index.get('patches', []):
+        if not cache.has(patch['from']):
+            continue
+        try:
+            patch_path, _, _ = fetch(urljoin(url, patch['url']), cache, session, sha256=patch.get('sha256'))
+            part = cache.partial_path(url + "#delta")
+            with paths.file_lock(part):
+                header = delta.apply(cache.path_for(patch['from']), patch_path, part)
+        except (requests.RequestException, OSError, DownloadError, delta.DeltaError):
+            # Any broken patch just means downloading the whole file
+            continue
+        # apply() verified the result against the patch's own target
+        if header['target']['sha256'] != target:
+            os.remove(part)
+            continue
+        path = cache.store(part, target)
+        cache.remember(url, target, os.path.getsize(path))
+        return path, target, "delta"
+    path, digest, _ = fetch(url, cache, session, sha256=target, progress=progress)
+    return path, digest, "full"
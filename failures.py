@@ -0,0 +1,166 @@
+"""What went wrong in a flash stage, and whether trying again can help.
+
+classify() maps the output of dfu-util, the native DFU engine, ipodscsi or
+the SG_IO writer (and the exit code, where there is one) to a failure
+class. Retryable classes are the ones a busy hub produces all the time -
+a stalled pipe, a USB timeout, a driver that wdi-simple hasn't finished
+binding - and cost a short backoff and another attempt at the same stage.
+Fatal ones (wrong image, missing tool) stop at once: repeating can't fix
+them.
+
+    failure = classify("dfu-util: Error during download (LIBUSB_ERROR_PIPE)", 74)
+    failure.name, failure.retryable, failure.retries, failure.backoff
+    # ('usb_pipe', True, 3, 0.5)
+
+COUNTS keeps per-class counters for the whole process: how often a class
+was seen, retried, recovered from (a later attempt succeeded) and given
+up on.
+"""
+import re
+import threading
+from collections import namedtuple
+
+# retries: attempts after the first; backoff: seconds before the first retry, doubling after
+FailureClass = namedtuple('FailureClass', 'name retryable retries backoff')
+
+# First match wins, so the specific libusb errors come before the generic
+# "Error during download" that dfu-util wraps them in
+CLASSES = [(FailureClass(name, retryable, retries, backoff), [re.compile(p, re.I) for p in patterns])
+           for name, retryable, retries, backoff, patterns in (
+    # Never worth repeating (before bad_image: "cannot run: ... No such file")
+    ("tool_missing", False, 0, 0, (
+        r"^cannot run:|aborted: cannot run:",
+        r"ipodscsi not found",
+        r"libusb-1\.0 not found|unable to initialize libusb",
+        r"is not a SCSI-generic device",
+        r"Not enough arguments|Unknown command|Unknown option|No MSE file name",
+    )),
+    ("bad_image", False, 0, 0, (
+        r"does not match device",
+        r"not a valid DFU (file|suffix)|DFU suffix",
+        r"MSE file size must be a multiple",
+        r"Error (reading from|while opening|while getting) MSE file",
+        r"error opening given file name",
+        r"readback does not match",
+        r"No such file",
+    )),
+    # wdi-simple returned but Windows hasn't bound libusbK yet, or another
+    # process still holds the interface
+    ("driver_not_bound", True, 3, 2.0, (
+        r"Cannot open (DFU )?device",
+        r"Cannot claim interface",
+        r"Cannot set alternate interface",
+        r"LIBUSB_ERROR_(ACCESS|NOT_SUPPORTED|NOT_FOUND)",
+        r"Access denied|Operation not supported|Entity not found",
+    )),
+    ("usb_busy", True, 3, 1.0, (
+        r"LIBUSB_ERROR_BUSY",
+        r"Resource busy",
+        r"device stayed busy",
+    )),
+    ("usb_pipe", True, 3, 0.5, (
+        r"LIBUSB_ERROR_PIPE",
+        r"Pipe error",
+        r"\(stall\)",
+        r"Status is not OK",
+    )),
+    ("usb_timeout", True, 2, 1.0, (
+        r"LIBUSB_ERROR_TIMEOUT",
+        r"timed out",
+        r"aborted: (stalled|timeout)",
+    )),
+    ("usb_io", True, 3, 0.5, (
+        r"LIBUSB_ERROR_(IO|OVERFLOW|INTERRUPTED|OTHER)",
+        r"Input/Output Error|Overflow|Interrupted",
+        r"USB communication error",
+        r"Error during download",
+    )),
+    # Only retried while the iPod is back in the mode the stage expects
+    ("device_gone", True, 2, 1.0, (
+        r"No DFU capable USB device available",
+        r"LIBUSB_ERROR_NO_DEVICE|No such device",
+        r"device disconnected|not found on port|DFU device \S+ not found",
+        r"could not open /dev/",
+        r"device rebooted",
+    )),
+    # SCSI sense keys 2 (not ready), 6 (unit attention), b (aborted command)
+    ("scsi_transient", True, 3, 1.0, (
+        r"sense 0?[26bB]/",
+        r"SG_IO ioctl error",
+    )),
+    # A write error on the iPod's flash usually clears on a rewrite
+    ("scsi_medium", True, 1, 1.0, (
+        r"sense 0?3/",
+    )),
+)]
+
+# Unrecognized output: one more go, as before classification existed
+UNKNOWN = FailureClass("unknown", True, 1, 1.0)
+
+def diagnose(text, returncode=None):
+    """(FailureClass, the line that decided it) for the output of a failed run.
+    Lines are read from the end, so the last error a tool printed wins."""
+    lines = [line.strip() for line in (text or "").splitlines() if line.strip()]
+    for line in reversed(lines):
+        for failure, patterns in CLASSES:
+            if any(pattern.search(line) for pattern in patterns):
+                return failure, line
+    last = lines[-1] if lines else "no output"
+    if returncode in (126, 127):
+        # The shell's "found but not executable" / "not found"
+        return by_name("tool_missing"), last
+    return UNKNOWN, last
+
+def classify(text, returncode=None):
+    return diagnose(text, returncode)[0]
+
+def of_stage(detail, extra):
+    """Stage classifier for pipeline.Stage(classify=...): the class a stage
+    already put in extra['failure_class'], else one read from its detail."""
+    if 'failure_class' in extra:
+        return by_name(extra['failure_class'])
+    return classify(detail)
+
+def by_name(name):
+    for failure, _ in CLASSES:
+        if failure.name == name:
+            return failure
+    return UNKNOWN
+
+class Counters:
+    """Thread-safe {class: {'seen', 'retried', 'recovered', 'gave_up'}}."""
+    FIELDS = ('seen', 'retried', 'recovered', 'gave_up')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, classes, recovered):
+        """Count one stage's failed attempts, in order. Every attempt but the
+        last failed one was retried; the last one was recovered from if the
+        stage got through in the end, else given up on."""
+        if not classes:
+            return
+        with self.lock:
+            for index, name in enumerate(classes):
+                counts = self.counts.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+                counts['seen'] += 1
+                if index < len(classes) - 1 or recovered:
+                    counts['retried'] += 1
+            self.counts[classes[-1]]['recovered' if recovered else 'gave_up'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(counts) for name, counts in self.counts.items()}
+
+    def summary(self):
+        """"usb_pipe 3 (3 recovered), driver_not_bound 1 (1 gave up)" or ""."""
+        parts = []
+        for name, counts in sorted(self.snapshot().items()):
+            outcome = f"{counts['recovered']} recovered" if counts['recovered'] else ""
+            if counts['gave_up']:
+                outcome += (", " if outcome else "") + f"{counts['gave_up']} gave up"
+            parts.append(f"{name} {counts['seen']}" + (f" ({outcome})" if outcome else ""))
+        return ", ".join(parts)
+
+COUNTS = Counters()
@@ -0,0 +1,158 @@
+"""Pre-flash validation of DFU images with an on-disk index.
+
+Each image is mapped with mmap and checked against the device it is going
+to be sent to:
+
+  * images with a standard DFU suffix: idVendor/idProduct/bcdDFU and dwCRC
+  * bare IMG1 images (what Apple ships and what misc/firmwares holds): the
+    chip magic in the header must match the target PID's SoC and the file
+    must be exactly as long as the header says (catches truncation)
+  * the ".x<pid>." tag in the file name must match the target PID
+
+Results are stored in misc/firmwares/.index.json keyed by path, size and
+mtime, and by SHA-256, so later runs don't need to hash or re-check
+unchanged files.
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+import paths
+
+INDEX_FILE = ".index.json"
+APPLE_VID = 0x05ac
+DFU_SUFFIX_LEN = 16
+
+# SoC magic in the IMG1 header -> PIDs that run images for that SoC
+IMG1_TARGETS = {
+    b'8723': {0x1232, 0x1248},           # nano 6G: DFU, WTF
+    b'8740': {0x1234, 0x1249, 0x124a},   # nano 7G: DFU, WTF 2012, WTF 2015
+}
+IMG1_HEADER_LEN = 0x400
+PID_IN_NAME_RE = re.compile(r'\.x([0-9a-fA-F]{4})\.')
+
+def dfu_crc(data):
+    """CRC the DFU suffix uses: CRC-32 without the final inversion."""
+    return zlib.crc32(data) ^ 0xFFFFFFFF
+
+def parse_suffix(view):
+    """Return the DFU suffix fields as a dict, or None if the image has none."""
+    if len(view) < DFU_SUFFIX_LEN or bytes(view[-8:-5]) != b'UFD':
+        return None
+    bcd_device, pid, vid, bcd_dfu, _, length, crc = struct.unpack('<4H3sBL', view[-16:])
+    return {'bcdDevice': bcd_device, 'idProduct': pid, 'idVendor': vid,
+            'bcdDFU': bcd_dfu, 'bLength': length, 'dwCRC': crc}
+
+def check_view(view, target_pid, name=""):
+    """Validate an image already in memory. Returns (ok, kind, reason)."""
+    match = PID_IN_NAME_RE.search(name)
+    if match and int(match.group(1), 16) != target_pid:
+        return False, "name", f"image is tagged for x{match.group(1)}, target is {target_pid:04x}"
+
+    suffix = parse_suffix(view)
+    if suffix:
+        if suffix['idVendor'] not in (APPLE_VID, 0xFFFF):
+            return False, "dfu", f"suffix idVendor {suffix['idVendor']:04x} is not Apple"
+        if suffix['idProduct'] not in (target_pid, 0xFFFF):
+            return False, "dfu", f"suffix idProduct {suffix['idProduct']:04x} != {target_pid:04x}"
+        if dfu_crc(view[:-4]) != suffix['dwCRC']:
+            return False, "dfu", "DFU suffix CRC mismatch (corrupted image)"
+        return True, "dfu", f"DFU {suffix['bcdDFU'] >> 8}.{suffix['bcdDFU'] & 0xFF} suffix OK"
+
+    if len(view) < IMG1_HEADER_LEN:
+        return False, "img1", f"only {len(view)} bytes, too short for an image"
+    magic = bytes(view[:4])
+    if magic not in IMG1_TARGETS:
+        return False, "img1", f"unknown image magic {magic!r}"
+    if target_pid not in IMG1_TARGETS[magic]:
+        return False, "img1", f"{magic.decode()} image does not run on PID {target_pid:04x}"
+    cert_offset, cert_len = struct.unpack('<2L', view[0x14:0x1c])
+    expected = IMG1_HEADER_LEN + cert_offset + cert_len
+    if len(view) != expected:
+        return False, "img1", f"size {len(view)} != {expected} from header (truncated or padded)"
+    return True, "img1", f"{magic.decode()} IMG1 OK"
+
+class FirmwareIndex:
+    """Validation cache for firmware images, persisted as JSON."""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, INDEX_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.files = data.get('files', {})
+        self.verdicts = data.get('verdicts', {})
+        self.dirty = False
+
+    def check(self, image, target_pid):
+        """Validate `image` for the device with `target_pid` ("05ac:1234" or int).
+
+        Returns a record dict with 'ok', 'reason', 'sha256' and 'cached'.
+        """
+        if isinstance(target_pid, str):
+            target_pid = int(target_pid.split(':')[-1], 16)
+        image = os.path.abspath(image)
+        try:
+            st = os.stat(image)
+        except OSError:
+            return {'ok': False, 'reason': "file is missing", 'sha256': None, 'cached': False}
+
+        key = f"{target_pid:04x}"
+        with self.lock:
+            known = self.files.get(image)
+            if known and known['size'] == st.st_size and known['mtime_ns'] == st.st_mtime_ns:
+                verdict = self.verdicts.get(known['sha256'], {}).get(key)
+                if verdict:
+                    return dict(verdict, sha256=known['sha256'], cached=True)
+
+        if st.st_size == 0:
+            return {'ok': False, 'reason': "file is empty", 'sha256': None, 'cached': False}
+        with open(image, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                digest = hashlib.sha256(view).hexdigest()
+                ok, kind, reason = check_view(view, target_pid, os.path.basename(image))
+            finally:
+                view.release()
+
+        verdict = {'ok': ok, 'kind': kind, 'reason': reason}
+        with self.lock:
+            self.files[image] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': digest}
+            self.verdicts.setdefault(digest, {})[key] = verdict
+            self.dirty = True
+        return dict(verdict, sha256=digest, cached=False)
+
+    def check_blob(self, view, sha256, target_pid, name=""):
+        """Validate an image that is already in memory (e.g. a bundle slice) by its known hash."""
+        if isinstance(target_pid, str):
+            target_pid = int(target_pid.split(':')[-1], 16)
+        key = f"{target_pid:04x}"
+        with self.lock:
+            verdict = self.verdicts.get(sha256, {}).get(key)
+        if verdict is None:
+            ok, kind, reason = check_view(view, target_pid, name)
+            verdict = {'ok': ok, 'kind': kind, 'reason': reason}
+            with self.lock:
+                self.verdicts.setdefault(sha256, {})[key] = verdict
+                self.dirty = True
+            return dict(verdict, sha256=sha256, cached=False)
+        return dict(verdict, sha256=sha256, cached=True)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                paths.atomic_write(self.path, json.dumps({'files': self.files, 'verdicts': self.verdicts},
+                                                         indent=1, sort_keys=True))
+                self.dirty = False
+            except OSError:
+                pass
@@ -0,0 +1,217 @@
+"""Pull a single member (Firmware.MSE) out of a remote IPSW with Range requests.
+
+An IPSW is a zip, so the end-of-central-directory record, the central
+directory and the one local header we need can each be fetched with a small
+Range request. Only the member's compressed bytes are downloaded after that,
+and they are inflated as they stream in.
+"""
+import hashlib
+import os
+import shutil
+import struct
+import zlib
+
+import downloader
+import metrics
+import paths
+
+EOCD_SIG = b'PK\x05\x06'
+ZIP64_LOCATOR_SIG = b'PK\x06\x07'
+ZIP64_EOCD_SIG = b'PK\x06\x06'
+CENTRAL_SIG = b'PK\x01\x02'
+LOCAL_SIG = b'PK\x03\x04'
+# EOCD (22 bytes) + the largest possible zip comment
+EOCD_SEARCH = 22 + 0xFFFF
+STORED, DEFLATED = 0, 8
+
+class IpswError(Exception):
+    pass
+
+class RemoteFile:
+    """Random access to an HTTP resource through Range requests."""
+
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session or downloader.make_session(1)
+        response = self.session.head(url, allow_redirects=True, timeout=downloader.TIMEOUT)
+        response.raise_for_status()
+        if response.headers.get('Accept-Ranges', 'bytes') != 'bytes':
+            raise IpswError(f"{url}: server does not support range requests")
+        self.url = response.url
+        self.etag = response.headers.get('ETag', '')
+        self.requested = 0
+        length = response.headers.get('Content-Length')
+        self.size = int(length) if length and length.isdigit() else self._probe_size()
+
+    def _probe_size(self):
+        """Total size from the Content-Range of a one-byte request, for servers
+        whose HEAD has no Content-Length (chunked transfer)."""
+        with self._get(0, 1) as response:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        if not total.isdigit():
+            raise IpswError(f"{self.url}: server reports no size (no Content-Length or Content-Range)")
+        return int(total)
+
+    def _get(self, start, end):
+        headers = {'Range': f"bytes={start}-{end - 1}"}
+        response = self.session.get(self.url, headers=headers, stream=True, timeout=downloader.TIMEOUT)
+        if response.status_code != 206:
+            response.close()
+            raise IpswError(f"{self.url}: expected 206 Partial Content, got {response.status_code}")
+        return response
+
+    def read(self, start, length):
+        with self._get(start, start + length) as response:
+            data = response.content
+        if len(data) != length:
+            raise IpswError(f"{self.url}: short read at {start} ({len(data)} of {length} bytes)")
+        self.requested += length
+        return data
+
+    def stream(self, start, length, chunk_size=downloader.CHUNK_SIZE):
+        with self._get(start, start + length) as response:
+            for chunk in response.iter_content(chunk_size):
+                self.requested += len(chunk)
+                yield chunk
+
+def _find_central_directory(remote):
+    tail_len = min(remote.size, EOCD_SEARCH)
+    tail_start = remote.size - tail_len
+    tail = remote.read(tail_start, tail_len)
+    pos = tail.rfind(EOCD_SIG)
+    if pos < 0:
+        raise IpswError("not a zip file (no end of central directory record)")
+    _, _, _, _, count, cd_size, cd_offset, _ = struct.unpack('<4s4H2LH', tail[pos:pos + 22])
+    if cd_offset == 0xFFFFFFFF or cd_size == 0xFFFFFFFF or count == 0xFFFF:
+        locator = tail.rfind(ZIP64_LOCATOR_SIG, 0, pos)
+        if locator < 0:
+            raise IpswError("zip64 archive without a zip64 locator")
+        eocd64_offset = struct.unpack('<Q', tail[locator + 8:locator + 16])[0]
+        eocd64 = remote.read(eocd64_offset, 56)
+        if eocd64[:4] != ZIP64_EOCD_SIG:
+            raise IpswError("bad zip64 end of central directory record")
+        count, cd_size, cd_offset = struct.unpack('<3Q', eocd64[32:56])
+    return cd_offset, cd_size, count
+
+def _parse_zip64_extra(extra, entry):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack('<2H', extra[pos:pos + 4])
+        body = extra[pos + 4:pos + 4 + size]
+        if tag == 0x0001:
+            values = list(struct.unpack(f'<{len(body) // 8}Q', body[:len(body) // 8 * 8]))
+            for key in ('size', 'compressed_size', 'offset'):
+                if entry[key] == 0xFFFFFFFF and values:
+                    entry[key] = values.pop(0)
+        pos += 4 + size
+
+def list_entries(remote):
+    """Parse the remote central directory into a list of entry dicts."""
+    cd_offset, cd_size, count = _find_central_directory(remote)
+    directory = remote.read(cd_offset, cd_size)
+    entries = []
+    pos = 0
+    for _ in range(count):
+        if directory[pos:pos + 4] != CENTRAL_SIG:
+            raise IpswError("corrupt central directory")
+        (method, crc, compressed_size, size, name_len, extra_len, comment_len,
+         offset) = struct.unpack('<6xH4xLLLHHH8xL', directory[pos + 4:pos + 46])
+        name = directory[pos + 46:pos + 46 + name_len].decode('utf-8', errors='replace')
+        extra = directory[pos + 46 + name_len:pos + 46 + name_len + extra_len]
+        entry = {'name': name, 'method': method, 'crc': crc, 'size': size,
+                 'compressed_size': compressed_size, 'offset': offset}
+        _parse_zip64_extra(extra, entry)
+        entries.append(entry)
+        pos += 46 + name_len + extra_len + comment_len
+    return entries
+
+def find_entry(entries, member):
+    """Entry whose basename is `member` (IPSWs keep Firmware.MSE at the root)."""
+    for entry in entries:
+        if entry['name'] == member or entry['name'].rsplit('/', 1)[-1] == member:
+            return entry
+    raise IpswError(f"{member} not found in archive")
+
+def extract_member(remote, entry, dest):
+    """Stream one entry's compressed bytes, inflate on the fly, verify the CRC."""
+    header = remote.read(entry['offset'], 30)
+    if header[:4] != LOCAL_SIG:
+        raise IpswError("bad local file header")
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    data_start = entry['offset'] + 30 + name_len + extra_len
+
+    if entry['method'] == DEFLATED:
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif entry['method'] != STORED:
+        raise IpswError(f"unsupported compression method {entry['method']}")
+
+    crc = 0
+    hasher = hashlib.sha256()
+    written = 0
+    part = dest + ".part"
+    with open(part, 'wb') as f:
+        for chunk in remote.stream(data_start, entry['compressed_size']):
+            data = inflater.decompress(chunk) if entry['method'] == DEFLATED else chunk
+            f.write(data)
+            crc = zlib.crc32(data, crc)
+            hasher.update(data)
+            written += len(data)
+        if entry['method'] == DEFLATED:
+            data = inflater.flush()
+            f.write(data)
+            crc = zlib.crc32(data, crc)
+            hasher.update(data)
+            written += len(data)
+    if written != entry['size'] or crc != entry['crc']:
+        os.remove(part)
+        raise IpswError(f"{entry['name']}: CRC/size mismatch after inflate")
+    os.replace(part, dest)
+    return hasher.hexdigest()
+
+def ipsw_key(remote, ipsw_sha1=None):
+    """Identity of the IPSW for the cache: its published SHA-1 when we have it."""
+    if ipsw_sha1:
+        return f"sha1:{ipsw_sha1.lower()}"
+    identity = f"{remote.url}|{remote.size}|{remote.etag}"
+    return "remote:" + hashlib.sha256(identity.encode()).hexdigest()
+
+def place(src, dest):
+    """Hard-link a cached blob to where the unbrick stages expect it (copy if needed)."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+def fetch_member(url, dest, cache, member="Firmware.MSE", ipsw_sha1=None, session=None):
+    """Make `dest` hold `member` of the IPSW at `url`. Returns (digest, cache_hit).
+
+    The extracted member is stored in the firmware cache under its own SHA-256
+    and indexed by the IPSW identity, so a second bench (or a second run) with
+    the same cache never touches the archive again.
+    """
+    if ipsw_sha1:
+        digest = cache.lookup(f"ipsw:sha1:{ipsw_sha1.lower()}:{member}")
+        if digest:
+            place(cache.path_for(digest), dest)
+            return digest, True
+    remote = RemoteFile(url, session)
+    key = f"ipsw:{ipsw_key(remote, ipsw_sha1)}:{member}"
+    part = cache.partial_path(key)
+    # Agents sharing the cache extract a member one at a time (see downloader.fetch)
+    with paths.file_lock(part):
+        try:
+            digest = cache.lookup(key)
+            if digest:
+                place(cache.path_for(digest), dest)
+                return digest, True
+            entry = find_entry(list_entries(remote), member)
+            digest = extract_member(remote, entry, part)
+        finally:
+            metrics.METRICS.download("ipsw", remote.requested)
+        path = cache.store(part, digest)
+        cache.remember(key, digest, entry['size'])
+    place(path, dest)
+    return digest, False
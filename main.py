@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
-import os
-import subprocess
 import sys
 import time
+STARTUP = [("start", time.perf_counter())]
+PRELOADED = set(sys.modules)
+
+import os
+import subprocess
 import platform
-import requests
-from zipfile import ZipFile
-import ctypes
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import json
+import argparse
+import contextlib
+import manifest
+# Loaded on first use, they are most of the startup time: downloader/ipsw
+# (requests), supervise/daemon (asyncio), scsiwrite, zipfile, ctypes, and the
+# session modules (bundle, checkpoint, dfu, failures, fwindex, metrics,
+# pipeline, stagetrace, usbwatch) that the menu doesn't need
+
+def startup_mark(label):
+    """Timestamp a startup phase for --profile-startup."""
+    STARTUP.append((label, time.perf_counter()))
+
+startup_mark("imports")
 
 # ---- Color codes ----
 RED = '\033[0;31m'
@@ -22,9 +39,22 @@ if 'NO_COLOR' in os.environ:
     RED = GREEN = YELLOW = BLUE = CYAN = BOLD = RESET = ''
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-DFU_UTILS_DIR = os.path.join(SCRIPT_DIR, "misc")
-FIRMWARES_DIR = os.path.join(DFU_UTILS_DIR, "firmwares")
-IPOD_SCSI = os.path.join(DFU_UTILS_DIR, "ipodscsi.exe")
+# Both can be pointed elsewhere, e.g. at the stand-in tools of benchmark.py
+DFU_UTILS_DIR = os.environ.get('LEUNBRICK_TOOLS_DIR', os.path.join(SCRIPT_DIR, "misc"))
+FIRMWARES_DIR = os.environ.get('LEUNBRICK_FIRMWARES_DIR', os.path.join(SCRIPT_DIR, "misc", "firmwares"))
+# Resolved once and cached (with versions) in the startup manifest, see manifest.py
+MANIFEST = manifest.Manifest()
+IPOD_SCSI = MANIFEST.resolve('ipodscsi', [
+    os.path.join(DFU_UTILS_DIR, "ipodscsi.exe"),
+    os.path.join(SCRIPT_DIR, "misc", "ipodscsi_linux", "ipodscsi"), "ipodscsi",
+]) or os.path.join(DFU_UTILS_DIR, "ipodscsi.exe")
+DFU_UTIL = MANIFEST.resolve('dfu-util', [os.path.join(DFU_UTILS_DIR, "dfu-util.exe"), "dfu-util"]) \
+    or os.path.join(DFU_UTILS_DIR, "dfu-util.exe")
+LIBUSB_DLL = os.path.join(DFU_UTILS_DIR, "libusb-1.0.dll")
+# {"6G"|"2012"|"2015": {"url": <IPSW url>, "sha1": <optional IPSW SHA-1>}}
+IPSW_SOURCES = os.path.join(FIRMWARES_DIR, "ipsw_sources.json")
+# Optional packed bundle of every image (see bundle.py); LEUNBRICK_BUNDLE_URL fetches one
+FIRMWARE_BUNDLE = os.path.join(FIRMWARES_DIR, "firmwares.lub")
 
 WTF_PATH_2012 = os.path.join(FIRMWARES_DIR, "2012_DFU", "WTF.x1234.RELEASE.dfu")
 FW_PATH_2012 = os.path.join(FIRMWARES_DIR, "2012_DFU", "FIRMWARE.x1249.RELEASE.dfu")
@@ -41,11 +71,27 @@ WTF_DEVICE_2012 = "05ac:1249"
 WTF_DEVICE_2015 = "05ac:124a"
 WTF_DEVICE_6G = "05ac:1248"
 
+# dfu-util prints at least every block; ipodscsi is silent while it writes the MSE
+DFU_STALL_TIMEOUT = 20
+IPODSCSI_TIMEOUT = 900
+# Most retries a flash stage gets for a transient failure (each class has its own cap, see failures.py)
+FLASH_RETRIES = int(os.environ.get('LEUNBRICK_FLASH_RETRIES', 3))
+# The only failures ipodscsi is run again for: the disk or the bus hiccuped.
+# Anything else (medium errors, a vanished disk, unknown output) needs a person
+SCSI_RETRY_CLASSES = ("scsi_transient", "usb_busy", "usb_pipe", "usb_timeout", "usb_io")
+
 USER_CHOICE = ""
 
 # ---- UI Helpers ----
+def clear_screen():
+    if platform.system() == 'Windows':
+        os.system('cls')
+    else:
+        # Same as `clear` without spawning it
+        print("\033[2J\033[H", end="", flush=True)
+
 def print_banner():
-    os.system('cls' if platform.system() == 'Windows' else 'clear')
+    clear_screen()
     print(f"""
 {CYAN}      ╦  ┌─┐  ╦ ╦┌┐┌╔╗ ┬─┐╦┌─┐┬┌─
       ║  ├┤   ║ ║│││╠╩╗├┬┘║│  ├┴┐
@@ -59,17 +105,18 @@ def print_banner():
 {CYAN}========================================={RESET}
 """)
 
+# Each line goes out in one write: pipeline stages print from several threads
 def msg(text):
-    print(f"{CYAN}[*]{RESET} {text}")
+    print(f"{CYAN}[*]{RESET} {text}\n", end="")
 
 def ok(text):
-    print(f"{GREEN}[✓]{RESET} {text}")
+    print(f"{GREEN}[✓]{RESET} {text}\n", end="")
 
 def warn(text):
-    print(f"{YELLOW}[!]{RESET} {text}")
+    print(f"{YELLOW}[!]{RESET} {text}\n", end="")
 
 def err(text):
-    print(f"{RED}[✖]{RESET} {text}")
+    print(f"{RED}[✖]{RESET} {text}\n", end="")
 
 def ask(text):
     return input(f"{YELLOW}[?]{RESET} {text}")
@@ -81,6 +128,7 @@ def is_admin():
     """Check if the script is running as admin/root."""
     if platform.system() == 'Windows':
         try:
+            import ctypes
             return ctypes.windll.shell32.IsUserAnAdmin() != 0
         except Exception:
             return False
@@ -94,6 +142,7 @@ def run_as_admin():
         script = os.path.abspath(sys.argv[0])
         params = ' '.join([f'"{arg}"' for arg in sys.argv[1:]])
         try:
+            import ctypes
             ctypes.windll.shell32.ShellExecuteW(
                 None, "runas", sys.executable, f'"{script}" {params}', None, 1
             )
@@ -117,14 +166,13 @@ def check_dependencies():
     msg("Checking for required dependencies...")
     missing = []
 
-    # Check for required .exe files in misc/ directory
-    required_files = ['dfu-util.exe', 'ipodscsi.exe']
     # lsusb.exe not needed on Windows as dfu-util.exe -l is used instead
-
-    for filename in required_files:
-        filepath = os.path.join(DFU_UTILS_DIR, filename)
-        if not os.path.exists(filepath):
-            missing.append(filename)
+    for name, path, version_args in (('dfu-util', DFU_UTIL, ('-V',)), ('ipodscsi', IPOD_SCSI, None)):
+        if not os.path.exists(path):
+            missing.append(name)
+        elif version_args:
+            ok(f"{name}: {MANIFEST.version(name, version_args) or path}")
+    MANIFEST.save()
 
     if not missing:
         ok("All dependencies are installed.")
@@ -134,94 +182,369 @@ def check_dependencies():
         return False
 
 # ---- Download Firmwares ----
-def download_firmwares(model):
-    msg(f"Checking for missing firmware files for {model}...")
-
-    FIRMWARE_URL_2012 = "https://github.com/lycanld/LeUnBrIck/releases/download/hidden/firmware_2012.zip"
-    FIRMWARE_URL_2015 = "https://github.com/lycanld/LeUnBrIck/releases/download/hidden/firmware_2015.zip"
-    FIRMWARE_URL_6G = "https://github.com/lycanld/LeUnBrIck/releases/download/hidden/firmware_6G.zip"
+FIRMWARE_URL_2012 = "https://github.com/lycanld/LeUnBrIck/releases/download/hidden/firmware_2012.zip"
+FIRMWARE_URL_2015 = "https://github.com/lycanld/LeUnBrIck/releases/download/hidden/firmware_2015.zip"
+FIRMWARE_URL_6G = "https://github.com/lycanld/LeUnBrIck/releases/download/hidden/firmware_6G.zip"
+
+# model -> [(label, short name, archive url, extract folder, [(image, target VID:PID), ...])]
+FIRMWARE_ARCHIVES = {
+    "6G": [("iPod nano 6G", "6G", FIRMWARE_URL_6G, "6G_DFU",
+            [(WTF_PATH_6G, DFU_DEVICE_6G), (FW_PATH_6G, WTF_DEVICE_6G)])],
+    "7G": [("2012 iPod", "2012", FIRMWARE_URL_2012, "2012_DFU",
+            [(WTF_PATH_2012, DFU_DEVICE_7G), (FW_PATH_2012, WTF_DEVICE_2012)]),
+           ("2015 iPod", "2015", FIRMWARE_URL_2015, "2015_DFU",
+            [(WTF_PATH_2015, DFU_DEVICE_7G), (FW_PATH_2015, WTF_DEVICE_2015)])],
+}
+
+FW_CACHE = None
+FW_SESSION = None
+FW_LOCK = threading.Lock()
+
+def firmware_cache():
+    global FW_CACHE, FW_SESSION
+    with FW_LOCK:
+        if FW_CACHE is None:
+            import downloader
+            FW_CACHE = downloader.FirmwareCache()
+            FW_SESSION = downloader.make_session()
+        return FW_CACHE
+
+def mse_path(short):
+    return os.path.join(FIRMWARES_DIR, short, "Firmware.MSE")
+
+def extract_archive(path, short, folder):
+    from zipfile import ZipFile
+    os.makedirs(os.path.join(FIRMWARES_DIR, short), exist_ok=True)
+    with ZipFile(path, 'r') as zip_ref:
+        zip_ref.extractall(os.path.join(FIRMWARES_DIR, folder))
+
+def start_downloads(archives):
+    """Start fetching every archive whose images aren't all available, together.
+    Returns {url: Future} (see downloader.fetch_all)."""
+    urls = [url for _, _, url, _, images in archives
+            if not all(image_available(image) for image, _ in images)]
+    if not urls:
+        return {}
+    import downloader
+    return downloader.fetch_all(urls, firmware_cache(), FW_SESSION)
+
+def fetch_archive(archive, downloads=None):
+    """Make sure one firmware zip's images are available and valid. Returns {image: (ok, reason)}.
+
+    `downloads` is a Future of start_downloads() for the model's archives,
+    when this one was started alongside them.
+    """
+    import metrics
+    _, short, url, folder, images = archive
+    if all(image_available(image) for image, _ in images):
+        metrics.METRICS.firmware("local")
+    else:
+        download = (downloads.result() if downloads else {}).get(url)
+        if download is None:
+            download = start_downloads([archive])[url]
+        path, _, cache_hit = download.result()
+        metrics.METRICS.firmware("cache" if cache_hit else "download")
+        extract_archive(path, short, folder)
+    results = {image: check_image(image, vid_pid) for image, vid_pid in images}
+    firmware_index().save()
+    MANIFEST.record_firmware(f"archive:{short}", results)
+    MANIFEST.save()
+    return results
+
+def fetch_mse(short):
+    """Pull Firmware.MSE out of the model's IPSW without downloading the whole IPSW."""
+    import metrics
+    dest = mse_path(short)
+    if image_available(dest):
+        metrics.METRICS.firmware("local")
+        results = {dest: (True, "present")}
+    else:
+        try:
+            with open(IPSW_SOURCES) as f:
+                source = json.load(f).get(short)
+        except (OSError, ValueError):
+            source = None
+        if not source:
+            return {dest: (False, "missing Firmware.MSE (no IPSW source in ipsw_sources.json)")}
+        import ipsw
+        # fetch_member() checks the member's CRC and size before placing it
+        _, cache_hit = ipsw.fetch_member(source['url'], dest, firmware_cache(),
+                                         ipsw_sha1=source.get('sha1'), session=FW_SESSION)
+        metrics.METRICS.firmware("cache" if cache_hit else "download")
+        results = {dest: (True, "from cache" if cache_hit else "extracted from IPSW")}
+    MANIFEST.record_firmware(f"mse:{short}", results)
+    MANIFEST.save()
+    return results
+
+class FirmwarePrep:
+    """Fetches, extracts and validates firmware on background threads.
+
+    Each image maps to the job that produces it, so a stage only ever waits
+    for the one image it is about to flash.
+    """
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="fw-prep")
+        self.lock = threading.Lock()
+        self.jobs = {}    # ('archive'|'mse', short name) -> Future
+        self.images = {}  # image path -> job key
+
+    def _needed(self, key):
+        """True if `key` needs a job, i.e. it has none yet or its last one failed."""
+        import metrics
+        job = self.jobs.get(key)
+        # Images the manifest says were fine, and haven't changed since, need no job at all
+        cached = MANIFEST.firmware(f"{key[0]}:{key[1]}") if job is None else None
+        if cached:
+            metrics.METRICS.firmware("manifest")
+            self.jobs[key] = Future()
+            self.jobs[key].set_result(cached)
+            return False
+        # Failed jobs are retried the next time someone asks for the model
+        return job is None or (job.done() and job.exception() is not None)
+
+    def start(self, model, include_mse=True):
+        with self.lock:
+            archives = [archive for archive in FIRMWARE_ARCHIVES.get(model, [])
+                        if self._needed(('archive', archive[1]))]
+            if archives:
+                # The model's missing zips download together over the shared session;
+                # queued first, so the archive jobs never wait on a job behind them
+                downloads = self.pool.submit(start_downloads, archives)
+            for archive in archives:
+                self.jobs[('archive', archive[1])] = self.pool.submit(fetch_archive, archive, downloads)
+            for archive in FIRMWARE_ARCHIVES.get(model, []):
+                short = archive[1]
+                for image, _ in archive[4]:
+                    self.images[image] = ('archive', short)
+                if include_mse:
+                    if self._needed(('mse', short)):
+                        self.jobs[('mse', short)] = self.pool.submit(fetch_mse, short)
+                    self.images[mse_path(short)] = ('mse', short)
+
+    def images_for(self, model):
+        images = []
+        for archive in FIRMWARE_ARCHIVES.get(model, []):
+            images += [image for image, _ in archive[4]] + [mse_path(archive[1])]
+        return images
+
+    def ready(self, image):
+        with self.lock:
+            job = self.jobs.get(self.images.get(image))
+        return job is not None and job.done()
+
+    def wait(self, image, timeout=None):
+        """Block until `image` is prepared. Returns (ok, reason)."""
+        with self.lock:
+            job = self.jobs.get(self.images.get(image))
+        if job is None:
+            return image_available(image), "not prepared"
+        try:
+            results = job.result(timeout)
+        except FutureTimeout:
+            return False, "still being prepared"
+        except Exception as e:
+            return False, f"download or extract failed: {e}"
+        return results.get(image, (False, "not provided by its archive"))
 
-    temp_dir = os.environ.get('TEMP', '/tmp')
+FIRMWARE_PREP = FirmwarePrep()
 
-    if model == "6G":
-        os.makedirs(os.path.join(FIRMWARES_DIR, "6G"), exist_ok=True)
-        # Check for WTF and FIRMWARE files before downloading
-        wtf_file = os.path.join(FIRMWARES_DIR, "6G_DFU", "WTF.x1232.RELEASE.dfu")
-        firmware_file = os.path.join(FIRMWARES_DIR, "6G_DFU", "FIRMWARE.x1248.RELEASE.dfu")
-        if not (os.path.exists(wtf_file) and os.path.exists(firmware_file)):
-            msg("Downloading firmware for iPod nano 6G...")
-            try:
-                response = requests.get(FIRMWARE_URL_6G)
-                response.raise_for_status()
-                zip_path = os.path.join(temp_dir, "fw6g.zip")
-                with open(zip_path, 'wb') as f:
-                    f.write(response.content)
-                with ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(os.path.join(FIRMWARES_DIR, "6G_DFU"))
-                ok("Extracted 6G firmware.")
-            except Exception as e:
-                err(f"Download or extract failed: {e}")
-                return
-    elif model == "7G":
-        os.makedirs(os.path.join(FIRMWARES_DIR, "2012_DFU"), exist_ok=True)
-        os.makedirs(os.path.join(FIRMWARES_DIR, "2015_DFU"), exist_ok=True)
-        wtf_2012 = os.path.join(FIRMWARES_DIR, "2012_DFU", "WTF.x1234.RELEASE.dfu")
-        firmware_2012 = os.path.join(FIRMWARES_DIR, "2012_DFU", "FIRMWARE.x1249.RELEASE.dfu")
-        wtf_2015 = os.path.join(FIRMWARES_DIR, "2015_DFU", "WTF.x1234.RELEASE.dfu")
-        firmware_2015 = os.path.join(FIRMWARES_DIR, "2015_DFU", "FIRMWARE.x124a.RELEASE.dfu")
-        if not (os.path.exists(wtf_2012) and os.path.exists(firmware_2012)):
-            msg("Downloading firmware for 2012 iPod...")
-            try:
-                response = requests.get(FIRMWARE_URL_2012)
-                response.raise_for_status()
-                zip_path = os.path.join(temp_dir, "fw2012.zip")
-                with open(zip_path, 'wb') as f:
-                    f.write(response.content)
-                with ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(os.path.join(FIRMWARES_DIR, "2012_DFU"))
-                ok("Extracted 2012 firmware.")
-            except Exception as e:
-                err(f"Download or extract failed: {e}")
-                return
-        if not (os.path.exists(wtf_2015) and os.path.exists(firmware_2015)):
-            msg("Downloading firmware for 2015 iPod...")
-            try:
-                response = requests.get(FIRMWARE_URL_2015)
-                response.raise_for_status()
-                zip_path = os.path.join(temp_dir, "fw2015.zip")
-                with open(zip_path, 'wb') as f:
-                    f.write(response.content)
-                with ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(os.path.join(FIRMWARES_DIR, "2015_DFU"))
-                ok("Extracted 2015 firmware.")
-            except Exception as e:
-                err(f"Download or extract failed: {e}")
-                return
+def download_firmwares(model):
+    """Fetch and validate everything `model` needs in the foreground."""
+    msg(f"Checking for missing firmware files for {model}...")
+    FIRMWARE_PREP.start(model)
+    good = True
+    for image in FIRMWARE_PREP.images_for(model):
+        image_ok, reason = FIRMWARE_PREP.wait(image)
+        if image_ok:
+            continue
+        if image.endswith("Firmware.MSE"):
+            warn(f"{os.path.relpath(image, FIRMWARES_DIR)}: {reason}")
+        else:
+            err(f"{os.path.relpath(image, FIRMWARES_DIR)}: {reason}")
+            good = False
+    return good
+
+def update_firmware():
+    """--update-firmware: bring every firmware archive (and LEUNBRICK_BUNDLE_URL) up to
+    the published version, rebuilding it from the cached one through a delta where
+    a patch is published. Returns the exit code."""
+    import downloader
+    import requests
+    cache = firmware_cache()
+    sources = [(archive[0], archive[2], archive)
+               for archives in FIRMWARE_ARCHIVES.values() for archive in archives]
+    if os.environ.get('LEUNBRICK_BUNDLE_URL'):
+        sources.append(("firmware bundle", os.environ['LEUNBRICK_BUNDLE_URL'], None))
+    how_text = {"current": "up to date", "delta": "updated from a delta patch", "full": "downloaded in full"}
+    failed = False
+    for label, url, archive in sources:
+        try:
+            path, digest, how = downloader.update(url, cache, session=FW_SESSION)
+        except (requests.RequestException, OSError, downloader.DownloadError) as e:
+            err(f"{label}: {e}")
+            failed = True
+            continue
+        if archive:
+            _, short, _, folder, images = archive
+            if how != "current" or not all(os.path.exists(image) for image, _ in images):
+                extract_archive(path, short, folder)
+            results = {image: check_image(image, vid_pid) for image, vid_pid in images}
+            MANIFEST.record_firmware(f"archive:{short}", results)
+            bad = [f"{os.path.basename(image)}: {reason}" for image, (good, reason) in results.items() if not good]
+            if bad:
+                err(f"{label}: {'; '.join(bad)}")
+                failed = True
+                continue
+        ok(f"{label}: {how_text[how]} ({digest[:12]})")
+    firmware_index().save()
+    MANIFEST.save()
+    return 1 if failed else 0
+
+# ---- Firmware Bundle ----
+BUNDLE = None
+BUNDLE_LOCK = threading.Lock()
+
+def get_bundle():
+    """The firmware bundle, if there is one locally or at LEUNBRICK_BUNDLE_URL."""
+    global BUNDLE
+    with BUNDLE_LOCK:
+        if BUNDLE is None:
+            BUNDLE = False
+            path = FIRMWARE_BUNDLE if os.path.exists(FIRMWARE_BUNDLE) else None
+            url = os.environ.get('LEUNBRICK_BUNDLE_URL')
+            if path is None and url:
+                try:
+                    import downloader
+                    path, _, _ = downloader.fetch(url, downloader.FirmwareCache())
+                except Exception as e:
+                    warn(f"Firmware bundle download failed: {e}")
+            if path:
+                import bundle
+                try:
+                    BUNDLE = bundle.Bundle(path)
+                except (OSError, bundle.BundleError) as e:
+                    warn(f"Ignoring firmware bundle: {e}")
+        return BUNDLE or None
+
+def bundle_name(path):
+    return os.path.relpath(path, FIRMWARES_DIR).replace(os.sep, '/')
+
+def image_available(path):
+    """True if the image is on disk or can be served from the bundle."""
+    if os.path.exists(path):
+        return True
+    fw_bundle = get_bundle()
+    return bool(fw_bundle) and bundle_name(path) in fw_bundle
+
+def image_file(path):
+    """Path of a real file for external tools, extracting it from the bundle if needed."""
+    fw_bundle = get_bundle()
+    if not os.path.exists(path) and fw_bundle and bundle_name(path) in fw_bundle:
+        fw_bundle.extract(bundle_name(path), path)
+    return path
+
+def image_size(path):
+    """Size of an image on disk or in the bundle, None if it isn't available yet."""
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    fw_bundle = get_bundle()
+    if fw_bundle and bundle_name(path) in fw_bundle:
+        return fw_bundle.info(bundle_name(path))['length']
+    return None
+
+# ---- Validate Firmwares ----
+FW_INDEX = None
+
+def firmware_index():
+    """The image verdict cache (see fwindex.py), loaded on first use."""
+    global FW_INDEX
+    with FW_LOCK:
+        if FW_INDEX is None:
+            import fwindex
+            FW_INDEX = fwindex.FirmwareIndex(FIRMWARES_DIR)
+        return FW_INDEX
+
+def check_image(image, vid_pid):
+    """Validate an image for the device it will be sent to. Returns (ok, reason).
+
+    Verdicts are cached in misc/firmwares/.index.json, so this is near-free
+    for images that haven't changed.
+    """
+    fw_bundle = get_bundle()
+    name = bundle_name(image)
+    if not os.path.exists(image) and fw_bundle and name in fw_bundle:
+        view = fw_bundle.view(name)
+        try:
+            record = firmware_index().check_blob(view, fw_bundle.sha256(name), vid_pid, name)
+        finally:
+            view.release()
+    else:
+        record = firmware_index().check(image, vid_pid)
+    return record['ok'], record['reason']
 
 # ---- Wait for USB ----
-def wait_for_usb(expected):
-    msg(f"Waiting for USB device {expected}...")
-    if platform.system() == 'Windows':
-        cmd = [os.path.join(DFU_UTILS_DIR, "dfu-util.exe"), "-l"]
+def wait_reenumeration(old, expected=None, port=None, timeout=30):
+    """Wait for `old` to drop off the bus and come back as one of `expected`.
+
+    Replaces the fixed sleeps after each flash: it returns as soon as the
+    device has re-enumerated. Returns the transition record (see
+    usbwatch.UsbWatcher.wait_transition) or None at the deadline.
+    """
+    import usbwatch
+    target = '/'.join(expected) if expected else "disconnect"
+    msg(f"Waiting for {old} to re-enumerate ({target})...")
+    watcher = usbwatch.get_watcher()
+    if watcher:
+        result = watcher.wait_transition(port, old, expected, timeout)
+    elif port:
+        result = poll_port_transition(port, old, expected, timeout)
     else:
-        cmd = ["lsusb"]
-
-    expected_lower = expected.lower()
-    for _ in range(30):  # wait up to 30 seconds
+        result = poll_transition(old, expected, timeout)
+    if result is None:
+        err(f"{old} did not re-enumerate as {target} within {timeout}s.")
+    elif expected:
+        ok(f"Device {result['vid_pid']} detected {result['back']:.1f}s after flashing "
+           f"(dropped off after {result['gone']:.1f}s).")
+    return result
+
+def poll_transition(old, expected, timeout):
+    """wait_transition() for platforms without sysfs, by polling lsusb / dfu-util -l."""
+    cmd = ['lsusb'] if platform.system() != 'Windows' else [DFU_UTIL, '-l']
+    started = time.monotonic()
+    gone = None
+    while time.monotonic() - started < timeout:
         result = subprocess.run(cmd, capture_output=True, text=True)
         output = (result.stdout + result.stderr).lower()
-
-        if expected_lower in output:
-            if "cannot open dfu device" in output or "libusb_error" in output:
-                warn(f"Device {expected} detected but not accessible (driver/service may be blocking).")
-            else:
-                ok(f"Device {expected} detected.")
-            return True
-
-        time.sleep(1)
-
-    err(f"Device {expected} not found.")
-    return False
+        if gone is None and old.lower() not in output:
+            gone = time.monotonic() - started
+            if not expected:
+                return {'path': None, 'vid_pid': None, 'gone': gone, 'back': None}
+        for candidate in expected or []:
+            # Seeing the new PID also proves the old one went away
+            if candidate.lower() in output:
+                back = time.monotonic() - started
+                return {'path': None, 'vid_pid': candidate.lower(),
+                        'gone': back if gone is None else gone, 'back': back}
+        time.sleep(0.25)
+    return None
+
+def poll_port_transition(port, old, expected, timeout):
+    """poll_transition() pinned to one port, through the paths dfu-util -l reports."""
+    wanted = {candidate.lower() for candidate in expected or []}
+    started = time.monotonic()
+    gone = None
+    while time.monotonic() - started < timeout:
+        current = list_dfu_devices()[0].get(port)
+        if gone is None and current != old.lower():
+            gone = time.monotonic() - started
+            if not expected:
+                return {'path': port, 'vid_pid': None, 'gone': gone, 'back': None}
+        if current in wanted:
+            back = time.monotonic() - started
+            return {'path': port, 'vid_pid': current, 'gone': gone, 'back': back}
+        time.sleep(0.25)
+    return None
 
 def change_driver(device_name, vid_pid):
     """Install libusbK driver for the device via wdi-simple."""
@@ -238,304 +561,1240 @@ def change_driver(device_name, vid_pid):
         warn(f"Failed to change driver for {device_name}: {result.stderr.strip()}")
         return False
 
+# VID:PIDs wdi-simple already bound; it binds every port at once, so once per PID is enough
+DRIVERS = set()
+DRIVERS_LOCK = threading.Lock()
 
-        
-# ---- Flash with dfu-util ----
-def flash_with_dfuutil(device, file):
-    flash(f"{file} to device {device}...")
-
-    dfu_util_path = os.path.join(DFU_UTILS_DIR, "dfu-util.exe")
-    result = subprocess.run([dfu_util_path, '-d', device, '-D', file], capture_output=True, text=True)
-    print(result.stdout)
-
-    if "Download done." in result.stdout:
-        ok("Flash completed (even if it threw LIBUSB_ERROR_NO_DEVICE).")
-        return True
-    elif "LIBUSB_ERROR_NO_DEVICE" in result.stdout:
-        warn("LIBUSB_ERROR_NO_DEVICE after transfer — this is expected.")
-        ok("Proceeding anyway.")
+def ensure_driver(device_name, vid_pid):
+    """change_driver() once per VID:PID for the whole process. Nothing to do off Windows."""
+    if platform.system() != 'Windows':
         return True
-    else:
-        err("Flash may have failed.")
-        input("Press ENTER to return to menu...")
-        return False
-
-# ---- Unbrick 6G ----
-def unbrick_6g():
-    download_firmwares("6G")
-    msg("Put your iPod nano 6G into DFU mode")
-    print(f"{CYAN}→ Hold VOLUME DOWN + POWER until black screen + connection sound.{RESET}")
-    input("Press ENTER when ready...")
-    if not wait_for_usb(DFU_DEVICE_6G):
-        return
+    with DRIVERS_LOCK:
+        if vid_pid not in DRIVERS and change_driver(device_name, vid_pid):
+            DRIVERS.add(vid_pid)
+        return vid_pid in DRIVERS
 
-    change_driver("USB DFU Device", DFU_DEVICE_6G)
+def rebind_driver(device_name, vid_pid):
+    """Run change_driver() again, e.g. when the device still can't be opened after the first one."""
+    with DRIVERS_LOCK:
+        DRIVERS.discard(vid_pid)
+    return ensure_driver(device_name, vid_pid)
 
-    if not os.path.exists(WTF_PATH_6G):
-        err(f"Missing WTF: {WTF_PATH_6G}")
-        return
-    msg("Flashing WTF firmware...")
-    if not flash_with_dfuutil(DFU_DEVICE_6G, WTF_PATH_6G):
-        return
-
-    time.sleep(5)
-    if not wait_for_usb(WTF_DEVICE_6G):
-        err("WTF mode not detected.")
-        return
-
-    # Change driver for iPod Recovery before flashing disk mode firmware
-    if not change_driver("iPod Recovery", WTF_DEVICE_6G):
-        err("Failed to change driver for iPod Recovery.")
-        return
-
-    ok("Device in WTF Mode. Disk Mode firmware available.")
-    confirm = ask("Flash it? (y/n): ").lower()
-    if confirm == "y":
-        if not os.path.exists(FW_PATH_6G):
-            err(f"Missing {FW_PATH_6G}")
-            return
-        msg("Flashing Disk Mode firmware...")
-        if not flash_with_dfuutil(WTF_DEVICE_6G, FW_PATH_6G):
-            return
 
-        time.sleep(5)
-        FINAL_MSE_6G = os.path.join(FIRMWARES_DIR, "6G", "Firmware.MSE")
-        if not os.path.exists(IPOD_SCSI):
-            err("ipodscsi not found.")
-            return
-        if not os.path.exists(FINAL_MSE_6G):
-            err("Missing Firmware.MSE.")
-            return
-
-        warn("[!] Flashing the wrong disk may harm your computer! Choose carefully.")
-        print(f"\n{CYAN}→ All drives/devices:{RESET}")
-        ipod_drive = None
+        
+# ---- Flash with dfu-util ----
+def native_flash(engine, device, file, path=None, progress=None):
+    """Flash through the in-process DFU engine. Returns (success, report text)."""
+    import dfu
+    fw_bundle = get_bundle()
+    name = bundle_name(file)
+    try:
+        if not os.path.exists(file) and fw_bundle and name in fw_bundle:
+            # Stream straight out of the bundle's mmap, no extraction
+            view = fw_bundle.view(name)
+            try:
+                stats = engine.download(device, dfu.strip_suffix(view), path=path, progress=progress)
+            finally:
+                view.release()
+        else:
+            stats = engine.download_file(device, file, path=path, progress=progress)
+    except dfu.DfuError as e:
+        return False, f"DFU error: {e}"
+    rate = stats['bytes'] / stats['seconds'] / 1024 if stats['seconds'] else 0
+    return True, (f"Download done. {stats['bytes']} bytes in {stats['blocks']} blocks, "
+                  f"{stats['seconds']:.1f}s ({rate:.0f} KiB/s), manifest: {stats['manifest']}")
+
+def run_dfuutil(device, file, path=None, progress=None):
+    """Run dfu-util without touching the console. Returns (success, stdout).
+
+    progress(percent) is called as the transfer advances.
+    """
+    import dfu
+    engine = dfu.native_engine(LIBUSB_DLL if platform.system() == 'Windows' else None)
+    if engine:
+        return native_flash(engine, device, file, path=path,
+                            progress=(lambda sent, total, _: progress(sent * 100 // max(total, 1)))
+                            if progress else None)
+
+    import supervise
+    result = supervise.run_tool(dfuutil_cmd(device, file, path), fatal=supervise.DFU_FATAL,
+                                stall_timeout=DFU_STALL_TIMEOUT,
+                                on_progress=(lambda percent, _line: progress(percent)) if progress else None)
+    output = result.output + (f"\naborted: {result.reason}" if result.reason else "")
+    return dfuutil_succeeded(result), output
+
+def dfuutil_cmd(device, file, path=None):
+    cmd = [DFU_UTIL, '-d', device]
+    if path:
+        # Pin the transfer to one physical port so identical devices don't collide
+        cmd += ['-p', path]
+    return cmd + ['-D', image_file(file)]
+
+def dfuutil_succeeded(result):
+    """A killed run never counts; LIBUSB_ERROR_NO_DEVICE at the end is the iPod rebooting."""
+    return result.reason is None and ("Download done." in result.output
+                                      or "LIBUSB_ERROR_NO_DEVICE" in result.output)
+
+def print_percent(percent, _line=None):
+    width = 30
+    filled = width * percent // 100
+    print(f"\r    [{'#' * filled}{'.' * (width - filled)}] {percent:3d}%",
+          end="" if percent < 100 else "\n", flush=True)
+
+def print_progress(sent, total, _block_seconds):
+    width = 30
+    filled = width * sent // total if total else width
+    print(f"\r    [{'#' * filled}{'.' * (width - filled)}] {sent * 100 // max(total, 1):3d}%  "
+          f"{sent // 1024}/{total // 1024} KiB", end="" if sent < total else "\n", flush=True)
+
+# ---- Write Firmware.MSE ----
+def ipodscsi_available():
+    import scsiwrite
+    return scsiwrite.native_available() or os.path.exists(IPOD_SCSI)
+
+def native_ipodscsi(writer, drive, mse, echo=True, progress=None):
+    """Write Firmware.MSE through the in-process SG_IO writer. Returns a supervise.ToolResult."""
+    import scsiwrite
+    import supervise
+    result = supervise.ToolResult(['scsiwrite', drive, mse])
+    verify = os.environ.get('LEUNBRICK_SCSI_VERIFY') == '1'
+
+    def status(text):
+        result.lines.append(text)
+        if echo:
+            print(text)
+    def chunk_done(sent, total, chunk_seconds):
+        if echo:
+            print_progress(sent, total, chunk_seconds)
+        if progress:
+            progress(sent * 100 // total)
+    try:
+        stats = writer.write_file(image_file(mse), verify=verify, status=status, progress=chunk_done)
+    except (scsiwrite.ScsiError, OSError) as e:
+        status(f"Error: {e}")
+        result.returncode = 1
+        return result
+    finally:
+        writer.backend.close()
+    result.returncode = 0
+    result.seconds = stats['seconds']
+    slowest = max(stats['chunk_times']) * 1000
+    rate = stats['bytes'] / stats['seconds'] / (1 << 20) if stats['seconds'] else 0
+    status(f"Wrote {stats['bytes']} bytes in {stats['chunks']} chunks, {stats['seconds']:.1f}s "
+           f"({rate:.1f} MiB/s, slowest chunk {slowest:.0f} ms)"
+           + (", readback verified" if stats['verified'] else ""))
+    return result
+
+def run_ipodscsi(drive, mse, echo=True, progress=None):
+    """Write Firmware.MSE, natively over SG_IO on Linux, else with ipodscsi under
+    supervision. Returns a supervise.ToolResult either way; progress(percent)
+    is called as the write advances."""
+    import scsiwrite
+    import supervise
+    try:
+        writer = scsiwrite.native_writer(drive)
+    except scsiwrite.ScsiError as e:
+        warn(f"Native SCSI writer unavailable ({e}), falling back to ipodscsi.")
+        writer = None
+    if writer:
+        return native_ipodscsi(writer, drive, mse, echo, progress)
+
+    cmd = [IPOD_SCSI, drive, 'ipod6g', 'writefirmware', '-r', '-p', image_file(mse)]
+    return supervise.run_tool(cmd, fatal=supervise.IPODSCSI_FATAL, timeout=IPODSCSI_TIMEOUT,
+                              on_line=print if echo else None,
+                              on_progress=(lambda percent, _line: progress(percent)) if progress else None)
+
+def ipodscsi_failure(result):
+    """Why an ipodscsi run failed, or None if it succeeded."""
+    if result.reason:
+        return result.reason
+    if result.returncode != 0:
+        return f"exit code {result.returncode}" + (f": {result.lines[-1]}" if result.lines else "")
+    return None
+
+# ---- Resolve iPod Disk ----
+def find_ipod_disk(timeout=30):
+    """Wait for disks whose model/volume name is iPod. Returns their paths ([] on timeout)."""
+    deadline = time.monotonic() + timeout
+    while True:
         if platform.system() == 'Windows':
-            print("Available drives:")
-            # Replacement block for better drive identification on Windows
-            result = subprocess.run(
-                ['wmic', 'diskdrive', 'get', 'Caption,DeviceID,Index,Size'],
-                capture_output=True, text=True
-            )
-            for line in result.stdout.splitlines():
-                if line.strip():
-                    print("  " + line.strip())
-
-            result = subprocess.run(
-                ['wmic', 'logicaldisk', 'get', 'Caption,VolumeName'],
-                capture_output=True, text=True
-            )
-            print("\nMounted volumes:")
-            volume_lines = result.stdout.splitlines()
-            for line in volume_lines:
-                if line.strip():
-                    print("  " + line.strip())
-                    # Auto-select drive letter if VolumeName is iPod
-                    parts = line.split()
-                    if len(parts) >= 2 and parts[1].lower() == 'ipod':
-                        ipod_drive = parts[0]
-
-            if ipod_drive:
-                ok(f"Auto-selected iPod drive: {ipod_drive}")
-            else:
-                print(f"{YELLOW}Note: Look for a drive with 'iPod' in Caption or VolumeName. Enter the drive letter (e.g. E:).{RESET}")
+            result = subprocess.run(['wmic', 'logicaldisk', 'get', 'Caption,VolumeName'],
+                                    capture_output=True, text=True)
+            disks = [parts[0] for parts in (line.split() for line in result.stdout.splitlines())
+                     if len(parts) >= 2 and parts[1].lower() == 'ipod']
+        else:
+            result = subprocess.run(['lsblk', '-d', '-n', '-o', 'NAME,MODEL'], capture_output=True, text=True)
+            disks = [f"/dev/{parts[0]}" for parts in (line.split(None, 1) for line in result.stdout.splitlines())
+                     if len(parts) == 2 and 'ipod' in parts[1].lower()]
+        if disks or time.monotonic() >= deadline:
+            return disks
+        time.sleep(0.5)
+
+# ---- USB Port Claims ----
+# Port path -> the session flashing the iPod on it. Sessions address devices by
+# port, so two identical iPods in the same mode never get each other's images.
+PORT_CLAIMS = {}
+PORT_CLAIMS_LOCK = threading.Lock()
+# Port paths this process may use at all (--agent-ports); None: every port
+AGENT_PORTS = None
+
+def port_free(path, owner=None):
+    """Whether `owner` may use `path`: it is one of AGENT_PORTS and no other session claimed it."""
+    return (AGENT_PORTS is None or path in AGENT_PORTS) and PORT_CLAIMS.get(path, owner) is owner
+
+def find_device(candidates, port=None, owner=None):
+    """(port, vid_pid) of a DFU/WTF device in `candidates` on `port`, or on any
+    port no other session has claimed. port is None where it can't be told."""
+    wanted = {candidate.lower() for candidate in candidates}
+    devices, unbound = list_dfu_devices()
+    for path, vid_pid in sorted(devices.items()):
+        if vid_pid in wanted and (port is None or path == port) and port_free(path, owner):
+            return path, vid_pid
+    # Without a driver (Windows, before wdi-simple) dfu-util lists no path at all,
+    # so an agent limited to some ports can't tell whether it is one of them
+    unbound = sorted(unbound & wanted)
+    if port is None and unbound and AGENT_PORTS is None:
+        return None, unbound[0]
+    return None
+
+def claim_port(port, owner):
+    """Claim `port` for `owner`; False if another session has it."""
+    with PORT_CLAIMS_LOCK:
+        if port is None or port_free(port, owner):
+            if port is not None:
+                PORT_CLAIMS[port] = owner
+            return True
+        return False
 
+def release_ports(owner):
+    with PORT_CLAIMS_LOCK:
+        for port in [port for port, claimer in PORT_CLAIMS.items() if claimer is owner]:
+            del PORT_CLAIMS[port]
+
+def claim_device(candidates, owner, port=None, timeout=30):
+    """Wait for a device in `candidates` on `port` (any free port if None) and
+    claim its port for `owner`. Returns (port, vid_pid) or None."""
+    import usbwatch
+    deadline = time.monotonic() + timeout
+    watcher = usbwatch.get_watcher()
+    while True:
+        with PORT_CLAIMS_LOCK:
+            found = find_device(candidates, port, owner)
+            if found and found[0] is not None:
+                PORT_CLAIMS[found[0]] = owner
+        if found:
+            return found
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        if watcher:
+            with watcher.changed:
+                watcher.changed.wait(min(remaining, 1))
+        else:
+            time.sleep(min(remaining, 1))
+
+def ipod_disks(port=None, timeout=30):
+    """Wait for the iPod's disk. On Linux it is resolved through sysfs to the
+    exact /dev/sdX behind `port`; elsewhere by its model/volume name."""
+    import usbwatch
+    watcher = usbwatch.get_watcher()
+    if watcher:
+        return watcher.wait_for_disks(timeout=timeout, path=port)
+    return find_ipod_disk(timeout)
+
+def auto_ipod_disk(port=None):
+    """The iPod disk when exactly one can be found, else None (the operator picks)."""
+    disks = ipod_disks(port)
+    if len(disks) == 1:
+        ok(f"Auto-selected iPod disk: {disks[0]}" + (f" (USB port {port})" if port else ""))
+        return disks[0]
+    if disks:
+        warn(f"Several iPod disks found ({', '.join(disks)}), pick one manually.")
+    return None
+
+# ---- Drive Selection ----
+def select_ipod_drive(port=None):
+    """Find the iPod disk, or list drives and let the operator pick and confirm with YES."""
+    warn("[!] Flashing the wrong disk may harm your computer! Choose carefully.")
+    print(f"\n{CYAN}→ All drives/devices:{RESET}")
+    ipod_drive = None
+    if platform.system() == 'Windows':
+        print("Available drives:")
+        # Replacement block for better drive identification on Windows
+        result = subprocess.run(
+            ['wmic', 'diskdrive', 'get', 'Caption,DeviceID,Index,Size'],
+            capture_output=True, text=True
+        )
+        for line in result.stdout.splitlines():
+            if line.strip():
+                print("  " + line.strip())
+
+        result = subprocess.run(
+            ['wmic', 'logicaldisk', 'get', 'Caption,VolumeName'],
+            capture_output=True, text=True
+        )
+        print("\nMounted volumes:")
+        volume_lines = result.stdout.splitlines()
+        for line in volume_lines:
+            if line.strip():
+                print("  " + line.strip())
+                # Auto-select drive letter if VolumeName is iPod
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].lower() == 'ipod':
+                    ipod_drive = parts[0]
+
+        if ipod_drive:
+            ok(f"Auto-selected iPod drive: {ipod_drive}")
         else:
+            print(f"{YELLOW}Note: Look for a drive with 'iPod' in Caption or VolumeName. Enter the drive letter (e.g. E:).{RESET}")
+
+    else:
+        ipod_drive = auto_ipod_disk(port)
+        if not ipod_drive:
             result = subprocess.run(['lsblk', '-d', '-o', 'NAME,SIZE,MODEL'], capture_output=True, text=True)
             for line in result.stdout.splitlines():
                 print(f"   {line}")
             print(f"{YELLOW}Note: The correct disk should be labeled 'iPod' in the MODEL column.{RESET}")
-        print()
+    print()
 
-        while not ipod_drive:
-            if platform.system() == 'Windows':
-                ipod_drive = ask("Input the correct drive (e.g., E: or \\\\.\\PHYSICALDRIVE1): ").strip()
-
-                # Normalize input
-                if ipod_drive and ipod_drive.endswith(':'):
-                    # Convert drive letter to PHYSICALDRIVE mapping
-                    letter = ipod_drive[0].upper()
-                    # Use wmic to map to PHYSICALDRIVE
-                    result = subprocess.run(
-                        ['wmic', 'path', 'Win32_LogicalDiskToPartition'],
-                        capture_output=True, text=True
-                    )
-                    mapping = result.stdout
-                    # Fallback: assume PhysicalDrive1 if it's an iPod
-                    if "PHYSICALDRIVE1" in mapping.upper():
-                        ipod_drive = r'\\.\PHYSICALDRIVE1'
-                    else:
-                        ipod_drive = f"\\\\.\\{ipod_drive}"
-                elif not ipod_drive.upper().startswith('\\\\.\\PHYSICALDRIVE'):
+    while not ipod_drive:
+        if platform.system() == 'Windows':
+            ipod_drive = ask("Input the correct drive (e.g., E: or \\\\.\\PHYSICALDRIVE1): ").strip()
+
+            # Normalize input
+            if ipod_drive and ipod_drive.endswith(':'):
+                # Convert drive letter to PHYSICALDRIVE mapping
+                letter = ipod_drive[0].upper()
+                # Use wmic to map to PHYSICALDRIVE
+                result = subprocess.run(
+                    ['wmic', 'path', 'Win32_LogicalDiskToPartition'],
+                    capture_output=True, text=True
+                )
+                mapping = result.stdout
+                # Fallback: assume PhysicalDrive1 if it's an iPod
+                if "PHYSICALDRIVE1" in mapping.upper():
+                    ipod_drive = r'\\.\PHYSICALDRIVE1'
+                else:
                     ipod_drive = f"\\\\.\\{ipod_drive}"
+            elif not ipod_drive.upper().startswith('\\\\.\\PHYSICALDRIVE'):
+                ipod_drive = f"\\\\.\\{ipod_drive}"
 
-            else:
-                ipod_drive = ask("Input the correct device (e.g., sda or /dev/sda): ")
-                if not ipod_drive.startswith('/dev/'):
-                    ipod_drive = f"/dev/{ipod_drive}"
-
-            if not ipod_drive:
-                err("No device entered.")
-                continue
-
-            really = ask(f"You selected {ipod_drive}. Type YES to confirm: ")
-            if really == "YES":
-                break
-            else:
-                warn("Aborted by user. Please try again.")
-                ipod_drive = None
-
-        # Use normalized device path
-        subprocess.run([IPOD_SCSI, ipod_drive, 'ipod6g', 'writefirmware', '-r', '-p', FINAL_MSE])
+        else:
+            ipod_drive = ask("Input the correct device (e.g., sda or /dev/sda): ")
+            if not ipod_drive.startswith('/dev/'):
+                ipod_drive = f"/dev/{ipod_drive}"
 
-        ok("Firmware flashed via ipodscsi.")
+        if not ipod_drive:
+            err("No device entered.")
+            continue
 
+        really = ask(f"You selected {ipod_drive}. Type YES to confirm: ")
+        if really == "YES":
+            break
+        else:
+            warn("Aborted by user. Please try again.")
+            ipod_drive = None
+
+    return ipod_drive
+
+# ---- Device Profiles ----
+# Everything that differs between models. The stages are the same for all
+# of them (see BatchRun.graph), so another model only needs a profile.
+DEVICE_PROFILES = {
+    "6G": {
+        'name': "iPod nano 6G",
+        'dfu_device': DFU_DEVICE_6G,
+        'wtf_image': WTF_PATH_6G,
+        # WTF VID:PID -> (variant, Disk Mode image, Firmware.MSE). The variant
+        # also names the firmware folder and goes into checkpoints.
+        'variants': {WTF_DEVICE_6G: ("6G", FW_PATH_6G, mse_path("6G"))},
+        'dfu_hint': "Hold VOLUME DOWN + POWER until black screen + connection sound.",
+        'recovery_hint': "Hold Sleep/Wake + Volume down → Disk Mode → Restore via iTunes",
+    },
+    "7G": {
+        'name': "iPod nano 7G",
+        'dfu_device': DFU_DEVICE_7G,
+        # Both variants boot the same WTF image and come back with their own PID
+        'wtf_image': WTF_PATH_2012,
+        'variants': {WTF_DEVICE_2012: ("2012", FW_PATH_2012, mse_path("2012")),
+                     WTF_DEVICE_2015: ("2015", FW_PATH_2015, mse_path("2015"))},
+        'dfu_hint': "USB-A to Lightning + Hold SLEEP + HOME until black screen + connection sound.",
+        'recovery_hint': "Hold SLEEP + HOME → Recovery Mode → Restore via iTunes",
+    },
+}
+
+# DFU PID -> (family, WTF image); WTF PID -> (variant, Disk Mode image, Firmware.MSE)
+DFU_STAGES = {profile['dfu_device']: (family, profile['wtf_image'])
+              for family, profile in DEVICE_PROFILES.items()}
+WTF_STAGES = {vid_pid: variant for profile in DEVICE_PROFILES.values()
+              for vid_pid, variant in profile['variants'].items()}
+# --model -> (family, DFU VID:PID, WTF VID:PIDs the device can come back as)
+HEADLESS_MODELS = {family.lower(): (family, profile['dfu_device'], list(profile['variants']))
+                   for family, profile in DEVICE_PROFILES.items()}
+
+def profile_family(vid_pid):
+    """Family of a DFU or WTF mode VID:PID, None if it isn't an iPod we know."""
+    for family, profile in DEVICE_PROFILES.items():
+        if vid_pid == profile['dfu_device'] or vid_pid in profile['variants']:
+            return family
+    return None
+
+# ---- Unbrick ----
+def unbrick(family, trace):
+    """The menu flow for one iPod of `family`: BatchRun's stages with prompts."""
+    # Fetch/validate in the background while the operator puts the iPod into DFU mode
+    FIRMWARE_PREP.start(family)
+    if offer_resume(family, trace):
+        return
+    record = BatchRun(family.lower(), resume=False, trace=trace, ui="menu").execute()
+    wrote = any(stage['stage'] == "ipodscsi" and stage['ok'] is not None for stage in record['stages'])
+    if record['exit_code'] == EXIT_OK and wrote:
+        ok(f"Firmware flashed in {record['seconds']:.1f}s.")
+    if wrote:
         print()
         warn("Still stuck in white screen?")
-        print(f"{CYAN}→ Hold Sleep/Wake + Volume down → Disk Mode → Restore via iTunes{RESET}")
-
+        print(f"{CYAN}→ {DEVICE_PROFILES[family]['recovery_hint']}{RESET}")
     input("Press ENTER to return...")
 
-# ---- Auto-detect and Unbrick iPod Nano 7G ----
-def unbrick_7g():
-    download_firmwares("7G")
-    msg("Put your iPod nano 7G into DFU mode")
-    print(f"{CYAN}→ USB-A to Lightning + Hold SLEEP + HOME until black screen + connection sound.{RESET}")
-    input("Press ENTER when ready...")
-    if not wait_for_usb(DFU_DEVICE_7G):
-        return
-
-    change_driver("USB DFU Device", DFU_DEVICE_7G)
-
-    if not os.path.exists(WTF_PATH_2012):
-        err(f"Missing WTF firmware: {WTF_PATH_2012}")
-        return
-    msg("Flashing WTF firmware...")
-    if not flash_with_dfuutil(DFU_DEVICE_7G, WTF_PATH_2012):
-        return
-
-    time.sleep(5)
-
-    msg("Detecting iPod model...")
-    detected = False
-    cmd = ['lsusb'] if platform.system() != 'Windows' else [os.path.join(DFU_UTILS_DIR, "dfu-util.exe"), '-l']
-    for _ in range(30):
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        output = (result.stdout + result.stderr).lower()
-
-        if WTF_DEVICE_2012.lower() in output:
-            MODEL = "2012"
-            WTF_DEVICE = WTF_DEVICE_2012
-            FW_PATH = FW_PATH_2012
-            FINAL_MSE = os.path.join(FIRMWARES_DIR, "2012", "Firmware.MSE")
-            ok("Detected iPod Nano 7G (2012)")
-            detected = True
-            break
-        elif WTF_DEVICE_2015.lower() in output:
-            MODEL = "2015"
-            WTF_DEVICE = WTF_DEVICE_2015
-            FW_PATH = FW_PATH_2015
-            FINAL_MSE = os.path.join(FIRMWARES_DIR, "2015", "Firmware.MSE")
-            ok("Detected iPod Nano 7G (2015)")
-            detected = True
-            break
-        time.sleep(1)
-
-    if not detected:
-        err("Could not detect iPod model after flashing WTF firmware.")
-        return
-
-    change_driver("iPod Recovery", WTF_DEVICE)
-
-    confirm = ask(f"Flash Disk Mode firmware for {MODEL}? (y/n): ").lower()
-    if confirm == "y":
-        if not os.path.exists(FW_PATH):
-            err(f"Missing Disk Mode firmware: {FW_PATH}")
-            return
-        msg("Flashing Disk Mode firmware...")
-        if not flash_with_dfuutil(WTF_DEVICE, FW_PATH):
-            return
+# ---- Tracing ----
+def traced_session(family):
+    """Run the menu's unbrick flow with a per-session stage trace (see stagetrace.py)."""
+    import stagetrace
+    trace = stagetrace.Tracer(family)
+    try:
+        unbrick(family, trace)
+    finally:
+        trace.close()
+
+def trace_summary(paths):
+    import stagetrace
+    stagetrace.print_summary(stagetrace.summarize(stagetrace.load(stagetrace.trace_files(paths))))
+
+# ---- Station Mode ----
+DFU_LIST_RE = re.compile(r'Found DFU: \[([0-9a-fA-F]{4}:[0-9a-fA-F]{4})\].*?path="([^"]+)"')
+DFU_UNBOUND_RE = re.compile(r'Cannot open DFU device ([0-9a-fA-F]{4}:[0-9a-fA-F]{4})')
+
+def list_dfu_devices():
+    """Return ({port_path: vid_pid}, {vid_pid without a usable driver}) from dfu-util -l."""
+    import usbwatch
+    watcher = usbwatch.get_watcher()
+    if watcher:
+        devices = {path: vid_pid for path, vid_pid in watcher.snapshot().items()
+                   if vid_pid in DFU_STAGES or vid_pid in WTF_STAGES}
+        return devices, set()
+
+    result = subprocess.run([DFU_UTIL, '-l'], capture_output=True, text=True)
+    output = result.stdout + result.stderr
+    devices = {}
+    for match in DFU_LIST_RE.finditer(output):
+        devices[match.group(2)] = match.group(1).lower()
+    unbound = {match.group(1).lower() for match in DFU_UNBOUND_RE.finditer(output)}
+    return devices, unbound
+
+# Stage -> (STAGE, STATUS) shown for a port while that stage runs
+STATION_STAGES = {
+    'dfu_driver': ("WTF", "installing driver"),
+    'wtf_flash': ("WTF", "flashing"),
+    'wtf_wait': ("WTF", "waiting for re-enumeration"),
+    'wtf_driver': ("Disk Mode", "installing driver"),
+    'disk_flash': ("Disk Mode", "flashing"),
+    'disk_mode_boot': ("Disk Mode", "waiting for disk"),
+    'disk_wait': ("Disk Mode", "waiting for disk"),
+    'ipodscsi': ("ipodscsi", "writing"),
+}
+
+class Station:
+    """One session per hub port, each a BatchRun pinned to its port, all
+    started from a single dfu-util -l scan loop."""
+
+    def __init__(self, max_workers):
+        self.lock = threading.Lock()
+        self.devices = {}     # port path -> vid:pid seen by the last scan
+        self.slots = {}       # port path -> per-device session state
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def scan(self):
+        devices, unbound = list_dfu_devices()
+        for vid_pid in unbound:
+            if vid_pid in DFU_STAGES:
+                self.pool.submit(ensure_driver, "USB DFU Device", vid_pid)
+        with self.lock:
+            self.devices = devices
+            for path, slot in self.slots.items():
+                if slot['finished'] and path not in devices:
+                    slot['unplugged'] = True
+            for path, vid_pid in devices.items():
+                slot = self.slots.get(path)
+                # A finished port only starts over once a new iPod has been plugged in.
+                # One already in WTF mode (station restarted mid-session) resumes from there.
+                if slot is not None and not slot.get('unplugged'):
+                    continue
+                if vid_pid in DFU_STAGES or vid_pid in WTF_STAGES:
+                    self.slots[path] = {
+                        'model': profile_family(vid_pid), 'stage': "queued", 'status': "",
+                        'started': time.monotonic(), 'elapsed': 0.0, 'finished': False,
+                    }
+                    self.pool.submit(self.run_session, path, vid_pid)
+
+    def update(self, path, **fields):
+        with self.lock:
+            self.slots[path].update(fields)
+
+    def on_event(self, path, event):
+        """Mirror a session's progress events into its row of the table."""
+        kind, stage = event['event'], event.get('stage')
+        if kind == "stage_started" and stage in STATION_STAGES:
+            label, status = STATION_STAGES[stage]
+            self.update(path, stage=label, status=status)
+        elif kind == "progress" and stage in STATION_STAGES:
+            self.update(path, status=f"{STATION_STAGES[stage][1]} {event['percent']}%")
+        elif kind == "variant":
+            self.update(path, model=event['variant'])
+        elif kind == "operator":
+            self.update(path, status="waiting for operator")
+        elif kind == "retry":
+            self.update(path, status=f"retrying ({event['failure']})")
+
+    def run_session(self, path, vid_pid):
+        import stagetrace
+        family = profile_family(vid_pid)
+        point = None
+        if vid_pid in WTF_STAGES:
+            # The station was restarted mid-session: WTF is already booted on this port
+            point = {'mode': 'wtf', 'vid_pid': vid_pid, 'port': path, 'disk': None,
+                     'variant': WTF_STAGES[vid_pid][0]}
+        run = BatchRun(family.lower(), assume_yes=True, resume=False, port=path, ui="station",
+                       trace=stagetrace.Tracer(family, port=path),
+                       on_event=lambda event: self.on_event(path, event))
+        try:
+            record = run.execute(point)
+            outcome = "done" if record['exit_code'] == EXIT_OK else f"failed: {record['error']}"
+        except Exception as e:
+            outcome = f"error: {e}"
+        with self.lock:
+            started = self.slots[path]['started']
+        self.update(path, status=outcome, finished=True, elapsed=time.monotonic() - started)
 
-        time.sleep(5)
-        if not os.path.exists(IPOD_SCSI):
-            err("ipodscsi not found.")
-            return
-        if not os.path.exists(FINAL_MSE):
-            err("Missing Firmware.MSE.")
+    def render(self):
+        if PROMPT_LOCK.locked():
             return
+        with self.lock:
+            rows = sorted(self.slots.items())
+            now = time.monotonic()
+            lines = []
+            for path, slot in rows:
+                elapsed = slot['elapsed'] if slot['finished'] else now - slot['started']
+                color = GREEN if slot['status'] == "done" else RED if slot['finished'] else CYAN
+                lines.append(f"  {path:<12} {slot['model']:<6} {slot['stage']:<11} "
+                             f"{color}{slot['status']:<34}{RESET} {elapsed:6.0f}s")
+        print("\033[2J\033[H", end="")
+        print(f"{BOLD}{CYAN}=========== Le UnBrIck Station ==========={RESET}")
+        print(f"{BOLD}  {'PORT':<12} {'MODEL':<6} {'STAGE':<11} {'STATUS':<34} {'TIME':>7}{RESET}")
+        print("\n".join(lines) if lines else f"  {YELLOW}No devices yet - put iPods into DFU mode.{RESET}")
+        done = sum(1 for _, slot in rows if slot['status'] == "done")
+        print(f"{CYAN}=========================================={RESET}")
+        print(f"Completed: {done}/{len(rows)}   (Ctrl+C to stop the station)")
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+def station_mode():
+    """Run an unbrick session for every iPod that enters DFU mode on the hub."""
+    import usbwatch
+    if not (download_firmwares("6G") and download_firmwares("7G")):
+        input("Press ENTER to return to menu...")
+        return
+    ports = ask("Number of hub ports to run in parallel [10]: ").strip()
+    station = Station(max_workers=int(ports) if ports.isdigit() and int(ports) > 0 else 10)
+    msg("Station running. Put iPods into DFU mode on any port.")
+    watcher = usbwatch.get_watcher()
+    try:
+        while True:
+            station.scan()
+            station.render()
+            if watcher:
+                # Rescan as soon as a device comes or goes, redraw at least once a second
+                with watcher.changed:
+                    watcher.changed.wait(1)
+            else:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        print()
+        warn("Stopping station, waiting for running sessions to finish...")
+    station.shutdown()
+    station.render()
+    input("Press ENTER to return to menu...")
 
-        warn("[!] Flashing the wrong disk may harm your computer! Choose carefully.")
-        print(f"\n{CYAN}→ All drives/devices:{RESET}")
-        ipod_drive = None
-        if platform.system() == 'Windows':
-            print("Available drives:")
-            # Replacement block for better drive identification on Windows
-            result = subprocess.run(
-                ['wmic', 'diskdrive', 'get', 'Caption,DeviceID,Index,Size'],
-                capture_output=True, text=True
-            )
-            for line in result.stdout.splitlines():
-                if line.strip():
-                    print("  " + line.strip())
+# ---- Headless Mode ----
+EXIT_OK = 0
+EXIT_FAILED = 1       # a pipeline stage failed
+EXIT_USAGE = 2        # bad arguments or job spec (argparse uses 2 as well)
+EXIT_SETUP = 3        # missing tool, firmware or privileges
+EXIT_INTERRUPTED = 130
+
+class StageFailed(Exception):
+    def __init__(self, stage, detail, code=EXIT_FAILED):
+        super().__init__(f"{stage}: {detail}")
+        self.code = code
+
+# ---- Resume ----
+CHECKPOINTS = None
+CHECKPOINTS_LOCK = threading.Lock()
+
+def checkpoints():
+    """The checkpoint store (see checkpoint.py), loaded on first use."""
+    global CHECKPOINTS
+    with CHECKPOINTS_LOCK:
+        if CHECKPOINTS is None:
+            import checkpoint
+            CHECKPOINTS = checkpoint.Checkpoints()
+        return CHECKPOINTS
+MODE_NAMES = {'dfu': "DFU mode", 'wtf': "WTF mode", 'disk': "Disk Mode (Firmware.MSE not written yet)"}
+
+def probe_device(family, port=None, owner=None):
+    """Which stage an attached `family` iPod can resume at, on `port` or on
+    any port no other session has claimed.
+
+    Returns {'mode': 'dfu'|'wtf'|'disk', 'vid_pid', 'port', 'disk', 'variant'}
+    or None. A disk only counts when a "disk_mode" checkpoint says we flashed
+    Disk Mode on that port and never wrote Firmware.MSE: a healthy iPod's
+    disk looks exactly the same.
+    """
+    _, dfu_device, wtf_devices = HEADLESS_MODELS[family.lower()]
+    found = find_device([dfu_device], port, owner)
+    if found:
+        return {'mode': 'dfu', 'vid_pid': found[1], 'port': found[0], 'disk': None, 'variant': None}
+    found = find_device(wtf_devices, port, owner)
+    if found:
+        return {'mode': 'wtf', 'vid_pid': found[1], 'port': found[0], 'disk': None,
+                'variant': WTF_STAGES[found[1]][0]}
+    for entry in checkpoints().entries(family):
+        if port is not None and entry['port'] != port:
+            continue
+        if not port_free(entry['port'], owner):
+            continue
+        if entry['stage'] == "disk_mode" and entry.get('variant'):
+            disks = ipod_disks(entry['port'], timeout=0)
+            if len(disks) == 1:
+                return {'mode': 'disk', 'vid_pid': None, 'port': entry['port'], 'disk': disks[0],
+                        'variant': entry['variant']}
+    return None
+
+def offer_resume(family, trace):
+    """If the iPod is already past DFU mode, offer to pick up from there. True if it did."""
+    point = probe_device(family)
+    if not point or point['mode'] == 'dfu':
+        return False
+    where = f" on USB port {point['port']}" if point['port'] else ""
+    ok(f"Found an iPod nano {point['variant'] or family} already in {MODE_NAMES[point['mode']]}{where}.")
+    if ask("Resume from there instead of starting over? (y/n): ").lower() != "y":
+        return False
+    record = BatchRun(family.lower(), assume_yes=True, trace=trace, ui="menu").execute(point)
+    if record['exit_code'] == EXIT_OK:
+        ok(f"Resumed session finished in {record['seconds']:.1f}s.")
+    else:
+        err(f"Resumed session failed: {record['error']}")
+    input("Press ENTER to return...")
+    return True
 
-            result = subprocess.run(
-                ['wmic', 'logicaldisk', 'get', 'Caption,VolumeName'],
-                capture_output=True, text=True
-            )
-            print("\nMounted volumes:")
-            volume_lines = result.stdout.splitlines()
-            for line in volume_lines:
-                if line.strip():
-                    print("  " + line.strip())
-                    # Auto-select drive letter if VolumeName is iPod
-                    parts = line.split()
-                    if len(parts) >= 2 and parts[1].lower() == 'ipod':
-                        ipod_drive = parts[0]
-
-            if ipod_drive:
-                ok(f"Auto-selected iPod drive: {ipod_drive}")
+def normalize_target(target):
+    if platform.system() == 'Windows':
+        return target if target.endswith(':') or target.startswith('\\\\.\\') else f"{target.upper()}:"
+    return target if target.startswith('/dev/') else f"/dev/{target}"
+
+# Stages up to WTF mode, from WTF to Disk Mode, and the ones that write the disk
+DFU_PHASE = ("operator_dfu", "prepare_wtf", "dfu_wait", "dfu_driver", "wtf_flash", "wtf_wait")
+WTF_PHASE = ("wtf_driver", "confirm_disk_mode", "prepare_disk_mode", "disk_flash", "disk_mode_boot")
+DISK_PHASE = ("prepare_disk_mode", "disk_flash", "disk_mode_boot", "prepare_mse", "disk_wait", "ipodscsi")
+# A stalled download or extraction shouldn't hold a session forever
+PREP_TIMEOUT = 600
+# Only one session at a time may ask the operator anything
+PROMPT_LOCK = threading.Lock()
+
+class BatchRun:
+    """One unbrick run, recording every stage's timing and outcome.
+
+    Every model runs the same stage graph (see graph()), filled in from
+    its device profile. `ui` is "headless" (no prompts), "menu" (the
+    interactive flow: DFU instructions, the Disk Mode confirmation, drive
+    selection, progress bars) or "station" (quiet, asks for the disk only
+    when it can't be told).
+    """
+
+    def __init__(self, model, target="auto", assume_yes=False, dfu_timeout=60, usb_timeout=30,
+                 resume=True, trace=None, on_event=None, port=None, ui="headless"):
+        self.family, self.dfu_device, self.wtf_devices = HEADLESS_MODELS[model]
+        self.profile = DEVICE_PROFILES[self.family]
+        self.model = model
+        self.target = target
+        self.assume_yes = assume_yes
+        self.dfu_timeout = dfu_timeout
+        self.usb_timeout = usb_timeout
+        self.resume = resume
+        self.ui = ui
+        self.echo = ui != "station"
+        self.resumed = None
+        self.variant = None
+        self.wtf_device = None
+        self.disk = None
+        # A pinned job only ever touches the iPod on this port
+        self.pinned = port
+        self.port = port
+        self.stages = []
+        self.lock = threading.Lock()
+        if trace is None:
+            import stagetrace
+            trace = stagetrace.Tracer(self.family, port=port)
+        self.trace = trace
+        if port and not self.trace.port:
+            self.trace.port = port
+        self.on_event = on_event
+        self.current = None
+        self.percent = None
+
+    def emit(self, event, **fields):
+        """Pass a progress event to on_event (the daemon streams these to clients)."""
+        if self.on_event:
+            self.on_event(dict(fields, event=event))
+
+    def progress(self, percent):
+        # Only whole-percent changes, dfu-util redraws the same value many times
+        if percent != self.percent:
+            self.percent = percent
+            self.emit("progress", stage=self.current, percent=percent)
+
+    def show_progress(self, percent):
+        if percent != self.percent:
+            print_percent(percent)
+        self.progress(percent)
+
+    def stage(self, stage):
+        """Run one pipeline.Stage and record it; a failure raises StageFailed."""
+        import failures
+        import metrics
+        if stage.info.get('progress'):
+            # Stages that report progress never overlap each other
+            self.current, self.percent = stage.name, None
+        self.emit("stage_started", stage=stage.name)
+        started = time.monotonic()
+        good, detail, extra = stage.call()
+        ended = time.monotonic()
+        record = {'stage': stage.name, 'ok': good, 'seconds': round(ended - started, 3), 'detail': detail}
+        record.update(extra)
+        failures.COUNTS.record(extra.get('failures'), good)
+        nbytes = stage.info.get('nbytes')
+        nbytes = nbytes() if callable(nbytes) else nbytes
+        with self.lock:
+            self.stages.append(record)
+            self.trace.record(stage.name, started, ended, "ok" if good else "failed", detail,
+                              nbytes, failures=extra.get('failures'))
+        metrics.METRICS.stage(stage.name, self.port, ended - started, "ok" if good else "failed",
+                      nbytes if good else None)
+        self.emit("stage", **record)
+        if not good:
+            if self.echo:
+                err(f"{stage.name}: {detail}")
+            raise StageFailed(stage.name, detail, stage.info.get('code', EXIT_FAILED))
+        if self.echo:
+            ok(f"{stage.name}: {detail}")
+        return detail
+
+    def retry(self, stage, failure, attempt, delay, driver=None):
+        """Before another attempt at `stage`: rebind the driver if that's what
+        failed, and tell the operator (or the daemon's clients)."""
+        name = failure.name if failure else "failed"
+        if name == "driver_not_bound" and driver:
+            rebind_driver(*driver)
+        self.emit("retry", stage=stage, failure=name, attempt=attempt, delay=delay)
+        if self.echo:
+            warn(f"{stage}: {name}, retrying in {delay:g}s (attempt {attempt + 1})")
+
+    def skip(self, stage, reason):
+        import metrics
+        record = {'stage': stage.name, 'ok': None, 'seconds': 0.0, 'detail': reason}
+        with self.lock:
+            self.stages.append(record)
+        metrics.METRICS.stage(stage.name, self.port, None, "skipped")
+        self.emit("stage", **record)
+        if self.echo:
+            warn(f"{stage.name}: skipped ({reason})")
+
+    # ---- Stages ----
+    def image(self, kind):
+        """Path of the "wtf", "disk" (Disk Mode) or "mse" image for this iPod."""
+        if kind == "wtf":
+            return self.profile['wtf_image']
+        for variant, fw_image, final_mse in self.profile['variants'].values():
+            if variant == self.variant:
+                return fw_image if kind == "disk" else final_mse
+        raise ValueError(f"no {kind} image before the variant is known")
+
+    def operator_dfu(self):
+        msg(f"Put your {self.profile['name']} into DFU mode")
+        print(f"{CYAN}→ {self.profile['dfu_hint']}{RESET}")
+        input("Press ENTER when ready...")
+        return True, "operator ready"
+
+    def prepare(self, kind):
+        image = self.image(kind)
+        if self.ui == "menu" and not FIRMWARE_PREP.ready(image):
+            msg(f"Waiting for {os.path.basename(image)} to finish downloading/validating...")
+        return FIRMWARE_PREP.wait(image)
+
+    def at_port(self, port):
+        """Our iPod is on `port` now; every later trace record carries it."""
+        with self.lock:
+            self.port = port
+            self.trace.port = port
+
+    def wait_device(self, candidates, timeout):
+        if self.echo:
+            msg(f"Waiting for {'/'.join(candidates)}" + (f" on port {self.pinned}" if self.pinned else "") + "...")
+        found = claim_device(candidates, self, self.pinned, timeout)
+        if not found:
+            where = f" on port {self.pinned}" if self.pinned else " on a free port"
+            return False, f"{'/'.join(candidates)} not seen{where} within {timeout}s"
+        self.at_port(found[0])
+        return True, found[1] + (f" on port {found[0]}" if found[0] else "")
+
+    def wait_dfu(self):
+        result = self.wait_device([self.dfu_device], self.dfu_timeout)
+        if result[0]:
+            self.checkpoint("dfu")
+        return result
+
+    def still_in(self, vid_pid):
+        """Whether our iPod is still in the mode `vid_pid` (a failed flash may be retried)."""
+        return find_device([vid_pid], self.port, self) is not None
+
+    def transition(self, old, expected):
+        result = wait_reenumeration(old, expected, self.port, self.usb_timeout)
+        if not result:
+            return False, f"{old} did not re-enumerate within {self.usb_timeout}s"
+        self.at_port(result['path'] or self.port)
+        latency = {'gone_seconds': round(result['gone'], 3)}
+        if result['back'] is not None:
+            latency['back_seconds'] = round(result['back'], 3)
+        return True, result['vid_pid'] or "disconnected", latency
+
+    def wait_wtf(self):
+        result = self.transition(self.dfu_device, self.wtf_devices)
+        if result[0]:
+            self.enter_wtf(result[1])
+        return result
+
+    def enter_wtf(self, wtf_device):
+        self.wtf_device = wtf_device
+        self.variant = WTF_STAGES[wtf_device][0]
+        self.emit("variant", variant=self.variant)
+        if self.ui == "menu":
+            ok(f"Detected {self.profile['name']}" + (f" ({self.variant})" if self.variant != self.family else ""))
+        self.checkpoint("wtf")
+
+    def driver(self, device_name, vid_pid):
+        if ensure_driver(device_name, vid_pid):
+            return True, "libusbK"
+        return False, "wdi-simple failed"
+
+    def confirm(self):
+        import pipeline
+        if ask(f"Flash Disk Mode firmware for {self.variant}? (y/n): ").lower() != "y":
+            raise pipeline.Stop("not confirmed")
+        return True, "confirmed"
+
+    def flash(self, kind):
+        import failures
+        vid_pid, image = (self.dfu_device, self.image("wtf")) if kind == "wtf" else (self.wtf_device, self.image("disk"))
+        if self.ui == "menu":
+            flash(f"{image} to device {vid_pid}" + (f" on USB port {self.port}" if self.port else "") + "...")
+        success, output = run_dfuutil(vid_pid, image, self.port,
+                                      progress=self.show_progress if self.ui == "menu" else self.progress)
+        if not success:
+            failure, line = failures.diagnose(output)
+            return False, line, {'failure_class': failure.name}
+        if kind == "disk":
+            self.checkpoint("disk_mode")
+        lines = [line.strip() for line in output.splitlines() if line.strip()]
+        return True, lines[-1] if lines else "no output"
+
+    def find_disk(self):
+        if self.target != "auto":
+            return True, normalize_target(self.target)
+        if self.ui == "menu":
+            return True, select_ipod_drive(self.port)
+        disks = ipod_disks(self.port, self.usb_timeout)
+        if len(disks) == 1:
+            return True, disks[0]
+        if self.ui == "station":
+            # Drive selection needs the operator, so only one session prompts at a time
+            self.emit("operator")
+            with PROMPT_LOCK:
+                print()
+                msg(f"Port {self.port} ({self.variant}) is in Disk Mode.")
+                return True, select_ipod_drive(self.port)
+        if disks:
+            # Never guess between two iPods; the operator has to name one
+            return False, f"several iPod disks ({', '.join(disks)}), pass --target"
+        return False, f"no iPod disk within {self.usb_timeout}s"
+
+    def wait_disk(self):
+        result = self.find_disk()
+        if result[0]:
+            self.disk = result[1]
+        return result
+
+    def write_mse(self):
+        import failures
+        if not ipodscsi_available():
+            return False, "ipodscsi not found"
+        disk, mse = self.disk, self.image("mse")
+        result = run_ipodscsi(disk, mse, echo=self.ui == "menu", progress=self.progress)
+        failure = ipodscsi_failure(result)
+        if failure:
+            failure_class, _ = failures.diagnose(f"{result.output}\n{failure}", result.returncode)
+            return False, f"ipodscsi {failure}", {'failure_class': failure_class.name}
+        self.checkpoint("done")
+        return True, f"Firmware.MSE written to {disk}"
+
+    def checkpoint(self, stage):
+        checkpoints().mark(self.family, self.port, stage, self.variant)
+
+    def graph(self):
+        """The stage graph: DFU -> WTF -> Disk Mode -> Firmware.MSE, with firmware
+        prep, driver installs and device waits running alongside each other."""
+        import failures
+        import pipeline
+        stages = []
+
+        def add(name, fn, *args, after=(), **options):
+            # Stages that don't apply here (drivers off Windows, prompts when
+            # not interactive) are left out, and so is waiting for them
+            present = {stage.name for stage in stages}
+            stages.append(pipeline.Stage(name, fn, *args, after=[n for n in after if n in present], **options))
+        windows = platform.system() == 'Windows'
+
+        if self.ui == "menu":
+            add("operator_dfu", self.operator_dfu)
+        add("prepare_wtf", self.prepare, "wtf", after=("operator_dfu",), timeout=PREP_TIMEOUT, code=EXIT_SETUP)
+        add("dfu_wait", self.wait_dfu, after=("operator_dfu",))
+        if windows:
+            add("dfu_driver", self.driver, "USB DFU Device", self.dfu_device, after=("dfu_wait",))
+        add("wtf_flash", self.flash, "wtf", after=("prepare_wtf", "dfu_wait", "dfu_driver"),
+            retries=FLASH_RETRIES, retry_if=lambda failure: self.still_in(self.dfu_device), classify=failures.of_stage,
+            on_retry=lambda *failed: self.retry("wtf_flash", *failed,
+                                                driver=windows and ("USB DFU Device", self.dfu_device)),
+            progress=True, nbytes=lambda: image_size(self.image("wtf")))
+        add("wtf_wait", self.wait_wtf, after=("wtf_flash",))
+
+        if windows:
+            add("wtf_driver", lambda: self.driver("iPod Recovery", self.wtf_device), after=("wtf_wait",))
+        if self.ui == "menu" and not self.assume_yes:
+            # Same place the old flow asked "Flash it? (y/n)"
+            add("confirm_disk_mode", self.confirm, after=("wtf_wait",))
+        add("prepare_disk_mode", self.prepare, "disk", after=("wtf_wait",), timeout=PREP_TIMEOUT, code=EXIT_SETUP)
+        add("disk_flash", self.flash, "disk", after=("prepare_disk_mode", "wtf_driver", "confirm_disk_mode"),
+            retries=FLASH_RETRIES, retry_if=lambda failure: self.still_in(self.wtf_device), classify=failures.of_stage,
+            on_retry=lambda *failed: self.retry("disk_flash", *failed,
+                                                driver=windows and ("iPod Recovery", self.wtf_device)),
+            progress=True, nbytes=lambda: image_size(self.image("disk")))
+        add("disk_mode_boot", lambda: self.transition(self.wtf_device, None), after=("disk_flash",))
+
+        add("prepare_mse", self.prepare, "mse", after=("wtf_wait", "confirm_disk_mode"),
+            timeout=PREP_TIMEOUT, code=EXIT_SETUP)
+        add("disk_wait", self.wait_disk, after=("disk_mode_boot",))
+        add("ipodscsi", self.write_mse, after=("disk_wait", "prepare_mse"),
+            retries=FLASH_RETRIES, classify=failures.of_stage,
+            retry_if=lambda failure: failure.name in SCSI_RETRY_CLASSES,
+            on_retry=lambda *failed: self.retry("ipodscsi", *failed),
+            progress=True, nbytes=lambda: image_size(self.image("mse")))
+        return stages
+
+    def run(self, point=None):
+        """Run from whatever mode the iPod is in now (see probe_device), or from DFU."""
+        import pipeline
+        if point is None and self.resume:
+            point = probe_device(self.family, self.pinned, self)
+        if point and point['mode'] != 'dfu' and not claim_port(point['port'], self):
+            point = None
+        mode = point['mode'] if point else 'dfu'
+        skip = {}
+        if mode != 'dfu':
+            self.resumed = mode
+            self.at_port(point['port'])
+            msg(f"Resuming: iPod already in {MODE_NAMES[mode]}.")
+            skip.update(dict.fromkeys(DFU_PHASE, f"resumed from {mode} mode"))
+            if mode == 'wtf':
+                self.enter_wtf(point['vid_pid'])
             else:
-                print(f"{YELLOW}Note: Look for a drive with 'iPod' in Caption or VolumeName. Enter the drive letter (e.g. E:).{RESET}")
-
+                self.variant = point['variant']
+                skip.update(dict.fromkeys(WTF_PHASE, "resumed from disk mode"))
+        # Without --yes a headless run stops in WTF mode, where the menu asks
+        writes_disk = self.assume_yes or self.ui == "menu"
+        if not writes_disk:
+            for name in DISK_PHASE:
+                skip.setdefault(name, "needs --yes")
+        FIRMWARE_PREP.start(self.family, include_mse=writes_disk)
+        pipeline.run(self.graph(), self.stage, skip, self.skip)
+
+    def execute(self, point=None):
+        """Run the pipeline and return the result record (with 'exit_code')."""
+        import metrics
+        started = time.monotonic()
+        code, error = EXIT_OK, None
+        if self.assume_yes and not ipodscsi_available():
+            code, error = EXIT_SETUP, "ipodscsi not found"
         else:
-            result = subprocess.run(['lsblk', '-d', '-o', 'NAME,SIZE,MODEL'], capture_output=True, text=True)
-            for line in result.stdout.splitlines():
-                print(f"   {line}")
-            print(f"{YELLOW}Note: The correct disk should be labeled 'iPod' in the MODEL column.{RESET}")
-        print()
-
-        while not ipod_drive:
-            if platform.system() == 'Windows':
-                ipod_drive = ask("Input the correct drive letter (e.g., E:): ")
-                if not ipod_drive.endswith(':'):
-                    ipod_drive = f"{ipod_drive.upper()}:"
+            try:
+                self.run(point)
+            except StageFailed as e:
+                code, error = e.code, str(e)
+            except KeyboardInterrupt:
+                code, error = EXIT_INTERRUPTED, "interrupted"
+            finally:
+                release_ports(self)
+        self.trace.close("ok" if code == EXIT_OK else error)
+        # ok only once Firmware.MSE is written; a run that stopped short didn't finish an iPod
+        if code == EXIT_OK:
+            result = "ok" if any(stage['stage'] == "ipodscsi" and stage['ok'] for stage in self.stages) else "stopped"
+        else:
+            result = "interrupted" if code == EXIT_INTERRUPTED else "failed"
+        metrics.METRICS.device(self.variant or self.family, result)
+        return {
+            'model': self.model, 'variant': self.variant, 'port': self.port, 'target': self.target,
+            'resumed': self.resumed,
+            'result': "ok" if code == EXIT_OK else "failed", 'exit_code': code, 'error': error,
+            'seconds': round(time.monotonic() - started, 3), 'stages': self.stages,
+            'trace': self.trace.path if self.trace.enabled else None,
+        }
+
+JOB_DEFAULTS = {'model': None, 'target': "auto", 'yes': False, 'dfu_timeout': 60, 'usb_timeout': 30,
+                'resume': True, 'port': None}
+
+def load_jobs(args):
+    """Jobs from --job (one object or a list of them), else a single job from the flags."""
+    defaults = {'model': args.model, 'target': args.target, 'yes': args.yes,
+                'dfu_timeout': args.dfu_timeout, 'usb_timeout': args.usb_timeout,
+                'resume': not args.no_resume, 'port': args.port}
+    if not args.job:
+        return [defaults]
+    with open(args.job) as f:
+        spec = json.load(f)
+    return [job_spec(job, defaults) for job in (spec if isinstance(spec, list) else [spec])]
+
+def job_spec(job, defaults=None):
+    """One job with defaults filled in; ValueError if it can't be run."""
+    import usbwatch
+    if not isinstance(job, dict):
+        raise ValueError("a job must be a JSON object")
+    job = dict(defaults or JOB_DEFAULTS, **job)
+    if str(job['model']).lower() not in HEADLESS_MODELS:
+        raise ValueError(f"unknown model {job['model']!r}")
+    if job['port'] is not None and not usbwatch.is_port_path(str(job['port'])):
+        raise ValueError(f"bad USB port path {job['port']!r} (expected e.g. 1-1.2)")
+    return job
+
+def run_headless(args):
+    """Run every job back to back with no prompts. Returns the worst exit code."""
+    import failures
+    try:
+        jobs = load_jobs(args)
+    except (OSError, ValueError, TypeError) as e:
+        err(f"Bad job spec: {e}")
+        return EXIT_USAGE
+
+    out = sys.stdout
+    worst = EXIT_OK
+    # With --json stdout carries only the results; progress goes to stderr
+    with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+        if not is_admin():
+            err("Headless mode must already run as admin/root.")
+            return EXIT_SETUP
+        for job in jobs:
+            run = BatchRun(str(job['model']).lower(), job['target'], job['yes'],
+                           job['dfu_timeout'], job['usb_timeout'], job['resume'], port=job['port'])
+            msg(f"Unbricking iPod nano {run.family} (target: {run.target})")
+            record = run.execute()
+            firmware_index().save()
+            if args.json:
+                print(json.dumps(record), file=out, flush=True)
+            elif record['exit_code'] == EXIT_OK:
+                ok(f"Done in {record['seconds']:.1f}s")
             else:
-                ipod_drive = ask("Input the correct device (e.g., sda or /dev/sda): ")
-                if not ipod_drive.startswith('/dev/'):
-                    ipod_drive = f"/dev/{ipod_drive}"
-            if not ipod_drive:
-                err("No device entered.")
-                continue
-            # Confirm drive
-            really = ask(f"You selected {ipod_drive}. Type YES to confirm: ")
-            if really == "YES":
+                err(f"Failed: {record['error']}")
+            worst = max(worst, record['exit_code'])
+            if record['exit_code'] == EXIT_INTERRUPTED:
                 break
-            else:
-                warn("Aborted by user. Please try again.")
-                ipod_drive = None
-
-        subprocess.run([IPOD_SCSI, ipod_drive, 'ipod6g', 'writefirmware', '-r', '-p', FINAL_MSE])
-        ok("Firmware flashed via ipodscsi.")
-
+        if failures.COUNTS.summary():
+            msg(f"Flash failures by class: {failures.COUNTS.summary()}")
+    return worst
+
+def daemon_job(job, emit):
+    """Run one daemon job on a worker thread; stage events go to emit."""
+    run = BatchRun(str(job['model']).lower(), job['target'], job['yes'], job['dfu_timeout'],
+                   job['usb_timeout'], job['resume'], on_event=emit, port=job['port'])
+    msg(f"Job: unbricking iPod nano {run.family} (target: {run.target})")
+    record = run.execute()
+    firmware_index().save()
+    return record
+
+def run_daemon(args):
+    """Serve unbrick jobs until interrupted (see daemon.py for the API)."""
+    import dfu
+    import failures
+    import metrics
+    import usbwatch
+    import asyncio
+    import daemon
+    if not is_admin():
+        err("The daemon must already run as admin/root.")
+        return EXIT_SETUP
+    # Everything a job would otherwise set up first: firmware, USB watcher, DFU engine
+    for family in ("6G", "7G"):
+        FIRMWARE_PREP.start(family)
+    usbwatch.get_watcher()
+    dfu.native_engine(LIBUSB_DLL if platform.system() == 'Windows' else None)
+
+    socket_path = daemon.SOCKET_PATH if args.socket is None else args.socket
+
+    def ready(servers):
+        where = [socket_path] if socket_path else []
+        if args.http is not None:
+            where.append(f"http://127.0.0.1:{args.http}")
+        ok(f"Daemon listening on {' and '.join(where)} ({args.max_jobs} concurrent jobs)")
+    server = daemon.JobServer(daemon_job, job_spec, args.max_jobs, metrics=metrics.METRICS.render,
+                              health=lambda: {'failures': failures.COUNTS.snapshot()})
+    try:
+        asyncio.run(server.serve(socket_path, args.http, ready=ready))
+    except KeyboardInterrupt:
         print()
-        warn("Still stuck in white screen?")
-        print(f"{CYAN}→ Hold SLEEP + HOME → Recovery Mode → Restore via iTunes{RESET}")
-
-    input("Press ENTER to return...")
+        warn("Daemon stopped.")
+    except OSError as e:
+        err(f"Cannot start the daemon: {e}")
+        return EXIT_SETUP
+    return EXIT_OK
+
+# ---- Bench Agent ----
+IMAGE_HASHES = {}   # path -> ([size, mtime_ns], sha256)
+
+def image_sha256(path):
+    """SHA-256 of an image on disk (hashed again only when it changes) or in the bundle; None if it isn't here."""
+    stamp = manifest.stamp(path)
+    if stamp:
+        known = IMAGE_HASHES.get(path)
+        if not known or known[0] != stamp:
+            import delta
+            known = IMAGE_HASHES[path] = (stamp, delta.file_sha256(path))
+        return known[1]
+    fw_bundle = get_bundle()
+    if fw_bundle and bundle_name(path) in fw_bundle:
+        return fw_bundle.sha256(bundle_name(path))
+    return None
+
+def firmware_inventory():
+    """{model: {image: sha256}} for every model whose images are all here."""
+    inventory = {}
+    for family, profile in DEVICE_PROFILES.items():
+        images = [profile['wtf_image']] + [image for _, fw_image, final_mse in profile['variants'].values()
+                                           for image in (fw_image, final_mse)]
+        hashes = {bundle_name(image): image_sha256(image) for image in images}
+        if None not in hashes.values():
+            inventory[family.lower()] = hashes
+    return inventory
+
+def free_ports():
+    """{port path: model} for iPods in DFU/WTF mode on ports this agent may
+    use and no session has claimed."""
+    devices, _ = list_dfu_devices()
+    with PORT_CLAIMS_LOCK:
+        return {path: profile_family(vid_pid).lower() for path, vid_pid in devices.items()
+                if port_free(path)}
+
+def agent_job(job, emit):
+    """A job from the coordinator: checked like a daemon job, then run like one."""
+    try:
+        job = job_spec(job)
+    except ValueError as e:
+        return {'result': "failed", 'exit_code': EXIT_USAGE, 'error': str(e)}
+    if job.get('port') and AGENT_PORTS is not None and job['port'] not in AGENT_PORTS:
+        return {'result': "failed", 'exit_code': EXIT_USAGE,
+                'error': f"port {job['port']} is not one of this agent's --agent-ports"}
+    return daemon_job(job, emit)
+
+def run_agent(args):
+    """Check in with the coordinator at args.agent and run the jobs it hands out (see coordinator.py)."""
+    import dfu
+    import failures
+    import usbwatch
+    global AGENT_PORTS
+    import socket
+    import coordinator
+    if not is_admin():
+        err("A bench agent must already run as admin/root.")
+        return EXIT_SETUP
+    for family in ("6G", "7G"):
+        FIRMWARE_PREP.start(family)
+    usbwatch.get_watcher()
+    dfu.native_engine(LIBUSB_DLL if platform.system() == 'Windows' else None)
+
+    name = args.agent_name or f"{socket.gethostname()}-{os.getpid()}"
+    if args.agent_ports:
+        AGENT_PORTS = {path.strip() for path in args.agent_ports.split(',') if path.strip()}
+        msg(f"Agent {name} only uses USB ports {', '.join(sorted(AGENT_PORTS))}")
+    agent = coordinator.Agent(args.agent, name, agent_job, slots=args.max_jobs, log=msg, status=lambda: {
+        'ports': free_ports(), 'firmware': firmware_inventory(), 'failures': failures.COUNTS.snapshot()})
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        print()
+        warn("Agent stopped.")
+    return EXIT_OK
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="iPod nano 6G/7G unbrick tool. Without --model or --job the interactive menu starts.")
+    parser.add_argument('--model', type=str.lower, choices=sorted(HEADLESS_MODELS),
+                        help="run unattended for this model")
+    parser.add_argument('--target', default="auto",
+                        help="disk for ipodscsi (sdb, /dev/sdb, E:) or 'auto' to find the iPod disk")
+    parser.add_argument('--yes', action='store_true',
+                        help="answer yes to the Disk Mode flash and disk confirmation")
+    parser.add_argument('--json', action='store_true',
+                        help="print one JSON result per job on stdout")
+    parser.add_argument('--job', metavar='FILE',
+                        help="JSON job spec: one object or a list (keys: model, target, yes, port, dfu_timeout, usb_timeout, resume)")
+    parser.add_argument('--port', metavar='PATH',
+                        help="only flash the iPod on this USB port path (e.g. 1-1.2, as dfu-util -l shows)")
+    parser.add_argument('--dfu-timeout', type=float, default=60, help="seconds to wait for DFU mode")
+    parser.add_argument('--usb-timeout', type=float, default=30,
+                        help="seconds to wait for each re-enumeration and the disk")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="always start from DFU mode instead of resuming where the iPod is")
+    parser.add_argument('--daemon', action='store_true',
+                        help="stay running and take jobs over a local socket/HTTP API (see daemon.py)")
+    parser.add_argument('--socket', help="UNIX socket for --daemon (default <cache>/leunbrick.sock, '' to disable)")
+    parser.add_argument('--http', type=int, metavar='PORT', help="also serve the job API on 127.0.0.1:PORT (read-only unless LEUNBRICK_DAEMON_TOKEN is set)")
+    parser.add_argument('--max-jobs', type=int, default=4, help="jobs the daemon or agent runs at once")
+    parser.add_argument('--agent', metavar='URL',
+                        help="run as a bench agent of the coordinator at URL (see coordinator.py)")
+    parser.add_argument('--agent-name', help="name this agent reports (default <hostname>-<pid>)")
+    parser.add_argument('--agent-ports', metavar='PATHS',
+                        help="comma-separated USB port paths this agent may use (default all), "
+                             "so several agents can share one machine")
+    parser.add_argument('--update-firmware', action='store_true',
+                        help="update the cached firmware archives (through delta patches where published) and exit")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve Prometheus metrics on http://<host>:PORT/metrics (see metrics.py)")
+    parser.add_argument('--metrics-host', default="127.0.0.1",
+                        help="address for --metrics-port (default 127.0.0.1; 0.0.0.0 for a remote Prometheus)")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="time imports and setup up to the first menu prompt, print the breakdown and exit")
+    parser.add_argument('--trace-summary', nargs='*', metavar='PATH',
+                        help="print p50/p95 per stage over traced sessions (default: the trace directory) and exit")
+    return parser.parse_args(argv)
 
 # ---- Show Credits ----
 def show_credits():
-    os.system('cls' if platform.system() == 'Windows' else 'clear')
+    clear_screen()
     print(f"""{CYAN}========================================={RESET}
 {BOLD}{CYAN}               Credits               {RESET}
 {CYAN}========================================={RESET}
@@ -583,33 +1842,99 @@ Contributions welcome!
 """)
     input("Press ENTER to return to menu...")
 
+# ---- Startup Profile ----
+# Heavy modules that should only be imported once something needs them
+LAZY_MODULES = ("requests", "asyncio", "downloader", "ipsw", "supervise", "daemon", "coordinator",
+                "scsiwrite", "zipfile", "ctypes", "checkpoint", "dfu", "pipeline", "stagetrace", "usbwatch")
+
+def process_age():
+    """Seconds since the interpreter process started (Linux, 10 ms resolution), else None."""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def print_startup_report(age):
+    first, total = STARTUP[0][1], STARTUP[-1][1] - STARTUP[0][1]
+    print(f"\n{BOLD}{'PHASE':<24} {'MS':>8} {'TOTAL':>8}{RESET}")
+    if age is not None:
+        # Interpreter start, site imports and compiling main.py (python3 -m main skips that)
+        print(f"{'before main.py':<24} {(age - total) * 1000:>8.1f} {'':>8}")
+    for (_, previous), (label, at) in zip(STARTUP, STARTUP[1:]):
+        print(f"{label:<24} {(at - previous) * 1000:>8.1f} {(at - first) * 1000:>8.1f}")
+    if age is not None:
+        print(f"{'process start -> prompt':<24} {age * 1000:>8.1f}")
+    # Anything site/.pth files pulled in before main.py started isn't ours to defer
+    deferred = [name for name in LAZY_MODULES if name not in sys.modules]
+    loaded = [name for name in LAZY_MODULES if name in sys.modules and name not in PRELOADED]
+    print(f"Deferred: {', '.join(deferred) or '-'}")
+    if loaded:
+        warn(f"Loaded before the first prompt: {', '.join(loaded)}")
+
 # ---- Main Menu ----
-def main_menu():
+def main_menu(profile=False):
         print_banner()
         print(f"{BOLD}Select an option:{RESET}")
         print("1. Unbrick iPod Nano 6G")
         print("2. Unbrick iPod Nano 7G (2012/2015)")
         print("3. Install Required Files/Packages")
         print("4. Credits")
-        print("5. Quit")
+        print("5. Station Mode (multiple iPods)")
+        print("6. Quit")
         print(f"{CYAN}========================================={RESET}")
+        if profile:
+            startup_mark("menu")
+            print_startup_report(process_age())
+            return
         opt = ask("Choice: ")
 
         if opt == "1":
             USER_CHOICE = "6G"
-            unbrick_6g()
+            traced_session("6G")
         elif opt == "2":
             USER_CHOICE = "7G"
-            unbrick_7g()
+            traced_session("7G")
         elif opt == "3":
             install_required_packages()
         elif opt == "4":
             show_credits()
         elif opt == "5":
-            os.system('cls' if platform.system() == 'Windows' else 'clear')
+            station_mode()
+        elif opt == "6":
+            clear_screen()
             sys.exit(0)
 
 if __name__ == "__main__":
-    if not is_admin():
+    startup_mark("module setup")
+    ARGS = parse_args(sys.argv[1:])
+    startup_mark("parse args")
+    if ARGS.metrics_port is not None:
+        import metrics
+        try:
+            metrics.METRICS.serve(ARGS.metrics_port, ARGS.metrics_host)
+        except OSError as e:
+            err(f"Cannot serve metrics on {ARGS.metrics_host}:{ARGS.metrics_port}: {e}")
+            sys.exit(EXIT_SETUP)
+    if ARGS.trace_summary is not None:
+        trace_summary(ARGS.trace_summary)
+        sys.exit(0)
+    if ARGS.update_firmware:
+        sys.exit(update_firmware())
+    if ARGS.daemon:
+        sys.exit(run_daemon(ARGS))
+    if ARGS.agent:
+        sys.exit(run_agent(ARGS))
+    if ARGS.model or ARGS.job:
+        sys.exit(run_headless(ARGS))
+    if not is_admin() and not ARGS.profile_startup:
         run_as_admin()
-    main_menu()
+    startup_mark("admin check")
+    # Warm the firmware cache/index while the menu is up; MSE waits for a model choice
+    FIRMWARE_PREP.start("6G", include_mse=False)
+    FIRMWARE_PREP.start("7G", include_mse=False)
+    startup_mark("firmware prep start")
+    main_menu(profile=ARGS.profile_startup)
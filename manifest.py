@@ -0,0 +1,133 @@
+"""Startup manifest: resolved tool paths, tool versions and firmware status.
+
+Kept in <cache>/manifest.json so a launch doesn't have to search PATH,
+spawn `dfu-util -V` or re-check firmware that was fine last time:
+
+    {"tools": {"dfu-util": {"path": ..., "stamp": [size, mtime_ns], "version": "dfu-util 0.11",
+                            "candidates": [...]}},
+     "firmware": {"archive:2012": {"stamps": {image: [size, mtime_ns]}, "results": {image: [ok, reason]}}}}
+
+Every entry carries the size and mtime of the files it describes and is
+only trusted while they still match, so validating the manifest costs one
+stat per file and never a process spawn.
+"""
+import json
+import os
+import shutil
+import subprocess
+import threading
+
+import paths
+
+MANIFEST_FILE = os.path.join(paths.CACHE_DIR, "manifest.json")
+VERSION_TIMEOUT = 3
+
+def stamp(path):
+    """[size, mtime_ns] of a file, or None if it isn't there."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+class Manifest:
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = None
+        self.dirty = False
+
+    def _load(self):
+        if self.data is None:
+            try:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+                if not isinstance(self.data, dict):
+                    raise ValueError("not an object")
+            except (OSError, ValueError):
+                self.data = {}
+            self.data.setdefault('tools', {})
+            self.data.setdefault('firmware', {})
+        return self.data
+
+    # ---- Tools ----
+    def resolve(self, name, candidates):
+        """First of `candidates` (paths, or bare names looked up on PATH) that
+        exists. Returns its path or None. A remembered path is only reused
+        for the same candidate list, so a new location is picked up."""
+        candidates = list(candidates)
+        with self.lock:
+            tools = self._load()['tools']
+            entry = tools.get(name)
+            if (entry and entry['path'] and entry.get('candidates') == candidates
+                    and stamp(entry['path']) == entry['stamp']):
+                return entry['path']
+            found = None
+            for candidate in candidates:
+                if os.path.dirname(candidate):
+                    if os.path.isfile(candidate):
+                        found = candidate
+                        break
+                else:
+                    found = shutil.which(candidate)
+                    if found:
+                        break
+            if found:
+                tools[name] = {'path': found, 'stamp': stamp(found), 'version': None,
+                               'candidates': candidates}
+                self.dirty = True
+            return found
+
+    def version(self, name, args=('--version',)):
+        """First output line of `<tool> <args>`, cached until the binary changes."""
+        with self.lock:
+            entry = self._load()['tools'].get(name)
+        if not entry or stamp(entry['path']) != entry['stamp']:
+            return None
+        if entry['version'] is None:
+            try:
+                result = subprocess.run([entry['path'], *args], capture_output=True, text=True,
+                                        timeout=VERSION_TIMEOUT)
+                lines = [line.strip() for line in (result.stdout + result.stderr).splitlines() if line.strip()]
+                version = lines[0] if lines else ""
+            except (OSError, subprocess.TimeoutExpired):
+                version = ""
+            with self.lock:
+                entry['version'] = version
+                self.dirty = True
+        return entry['version'] or None
+
+    # ---- Firmware ----
+    def firmware(self, key):
+        """Cached {image: (ok, reason)} for `key` if none of its images changed, else None."""
+        with self.lock:
+            entry = self._load()['firmware'].get(key)
+        if not entry:
+            return None
+        for image, image_stamp in entry['stamps'].items():
+            if stamp(image) != image_stamp:
+                return None
+        return {image: tuple(result) for image, result in entry['results'].items()}
+
+    def record_firmware(self, key, results):
+        """Remember a fully good result for `key`; anything else is re-checked next time."""
+        stamps = {image: stamp(image) for image in results}
+        with self.lock:
+            firmware = self._load()['firmware']
+            if all(good for good, _ in results.values()) and None not in stamps.values():
+                firmware[key] = {'stamps': stamps, 'results': results}
+            elif key in firmware:
+                del firmware[key]
+            else:
+                return
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                paths.atomic_write(self.path, json.dumps(self.data, indent=1, sort_keys=True))
+                self.dirty = False
+            except OSError:
+                pass
@@ -0,0 +1,195 @@
+"""Prometheus metrics: throughput, stage latency, firmware cache and failures.
+
+Everything is counted in-process in METRICS and rendered in the Prometheus
+text format, published three ways:
+
+  * GET /metrics on the daemon's HTTP port (main.py --daemon --http PORT)
+  * main.py --metrics-port PORT in any mode (menu, station, headless, agent),
+    on 127.0.0.1 unless --metrics-host says otherwise
+  * LEUNBRICK_METRICS_FILE=<dir>/leunbrick.prom: rewritten after every
+    stage, for node_exporter's textfile collector
+
+Series:
+    leunbrick_devices_total{model, result}          iPods finished; ok = Firmware.MSE written
+    leunbrick_devices_last_hour                     ok ones in the past hour
+    leunbrick_stage_seconds{stage, port}            histogram of stage latency
+    leunbrick_stages_total{stage, outcome}          ok / failed / skipped
+    leunbrick_flash_bytes_total{stage, port}        bytes sent by wtf_flash, disk_flash, ipodscsi
+    leunbrick_flash_seconds_total{stage, port}      time spent sending them
+    leunbrick_flash_bytes_per_second{stage, port}   rate of the last transfer
+    leunbrick_firmware_requests_total{source}       manifest / local / cache (no download) or download
+    leunbrick_firmware_cache_hit_ratio              share of those that needed no download
+    leunbrick_download_bytes_total{kind}            full / delta / ipsw
+    leunbrick_flash_failures_total{class, outcome}  seen / retried / recovered / gave_up (failures.py)
+
+rate(leunbrick_flash_bytes_total[10m]) / rate(leunbrick_flash_seconds_total[10m])
+by port is the number that gives a bad cable or a slow hub away.
+"""
+import collections
+import os
+import threading
+import time
+
+import failures
+import paths
+
+STAGE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+FLASH_STAGES = ("wtf_flash", "disk_flash", "ipodscsi")
+HOUR = 3600
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name -> (type, help), in output order
+SERIES = {
+    'leunbrick_devices_total': ("counter", "iPods finished, by model and result (ok = Firmware.MSE written)"),
+    'leunbrick_devices_last_hour': ("gauge", "iPods finished ok in the past hour"),
+    'leunbrick_stage_seconds': ("histogram", "Stage latency"),
+    'leunbrick_stages_total': ("counter", "Stages run, by outcome"),
+    'leunbrick_flash_bytes_total': ("counter", "Bytes sent to iPods by the flash stages"),
+    'leunbrick_flash_seconds_total': ("counter", "Seconds the flash stages spent sending them"),
+    'leunbrick_flash_bytes_per_second': ("gauge", "Throughput of the last transfer"),
+    'leunbrick_firmware_requests_total': ("counter", "Firmware preparations, by where the images came from"),
+    'leunbrick_firmware_cache_hit_ratio': ("gauge", "Share of firmware preparations that needed no download"),
+    'leunbrick_download_bytes_total': ("counter", "Bytes downloaded, by kind"),
+    'leunbrick_flash_failures_total': ("counter", "Flash failures by class and outcome"),
+}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics:
+    def __init__(self, path=os.environ.get('LEUNBRICK_METRICS_FILE')):
+        self.path = path
+        self.lock = threading.Lock()
+        # Stage threads flush concurrently; one at a time, so an older render never replaces a newer one
+        self.flush_lock = threading.Lock()
+        self.values = {}       # (name, ((label, value), ...)) -> number
+        self.histograms = {}   # (name, labels) -> [count per bucket..., sum, count]
+        self.completed = collections.deque()   # monotonic times of ok devices
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(labels.items()))] = value
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            counts = self.histograms.setdefault(key, [0] * len(buckets) + [0.0, 0])
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    # ---- Recording ----
+    def stage(self, stage, port, seconds, outcome, nbytes=None):
+        """A finished (or skipped, seconds None) stage; nbytes for a flash stage that succeeded."""
+        port = port or ""
+        self.inc('leunbrick_stages_total', stage=stage, outcome=outcome)
+        if seconds is not None:
+            self.observe('leunbrick_stage_seconds', seconds, stage=stage, port=port)
+        if stage in FLASH_STAGES and nbytes and seconds:
+            self.inc('leunbrick_flash_bytes_total', nbytes, stage=stage, port=port)
+            self.inc('leunbrick_flash_seconds_total', seconds, stage=stage, port=port)
+            self.set('leunbrick_flash_bytes_per_second', round(nbytes / seconds, 1), stage=stage, port=port)
+        self.flush()
+
+    def device(self, model, result):
+        self.inc('leunbrick_devices_total', model=model, result=result)
+        if result == "ok":
+            with self.lock:
+                self.completed.append(time.monotonic())
+        self.flush()
+
+    def firmware(self, source):
+        """One firmware preparation: "manifest", "local", "cache" or "download"."""
+        self.inc('leunbrick_firmware_requests_total', source=source)
+
+    def download(self, kind, nbytes):
+        if nbytes:
+            self.inc('leunbrick_download_bytes_total', nbytes, kind=kind)
+
+    # ---- Export ----
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        now = time.monotonic()
+        with self.lock:
+            while self.completed and now - self.completed[0] > HOUR:
+                self.completed.popleft()
+            values = dict(self.values)
+            values[('leunbrick_devices_last_hour', ())] = len(self.completed)
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+        requests = {dict(labels)['source']: value for (name, labels), value in values.items()
+                    if name == 'leunbrick_firmware_requests_total'}
+        if requests:
+            hits = sum(value for source, value in requests.items() if source != "download")
+            values[('leunbrick_firmware_cache_hit_ratio', ())] = round(hits / sum(requests.values()), 4)
+        for name, counts in failures.COUNTS.snapshot().items():
+            for outcome, value in counts.items():
+                values[('leunbrick_flash_failures_total', (('class', name), ('outcome', outcome)))] = value
+
+        lines = []
+        for name, (kind, help_text) in SERIES.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "histogram":
+                for (series, labels), counts in sorted(histograms.items()):
+                    if series != name:
+                        continue
+                    for bound, count in zip(STAGE_BUCKETS, counts):
+                        lines.append(f"{name}_bucket{_labels(labels, [('le', _number(float(bound)))])} {count}")
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {counts[-1]}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(round(counts[-2], 4))}")
+                    lines.append(f"{name}_count{_labels(labels)} {counts[-1]}")
+                continue
+            for (series, labels), value in sorted(values.items()):
+                if series == name:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        """Rewrite LEUNBRICK_METRICS_FILE, if set (atomically, so a scrape never sees half a file)."""
+        if not self.path:
+            return
+        with self.flush_lock:
+            try:
+                paths.atomic_write(self.path, self.render())
+            except OSError:
+                pass
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve GET /metrics on a background thread. Returns the server."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0].rstrip('/') != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes every few seconds would drown the console
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+METRICS = Metrics()
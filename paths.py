@@ -0,0 +1,62 @@
+"""Where LeUnBrIck keeps its files, and how it writes them.
+
+Everything it writes between runs (firmware cache, checkpoints, manifest,
+traces, the daemon socket, coordinator results) goes under CACHE_DIR, which
+LEUNBRICK_CACHE can point elsewhere, e.g. at a share used by several benches.
+"""
+import contextlib
+import os
+import tempfile
+import time
+
+CACHE_DIR = os.environ.get(
+    'LEUNBRICK_CACHE', os.path.join(os.path.expanduser("~"), ".cache", "leunbrick"))
+
+def atomic_write(path, text):
+    """Replace `path` with `text` so that readers see the old file or the new
+    one, never half of it. Each write gets its own temp file, so threads and
+    processes writing the same path at once can't clobber each other's."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `<path>.lock` for the duration of the block.
+    It is taken per open file, so it serializes threads of one process as well
+    as every process sharing the directory."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", 'a+') as f:
+        try:
+            import fcntl
+        except ImportError:
+            # Windows: msvcrt.locking gives up after ten one-second tries
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
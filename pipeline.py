@@ -0,0 +1,166 @@
+"""Stage-graph executor behind every unbrick run (see BatchRun in main.py).
+
+A pipeline is a list of Stages, each naming the stages it waits for. A
+stage starts as soon as all of those are done, so independent work -
+fetching firmware, installing a driver, waiting for the iPod to enumerate -
+overlaps on worker threads instead of running back to back.
+
+Stage functions return (ok, detail[, extra record fields]). A stage can
+have a timeout and retries; retry_if(failure), when given, decides whether
+a failed attempt may be repeated (e.g. only while the device is still in
+the mode the stage expects, or only for some failure classes; failure is
+None without classify). classify(detail, extra), when given, names
+each failure (see failures.py): its class caps the retries and sets the
+backoff, and a fatal class isn't retried at all. Raising Stop ends the
+run early without a failure; every stage that hasn't started is skipped
+with its reason.
+
+    run([Stage("prepare", prepare_image),
+         Stage("wait", wait_device),
+         Stage("flash", flash, after=("prepare", "wait"), retries=1)],
+        execute=lambda stage: stage.call())
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class Stop(Exception):
+    """Raised by a stage to end the run early; the message is the skip reason."""
+
+class Stage:
+    def __init__(self, name, fn, *args, after=(), timeout=None, retries=0, retry_delay=1.0,
+                 retry_if=None, classify=None, on_retry=None, **info):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.after = tuple(after)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_if = retry_if
+        # classify(detail, extra) -> object with name, retries and backoff;
+        # on_retry(failure, attempt, delay) runs before each new attempt
+        self.classify = classify
+        self.on_retry = on_retry
+        # Anything else is for the runner (exit code, byte count, ...)
+        self.info = info
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, after={self.after!r})"
+
+    def attempt(self):
+        """One call of fn, bounded by the timeout. Returns (ok, detail, extra)."""
+        if self.timeout is None:
+            return _result(self.fn(*self.args))
+        outcome = {}
+
+        def target():
+            try:
+                outcome['result'] = self.fn(*self.args)
+            except BaseException as e:
+                outcome['error'] = e
+        worker = threading.Thread(target=target, name=f"stage-{self.name}", daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        if worker.is_alive():
+            # A thread can't be killed; whatever it returns later is ignored
+            return False, f"timed out after {self.timeout:g}s", {}
+        if 'error' in outcome:
+            raise outcome['error']
+        return _result(outcome['result'])
+
+    def call(self):
+        """fn with timeout and retries. Returns (ok, detail, extra); extra
+        carries 'attempts' when more than one was made and 'failures' (the
+        class of each failed attempt) when classify is set."""
+        attempts = 0
+        failures = []
+        while True:
+            attempts += 1
+            try:
+                good, detail, extra = self.attempt()
+            except Stop:
+                raise
+            except Exception as e:
+                good, detail, extra = False, f"{type(e).__name__}: {e}", {}
+            if good:
+                break
+            failure = self.classify(detail, extra) if self.classify else None
+            retries, delay = self.retries, self.retry_delay
+            if failure is not None:
+                failures.append(failure.name)
+                # Short backoff, doubling with every attempt
+                retries, delay = min(retries, failure.retries), failure.backoff * 2 ** (attempts - 1)
+            if attempts > retries or (self.retry_if and not self.retry_if(failure)):
+                break
+            if self.on_retry:
+                self.on_retry(failure, attempts, delay)
+            time.sleep(delay)
+        if attempts > 1:
+            extra = dict(extra, attempts=attempts)
+        if failures:
+            extra = dict(extra, failures=failures)
+        return good, detail, extra
+
+def _result(result):
+    good, detail = result[:2]
+    return good, detail, dict(result[2]) if len(result) > 2 else {}
+
+def run(stages, execute, skip=None, on_skip=None):
+    """Run `stages` in dependency order, each through execute(stage) on a
+    worker thread as soon as the stages it waits for are done.
+
+    execute(stage) does the call (stage.call() plus whatever recording the
+    caller wants) and raises to fail the run: nothing new starts after
+    that, and the first exception is re-raised once the stages already
+    running have finished. Stages named in `skip` ({name: reason}) count
+    as done without running; on_skip(stage, reason) is called for them and
+    for every stage left over after a Stop.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        for name in stage.after:
+            if name not in names:
+                raise ValueError(f"stage {stage.name} waits for unknown stage {name}")
+    skip = skip or {}
+    pending, running, done = list(stages), {}, set()
+    failure = stop = None
+    pool = ThreadPoolExecutor(max_workers=max(len(stages), 1), thread_name_prefix="stage")
+    try:
+        while True:
+            started = True
+            while started and failure is None and stop is None:
+                started = False
+                for stage in [stage for stage in pending if all(name in done for name in stage.after)]:
+                    pending.remove(stage)
+                    if stage.name in skip:
+                        if on_skip:
+                            on_skip(stage, skip[stage.name])
+                        done.add(stage.name)
+                        started = True
+                    else:
+                        running[pool.submit(execute, stage)] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                    done.add(stage.name)
+                except Stop as e:
+                    stop = stop or e
+                    done.add(stage.name)
+                except BaseException as e:
+                    failure = failure or e
+    finally:
+        # Normally everything has finished; after Ctrl+C don't wait for stages
+        # that are blocked in a prompt or a tool
+        pool.shutdown(wait=False, cancel_futures=True)
+    if failure is not None:
+        raise failure
+    if pending and stop is None:
+        raise ValueError(f"stages wait on each other: {', '.join(stage.name for stage in pending)}")
+    for stage in pending:
+        if on_skip:
+            on_skip(stage, str(stop))
@@ -0,0 +1,303 @@
+"""In-process Firmware.MSE writer speaking ipodscsi's vendor SCSI commands.
+
+Does what `ipodscsi <disk> ipod6g writefirmware -r -p Firmware.MSE` does,
+through the SG_IO ioctl instead of a separate process, so the longest
+transfer of a session reports progress and per-chunk timing:
+
+    c6 94 <size/1024, BE32>  repartition the firmware partition
+    c6 90                    start a firmware transfer
+    c6 91 00 <n>             write n 4096-byte blocks (data out)
+    1b 00 00 00 02 00        reboot (START STOP UNIT, eject)
+
+The image is mmap'd and sent as slices of the mapping, so no per-chunk
+copies are made. ipodscsi sends 16 blocks (64 KiB) per write; the chunk
+size is configurable up to the 255 blocks the CDB can express.
+
+Backends:
+  SgBackend       - SG_IO on /dev/sdX or /dev/sgN (Linux)
+  EmulatedTarget  - file-backed stand-in that decodes the same CDBs, and
+                    can read the written firmware back for verification
+"""
+import ctypes
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+
+BLOCK_SIZE = 4096
+DEFAULT_CHUNK_BLOCKS = 16
+MAX_CHUNK_BLOCKS = 255
+
+# Per-command timeouts in ms, same as ipodscsi
+REPARTITION_TIMEOUT = 60000
+INIT_TIMEOUT = 1000
+WRITE_TIMEOUT = 5000
+REBOOT_TIMEOUT = 10000
+
+# ---- SG_IO constants ----
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_TO_DEV = -2
+SG_DXFER_FROM_DEV = -3
+SG_INFO_OK_MASK = 0x1
+SENSE_LEN = 32
+# Fixed-format sense 03/0c/00: medium error, write error
+WRITE_ERROR_SENSE = bytes([0x70, 0, 0x03] + [0] * 9 + [0x0C, 0x00])
+
+class ScsiError(Exception):
+    pass
+
+def repartition_cdb(size):
+    return bytes([0xC6, 0x94]) + struct.pack('>I', size // BLOCK_SIZE * 4)
+
+def init_cdb():
+    return bytes([0xC6, 0x90, 0, 0, 0, 0])
+
+def write_cdb(blocks):
+    if not 0 < blocks <= MAX_CHUNK_BLOCKS:
+        raise ValueError(f"bad write length {blocks} blocks")
+    return bytes([0xC6, 0x91, 0, blocks, 0, 0])
+
+def reboot_cdb():
+    return bytes([0x1B, 0, 0, 0, 0x02, 0])
+
+def describe_sense(sense):
+    """"sense KK/AA/QQ" for fixed or descriptor format sense data."""
+    if len(sense) >= 14 and sense[0] & 0x7F in (0x70, 0x71):
+        return f"sense {sense[2] & 0x0F:02x}/{sense[12]:02x}/{sense[13]:02x}"
+    if len(sense) >= 4 and sense[0] & 0x7F in (0x72, 0x73):
+        return f"sense {sense[1] & 0x0F:02x}/{sense[2]:02x}/{sense[3]:02x}"
+    return "no sense data"
+
+# ---- Backends ----
+class SgIoHdr(ctypes.Structure):
+    """struct sg_io_hdr from <scsi/sg.h>."""
+    _fields_ = [
+        ('interface_id', ctypes.c_int),
+        ('dxfer_direction', ctypes.c_int),
+        ('cmd_len', ctypes.c_ubyte),
+        ('mx_sb_len', ctypes.c_ubyte),
+        ('iovec_count', ctypes.c_ushort),
+        ('dxfer_len', ctypes.c_uint),
+        ('dxferp', ctypes.c_void_p),
+        ('cmdp', ctypes.c_void_p),
+        ('sbp', ctypes.c_void_p),
+        ('timeout', ctypes.c_uint),
+        ('flags', ctypes.c_uint),
+        ('pack_id', ctypes.c_int),
+        ('usr_ptr', ctypes.c_void_p),
+        ('status', ctypes.c_ubyte),
+        ('masked_status', ctypes.c_ubyte),
+        ('msg_status', ctypes.c_ubyte),
+        ('sb_len_wr', ctypes.c_ubyte),
+        ('host_status', ctypes.c_ushort),
+        ('driver_status', ctypes.c_ushort),
+        ('resid', ctypes.c_int),
+        ('duration', ctypes.c_uint),
+        ('info', ctypes.c_uint),
+    ]
+
+def buffer_address(view):
+    """Address of a writable buffer (bytearray, mmap or a memoryview of one)."""
+    view = memoryview(view)
+    if view.readonly:
+        raise ScsiError("data buffer must be writable for SG_IO")
+    return ctypes.addressof(ctypes.c_char.from_buffer(view)) if len(view) else None
+
+class SgBackend:
+    """SCSI commands through the SG_IO ioctl on one open device node."""
+
+    def __init__(self, path):
+        import fcntl
+        self.fcntl = fcntl
+        self.path = path
+        try:
+            self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        except OSError as e:
+            raise ScsiError(f"cannot open {path}: {e.strerror}")
+
+    def command(self, cdb, data=None, direction=SG_DXFER_NONE, timeout=WRITE_TIMEOUT):
+        cdb_buf = ctypes.create_string_buffer(bytes(cdb), len(cdb))
+        sense = ctypes.create_string_buffer(SENSE_LEN)
+        hdr = SgIoHdr(interface_id=ord('S'), dxfer_direction=direction, cmd_len=len(cdb),
+                      mx_sb_len=SENSE_LEN, cmdp=ctypes.addressof(cdb_buf),
+                      sbp=ctypes.addressof(sense), timeout=timeout)
+        if data is not None and len(data):
+            hdr.dxfer_len = len(data)
+            hdr.dxferp = buffer_address(data)
+        try:
+            self.fcntl.ioctl(self.fd, SG_IO, hdr)
+        except OSError as e:
+            raise ScsiError(f"SG_IO ioctl error on {self.path}: {e.strerror}")
+        if (hdr.info & SG_INFO_OK_MASK) or hdr.status or hdr.host_status or hdr.driver_status:
+            raise ScsiError(f"command {cdb[0]:02x}/{cdb[1]:02x} failed: status {hdr.status:#x}, "
+                            f"host {hdr.host_status:#x}, driver {hdr.driver_status:#x}, "
+                            f"{describe_sense(sense.raw[:hdr.sb_len_wr])}")
+        return len(data) - hdr.resid if data is not None else 0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class EmulatedTarget:
+    """An iPod in Disk Mode whose firmware partition is a plain file.
+
+    Decodes the CDBs exactly as sent, so it checks the writer's encoding
+    too. latency adds seconds per write command, fail_at_chunk makes that
+    write (1-based) fail with a medium error.
+    """
+
+    def __init__(self, path, latency=0.0, fail_at_chunk=None):
+        self.path = path
+        self.latency = latency
+        self.fail_at_chunk = fail_at_chunk
+        self.partition_size = None
+        self.offset = None
+        self.writes = 0
+        self.rebooted = False
+        self.commands = []
+
+    def command(self, cdb, data=None, direction=SG_DXFER_NONE, timeout=WRITE_TIMEOUT):
+        cdb = bytes(cdb)
+        self.commands.append(cdb)
+        if self.rebooted:
+            raise ScsiError("SG_IO ioctl error: device rebooted")
+        if cdb[:2] == b'\xc6\x94':
+            self.partition_size = struct.unpack('>I', cdb[2:6])[0] * 1024
+            with open(self.path, 'wb') as f:
+                f.truncate(self.partition_size)
+            return 0
+        if cdb[:2] == b'\xc6\x90':
+            self.offset = 0
+            return 0
+        if cdb[:2] == b'\xc6\x91':
+            if self.offset is None or direction != SG_DXFER_TO_DEV:
+                raise ScsiError("write without a transfer init")
+            length = cdb[3] * BLOCK_SIZE
+            if data is None or len(data) != length:
+                raise ScsiError(f"write of {cdb[3]} blocks carried {len(data or b'')} bytes")
+            self.writes += 1
+            if self.fail_at_chunk == self.writes:
+                raise ScsiError(f"command c6/91 failed: status 0x2, {describe_sense(WRITE_ERROR_SENSE)}")
+            if self.partition_size is not None and self.offset + length > self.partition_size:
+                raise ScsiError("write past the end of the firmware partition")
+            if self.latency:
+                time.sleep(self.latency)
+            with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+                f.seek(self.offset)
+                f.write(data)
+            self.offset += length
+            return length
+        if cdb[0] == 0x1B:
+            self.rebooted = True
+            return 0
+        raise ScsiError(f"unsupported command {cdb.hex()}")
+
+    def read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def close(self):
+        pass
+
+def open_target(drive):
+    """Backend for `drive`: a regular file is an emulated target, anything else SG_IO."""
+    if os.path.isfile(drive):
+        return EmulatedTarget(drive)
+    return SgBackend(drive)
+
+# ---- Writer ----
+class MseWriter:
+    """Writes Firmware.MSE images in chunks of `chunk_blocks` 4096-byte blocks."""
+
+    def __init__(self, backend, chunk_blocks=DEFAULT_CHUNK_BLOCKS):
+        if not 0 < chunk_blocks <= MAX_CHUNK_BLOCKS:
+            raise ValueError(f"chunk size must be 1-{MAX_CHUNK_BLOCKS} blocks")
+        self.backend = backend
+        self.chunk_blocks = chunk_blocks
+
+    def write(self, payload, repartition=True, reboot=True, verify=False, progress=None, status=None):
+        """Send `payload` (a writable buffer) the way writefirmware -r -p does.
+
+        progress(sent, total, chunk_seconds) is called after every chunk and
+        status(text) before every step. verify reads the image back in
+        chunks and compares SHA-256; backends that can't read back report
+        'verified': None. Returns a stats dict.
+        """
+        view = payload if isinstance(payload, memoryview) else memoryview(payload)
+        total = len(view)
+        if total == 0 or total % BLOCK_SIZE:
+            raise ScsiError("MSE file size must be a multiple of 4096")
+        status = status or (lambda _text: None)
+        stats = {'bytes': 0, 'chunks': 0, 'chunk_times': [], 'verified': None}
+        digest = hashlib.sha256()
+        started = time.monotonic()
+        if repartition:
+            status("Repartitioning...")
+            self.backend.command(repartition_cdb(total), timeout=REPARTITION_TIMEOUT)
+        status("Initiating firmware transfer...")
+        self.backend.command(init_cdb(), timeout=INIT_TIMEOUT)
+
+        status("Writing firmware...")
+        chunk_size = self.chunk_blocks * BLOCK_SIZE
+        for offset in range(0, total, chunk_size):
+            # Released right away, even on error, so the caller can unmap the image
+            with view[offset:offset + chunk_size] as chunk:
+                chunk_started = time.monotonic()
+                self.backend.command(write_cdb(len(chunk) // BLOCK_SIZE), chunk, SG_DXFER_TO_DEV,
+                                     WRITE_TIMEOUT)
+                elapsed = time.monotonic() - chunk_started
+                digest.update(chunk)
+                length = len(chunk)
+            stats['bytes'] += length
+            stats['chunks'] += 1
+            stats['chunk_times'].append(elapsed)
+            if progress:
+                progress(stats['bytes'], total, elapsed)
+        stats['sha256'] = digest.hexdigest()
+
+        if verify and hasattr(self.backend, 'read'):
+            status("Verifying firmware...")
+            readback = hashlib.sha256()
+            for offset in range(0, total, chunk_size):
+                readback.update(self.backend.read(offset, min(chunk_size, total - offset)))
+            stats['verified'] = readback.hexdigest() == stats['sha256']
+            if not stats['verified']:
+                raise ScsiError("readback does not match Firmware.MSE")
+        if reboot:
+            status("Rebooting device...")
+            self.backend.command(reboot_cdb(), timeout=REBOOT_TIMEOUT)
+        stats['seconds'] = time.monotonic() - started
+        return stats
+
+    def write_file(self, path, **kwargs):
+        """Write an image file through a private (copy-on-write) mmap of it."""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ScsiError("MSE file size must be a multiple of 4096")
+            # ACCESS_COPY because SG_IO needs a writable buffer; nothing is copied unless written
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        try:
+            with memoryview(mapped) as view:
+                return self.write(view, **kwargs)
+        finally:
+            mapped.close()
+
+def native_available():
+    """SG_IO is Linux-only; LEUNBRICK_SCSI=ipodscsi forces the binary."""
+    return os.environ.get('LEUNBRICK_SCSI') != 'ipodscsi' and sys.platform.startswith('linux')
+
+def native_writer(drive, chunk_blocks=None):
+    """MseWriter for `drive`, or None where the ipodscsi binary has to be used."""
+    if os.environ.get('LEUNBRICK_SCSI') == 'ipodscsi':
+        return None
+    if not os.path.isfile(drive) and not native_available():
+        return None
+    if chunk_blocks is None:
+        chunk_kib = os.environ.get('LEUNBRICK_SCSI_CHUNK_KIB', '')
+        chunk_blocks = int(chunk_kib) // 4 if chunk_kib.isdigit() else DEFAULT_CHUNK_BLOCKS
+    return MseWriter(open_target(drive), max(1, min(chunk_blocks, MAX_CHUNK_BLOCKS)))
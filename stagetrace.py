@@ -0,0 +1,172 @@
+"""Per-stage timing traces for unbrick sessions.
+
+Every session appends JSON lines to its own file under the trace directory
+(LEUNBRICK_TRACE_DIR, default <cache>/traces; LEUNBRICK_TRACE=0 turns
+tracing off):
+
+    {"event": "session", "session": ..., "model": "7G", "port": "1-1.2", "started_at": <unix time>}
+    {"event": "stage", "stage": "wtf_flash", "start": 12.031, "end": 14.377, "seconds": 2.346,
+     "outcome": "ok", "bytes": 1048576, "detail": "..."}
+    {"event": "end", "outcome": "ok", "port": "1-1.2", "seconds": 74.2}
+
+A session that only finds its iPod after the first stage (any free port)
+has "port": null in its header; its later stages and the end record carry
+the port it was found on.
+
+start/end are monotonic seconds since the session started. The summary
+aggregates any number of trace files into p50/p95 per stage:
+
+    python3 stagetrace.py summary [trace dir or files...]
+"""
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import paths
+
+TRACE_DIR = os.environ.get('LEUNBRICK_TRACE_DIR', os.path.join(paths.CACHE_DIR, "traces"))
+ENABLED = os.environ.get('LEUNBRICK_TRACE', '1') != '0'
+
+class Tracer:
+    """Appends one session's stage records to its JSON-lines file."""
+
+    def __init__(self, model, port=None, trace_dir=None, enabled=None):
+        self.model = model
+        self.port = port
+        self.session = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.enabled = ENABLED if enabled is None else enabled
+        self.dir = trace_dir or TRACE_DIR
+        self.path = os.path.join(self.dir, f"{self.session}-{model}.jsonl")
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.stages = []
+        self.file = None
+        self.closed = False
+
+    def _write(self, record):
+        if not self.enabled:
+            return
+        with self.lock:
+            try:
+                if self.file is None:
+                    os.makedirs(self.dir, exist_ok=True)
+                    self.file = open(self.path, 'a')
+                    self.file.write(json.dumps({
+                        'event': "session", 'session': self.session, 'model': self.model,
+                        'port': self.port, 'started_at': time.time() - (time.monotonic() - self.started),
+                    }) + "\n")
+                self.file.write(json.dumps(record) + "\n")
+                # Flushed per line so a crashed or killed session still leaves its trace
+                self.file.flush()
+            except OSError:
+                self.enabled = False
+
+    def record(self, stage, start, end, outcome, detail=None, nbytes=None, failures=None):
+        """Record a stage that was timed elsewhere (monotonic start/end)."""
+        entry = {'event': "stage", 'stage': stage, 'start': round(start - self.started, 4),
+                 'end': round(end - self.started, 4), 'seconds': round(end - start, 4),
+                 'outcome': outcome}
+        if nbytes is not None:
+            entry['bytes'] = nbytes
+        if failures:
+            entry['failures'] = failures
+        if detail is not None:
+            entry['detail'] = detail if isinstance(detail, (str, int, float)) else str(detail)
+        if self.port:
+            entry['port'] = self.port
+        self.stages.append(entry)
+        self._write(entry)
+        return entry
+
+    def close(self, outcome=None):
+        """Write the end record. Without `outcome`, it is the last non-ok stage's."""
+        if self.closed:
+            return
+        if outcome is None:
+            failed = [stage['outcome'] for stage in self.stages if stage['outcome'] != "ok"]
+            outcome = failed[-1] if failed else "ok"
+        self.closed = True
+        self._write({'event': "end", 'outcome': outcome, 'port': self.port,
+                     'seconds': round(time.monotonic() - self.started, 4)})
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+# ---- Summary ----
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+def trace_files(paths):
+    files = []
+    for path in paths or [TRACE_DIR]:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.jsonl")))
+        else:
+            files.append(path)
+    return files
+
+def load(files):
+    """Yield every record of the given trace files, skipping torn lines."""
+    for path in files:
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+
+def summarize(records):
+    """{stage: {count, failed, p50, p95, max, mib_per_s}} plus a 'session' row for totals."""
+    durations, failures, rates = {}, {}, {}
+    for record in records:
+        if record.get('event') == "stage":
+            name = record['stage']
+        elif record.get('event') == "end":
+            name = "session"
+        else:
+            continue
+        durations.setdefault(name, []).append(record['seconds'])
+        if record.get('outcome') != "ok":
+            failures[name] = failures.get(name, 0) + 1
+        if record.get('bytes') and record['seconds'] > 0 and record.get('outcome') == "ok":
+            rates.setdefault(name, []).append(record['bytes'] / record['seconds'] / (1 << 20))
+    summary = {}
+    for name, values in durations.items():
+        summary[name] = {
+            'count': len(values), 'failed': failures.get(name, 0),
+            'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values),
+            'mib_per_s': percentile(rates[name], 50) if name in rates else None,
+        }
+    return summary
+
+def print_summary(summary, out=sys.stdout):
+    if not summary:
+        print("No traced sessions found.", file=out)
+        return
+    print(f"{'STAGE':<20} {'N':>5} {'FAIL':>5} {'P50':>9} {'P95':>9} {'MAX':>9} {'MiB/s':>7}", file=out)
+    # Slowest first: that is what to tune
+    for name, row in sorted(summary.items(), key=lambda item: (item[0] == "session", -item[1]['p50'])):
+        rate = f"{row['mib_per_s']:7.2f}" if row['mib_per_s'] is not None else f"{'-':>7}"
+        print(f"{name:<20} {row['count']:>5} {row['failed']:>5} {row['p50']:>8.2f}s "
+              f"{row['p95']:>8.2f}s {row['max']:>8.2f}s {rate}", file=out)
+
+def main(argv):
+    if argv and argv[0] == 'summary':
+        print_summary(summarize(load(trace_files(argv[1:]))))
+        return 0
+    print("Usage: stagetrace.py summary [trace dir or files...]")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
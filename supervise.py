@@ -0,0 +1,170 @@
+"""Streaming supervision of external tools (dfu-util, ipodscsi, ...).
+
+stdout and stderr are read as the tool writes them (split on both \\n and
+\\r, since dfu-util redraws its progress bar with \\r). Each line is
+checked for percent progress and for known fatal messages. A fatal line
+kills the tool at once instead of waiting for it to exit. A tool that
+prints nothing for `stall_timeout` seconds, or runs past `timeout`, is
+killed too.
+
+All supervised processes run on one shared asyncio loop in a background
+thread, so any number of concurrent flashes cost no extra threads:
+
+    result = await supervise(cmd, fatal=DFU_FATAL)          # from a coroutine
+    future = get_supervisor().submit(cmd, fatal=DFU_FATAL)  # from any thread
+    result = run_tool(cmd, fatal=DFU_FATAL)                 # blocking
+"""
+import asyncio
+import re
+import threading
+
+PERCENT_RE = re.compile(r'(\d{1,3})%')
+
+# dfu-util messages after which the transfer can't succeed. LIBUSB_ERROR_NO_DEVICE
+# is not here: the iPod resets itself away right after "Download done."
+DFU_FATAL = [re.compile(pattern) for pattern in (
+    r"No DFU capable USB device available",
+    r"Cannot open (DFU )?device",
+    r"Cannot claim interface",
+    r"Cannot set alternate interface",
+    r"unable to initialize libusb",
+    r"USB communication error",
+    r"Status is not OK",
+    r"Error during download",
+    r"does not match device",
+    r"LIBUSB_ERROR_(PIPE|TIMEOUT|IO|ACCESS|BUSY|OVERFLOW|NOT_SUPPORTED)",
+)]
+
+# ipodscsi (freemyipod) error messages
+IPODSCSI_FATAL = [re.compile(pattern) for pattern in (
+    r"is not a SCSI-generic device",
+    r"error opening given file name",
+    r"Error while (opening|getting) MSE file",
+    r"MSE file size must be a multiple of 4096",
+    r"Error reading from MSE file",
+    r"SG_IO ioctl error",
+    r"Not enough arguments|Unknown command|Unknown option|No MSE file name",
+)]
+
+class ToolResult:
+    """Outcome of one supervised run.
+
+    reason is None for a normal exit, else "fatal: <line>", "stalled",
+    "timeout" or "cannot run: <error>"; returncode is None if the tool
+    never started.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.returncode = None
+        self.lines = []
+        self.reason = None
+        self.percent = None
+        self.seconds = 0.0
+
+    @property
+    def output(self):
+        return "\n".join(self.lines)
+
+    @property
+    def killed(self):
+        return self.reason is not None and self.returncode is not None
+
+    def __repr__(self):
+        return f"ToolResult(returncode={self.returncode}, reason={self.reason!r}, lines={len(self.lines)})"
+
+async def supervise(cmd, fatal=(), stall_timeout=None, timeout=None, on_line=None, on_progress=None):
+    """Run `cmd`, watching its output as it is produced. Returns a ToolResult.
+
+    on_line(line) sees every output line; on_progress(percent, line) every
+    line with a percentage. Both run on the event loop, so keep them short.
+    """
+    result = ToolResult(cmd)
+    loop = asyncio.get_running_loop()
+    started = last_output = loop.time()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        result.reason = f"cannot run: {e}"
+        return result
+
+    def kill(reason):
+        if result.reason is None:
+            result.reason = reason
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    def handle(raw):
+        line = raw.decode(errors='replace').rstrip()
+        if not line:
+            return
+        result.lines.append(line)
+        if on_line:
+            on_line(line)
+        match = PERCENT_RE.search(line)
+        if match and int(match.group(1)) <= 100:
+            result.percent = int(match.group(1))
+            if on_progress:
+                on_progress(result.percent, line)
+        for pattern in fatal:
+            if pattern.search(line):
+                kill(f"fatal: {line.strip()}")
+                break
+
+    async def pump(stream):
+        nonlocal last_output
+        pending = b''
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                break
+            last_output = loop.time()
+            pending += chunk
+            *lines, pending = re.split(rb'[\r\n]', pending)
+            for line in lines:
+                handle(line)
+        handle(pending)
+
+    readers = asyncio.ensure_future(asyncio.gather(pump(proc.stdout), pump(proc.stderr)))
+    while not readers.done():
+        await asyncio.wait([readers], timeout=0.25)
+        now = loop.time()
+        if timeout is not None and now - started > timeout:
+            kill("timeout")
+        elif stall_timeout is not None and now - last_output > stall_timeout:
+            kill("stalled")
+    result.returncode = await proc.wait()
+    result.seconds = loop.time() - started
+    return result
+
+class Supervisor:
+    """One asyncio loop in a daemon thread that all supervised tools share."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="supervisor", daemon=True)
+        self.thread.start()
+
+    def submit(self, cmd, **kwargs):
+        """Start supervising `cmd`; returns a concurrent.futures.Future of its ToolResult."""
+        return asyncio.run_coroutine_threadsafe(supervise(cmd, **kwargs), self.loop)
+
+    def run(self, cmd, **kwargs):
+        return self.submit(cmd, **kwargs).result()
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def get_supervisor():
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+        return _supervisor
+
+def run_tool(cmd, **kwargs):
+    """Blocking supervise() for code running in ordinary threads."""
+    return get_supervisor().run(cmd, **kwargs)
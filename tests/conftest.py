@@ -0,0 +1,103 @@
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FileServer:
+    """Serves `files` ({path: bytes}) over HTTP with Range, If-Range and ETag
+    support, like the release hosts firmware comes from.
+
+    head_length False leaves Content-Length out of HEAD replies (chunked
+    servers); cut_after[path] = n makes the next full GET of that path stop
+    after n bytes, as a dropped connection would; slow sends bodies in 64 KiB
+    pieces that many seconds apart.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.etags = {}
+        self.head_length = True
+        self.cut_after = {}
+        self.slow = 0
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.reply(head=True)
+
+            def do_GET(self):
+                self.reply(head=False)
+
+            def reply(self, head):
+                server.requests.append((self.command, self.path, self.headers.get('Range')))
+                data = server.files.get(self.path)
+                if data is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', "0")
+                    self.end_headers()
+                    return
+                etag = server.etags.get(self.path, '"v1"')
+                start, end, status = 0, len(data), 200
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get('Range') or "")
+                if match and self.headers.get('If-Range', etag) == etag:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)) + 1, len(data)) if match.group(2) else len(data)
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f"bytes */{len(data)}")
+                        self.send_header('Content-Length', "0")
+                        self.end_headers()
+                        return
+                    status = 206
+                self.send_response(status)
+                self.send_header('Accept-Ranges', "bytes")
+                self.send_header('ETag', etag)
+                if status == 206:
+                    self.send_header('Content-Range', f"bytes {start}-{end - 1}/{len(data)}")
+                if head:
+                    if server.head_length:
+                        self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    return
+                body = data[start:end]
+                self.send_header('Content-Length', str(len(body)))
+                cut = server.cut_after.pop(self.path, None) if status == 200 else None
+                if cut is not None:
+                    self.send_header('Connection', "close")
+                    self.close_connection = True
+                    body = body[:cut]
+                self.end_headers()
+                for start in range(0, len(body), 1 << 16):
+                    if server.slow:
+                        time.sleep(server.slow)
+                    self.wfile.write(body[start:start + (1 << 16)])
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    yield server
+    server.close()
@@ -0,0 +1,55 @@
+"""Bundle build and read-back: deduplication, alignment and zero-copy views."""
+import hashlib
+import os
+
+import pytest
+
+import bundle
+
+@pytest.fixture
+def images(tmp_path):
+    root = tmp_path / "firmwares"
+    wtf = os.urandom(10000)
+    contents = {"2012/WTF.x1249.RELEASE.dfu": wtf, "2015/WTF.x124a.RELEASE.dfu": wtf,
+                "2015/Firmware.MSE": os.urandom(70000), "2015/readme.txt": b"not an image"}
+    for name, data in contents.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_bytes(data)
+    return str(root), {name: data for name, data in contents.items() if not name.endswith(".txt")}
+
+def test_identical_images_are_stored_once_on_4k_boundaries(tmp_path, images):
+    root, contents = images
+    path = str(tmp_path / "firmwares.lub")
+    assert bundle.build(path, bundle.collect(root)) == (3, 2)
+    with bundle.Bundle(path) as packed:
+        assert packed.names() == sorted(contents)
+        assert packed.info("2012/WTF.x1249.RELEASE.dfu") is packed.info("2015/WTF.x124a.RELEASE.dfu")
+        assert all(blob['offset'] % bundle.ALIGN == 0 for blob in packed.blobs)
+
+def test_views_are_the_original_bytes(tmp_path, images):
+    root, contents = images
+    path = str(tmp_path / "firmwares.lub")
+    bundle.build(path, bundle.collect(root))
+    with bundle.Bundle(path) as packed:
+        for name, data in contents.items():
+            view = packed.view(name)
+            try:
+                assert view.readonly and view == data
+                assert packed.sha256(name) == hashlib.sha256(data).hexdigest()
+            finally:
+                view.release()
+            assert packed.verify(name)
+        packed.extract("2015/Firmware.MSE", str(tmp_path / "out" / "Firmware.MSE"))
+    assert (tmp_path / "out" / "Firmware.MSE").read_bytes() == contents["2015/Firmware.MSE"]
+
+def test_damaged_bundles_are_refused(tmp_path, images):
+    root, _ = images
+    path = tmp_path / "firmwares.lub"
+    bundle.build(str(path), bundle.collect(root))
+    data = path.read_bytes()
+    path.write_bytes(data[:-100])
+    with pytest.raises(bundle.BundleError, match="truncated"):
+        bundle.Bundle(str(path))
+    path.write_bytes(b"PK" + data[2:])
+    with pytest.raises(bundle.BundleError, match="not a firmware bundle"):
+        bundle.Bundle(str(path))
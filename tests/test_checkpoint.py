@@ -0,0 +1,58 @@
+"""Checkpoints shared between sessions, and where probe_device lets a session resume."""
+import threading
+
+import pytest
+
+import checkpoint
+import main
+
+def test_sessions_with_their_own_store_keep_each_others_marks(tmp_path):
+    path = str(tmp_path / "checkpoints.json")
+    stores = [checkpoint.Checkpoints(path) for _ in range(2)]
+
+    def mark(store, index):
+        for n in range(40):
+            store.mark("7G", f"{index}-{n}", "wtf", "2015")
+    threads = [threading.Thread(target=mark, args=(store, index)) for index, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(checkpoint.Checkpoints(path).entries("7G")) == 80
+
+def test_dfu_checkpoint_forgets_the_variant(tmp_path):
+    store = checkpoint.Checkpoints(str(tmp_path / "checkpoints.json"))
+    store.mark("7G", "1-1", "disk_mode", "2012")
+    assert store.get("7G", "1-1")['variant'] == "2012"
+    store.mark("7G", "1-1", "dfu")
+    assert 'variant' not in store.get("7G", "1-1")
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    """main's resume probe with no DFU/WTF device on the bus and one iPod disk on every port."""
+    store = checkpoint.Checkpoints(str(tmp_path / "checkpoints.json"))
+    monkeypatch.setattr(main, 'CHECKPOINTS', store)
+    monkeypatch.setattr(main, 'find_device', lambda candidates, port=None, owner=None: None)
+    monkeypatch.setattr(main, 'ipod_disks', lambda port=None, timeout=30: [f"/dev/sd-{port}"])
+    monkeypatch.setattr(main, 'PORT_CLAIMS', {})
+    return store
+
+def test_disk_mode_checkpoint_resumes_at_the_disk(bench):
+    bench.mark("7G", "1-1", "disk_mode", "2015")
+    point = main.probe_device("7G")
+    assert (point['mode'], point['port'], point['disk'], point['variant']) == ("disk", "1-1", "/dev/sd-1-1", "2015")
+
+@pytest.mark.parametrize("stage", ["wtf", "done"])
+def test_disk_without_a_disk_mode_checkpoint_is_left_alone(bench, stage):
+    # A finished (or never flashed) iPod's disk looks just like Disk Mode
+    bench.mark("7G", "1-1", stage, "2015")
+    assert main.probe_device("7G") is None
+
+def test_stale_or_claimed_checkpoint_is_not_resumed(bench, monkeypatch):
+    bench.mark("7G", "1-1", "disk_mode", "2015")
+    main.PORT_CLAIMS["1-1"] = object()
+    assert main.probe_device("7G") is None
+    main.PORT_CLAIMS.clear()
+    # Stale: some earlier iPod on the port
+    monkeypatch.setattr(checkpoint, 'MAX_AGE', -1)
+    assert main.probe_device("7G") is None
@@ -0,0 +1,144 @@
+"""Coordinator scheduling, and two agents sharing one machine through --agent-ports."""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import benchmark
+import coordinator
+import daemon
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRMWARE = {'7g': {'Firmware.MSE': "0" * 64}}
+
+@pytest.fixture
+def hub(tmp_path):
+    return coordinator.Coordinator(str(tmp_path / "results.jsonl"), token=None)
+
+def placed(*jobs):
+    return [(job.state, job.agent) for job in jobs]
+
+def test_job_waits_for_a_busy_bench_that_has_the_images(hub):
+    hub.check_in("cached", {'slots': 1, 'firmware': FIRMWARE})
+    hub.check_in("empty", {'slots': 4})
+    first, second = hub.submit({'model': "7g"}), hub.submit({'model': "7g"})
+    assert placed(first, second) == [("assigned", "cached"), ("queued", None)]
+
+    hub.check_in("cached", {'slots': 1, 'firmware': FIRMWARE, 'running': {str(first.id): "wtf_flash"}})
+    assert placed(second) == [("queued", None)]
+    hub.check_in("cached", {'slots': 1, 'firmware': FIRMWARE,
+                            'results': [{'job': first.id, 'record': {'exit_code': 0}}]})
+    assert first.state == "done"
+    assert placed(second) == [("running", "cached")]
+
+def test_uncached_bench_only_when_no_live_bench_has_the_images(hub, monkeypatch):
+    monkeypatch.setattr(coordinator, 'AGENT_TIMEOUT', 0.2)
+    hub.check_in("cached", {'slots': 1, 'firmware': FIRMWARE})
+    hub.check_in("empty", {'slots': 1})
+    time.sleep(0.3)
+    # "cached" has gone silent, so only "empty" is alive
+    hub.check_in("empty", {'slots': 1})
+    assert placed(hub.submit({'model': "7g"})) == [("assigned", "empty")]
+
+def test_model_nobody_has_goes_to_any_bench_with_room(hub):
+    hub.check_in("a", {'slots': 1, 'firmware': FIRMWARE})
+    hub.check_in("b", {'slots': 1, 'firmware': FIRMWARE})
+    first, second = hub.submit({'model': "6g"}), hub.submit({'model': "6g"})
+    assert sorted(job.agent for job in (first, second)) == ["a", "b"]
+
+def test_bench_with_the_ipod_attached_wins(hub):
+    hub.check_in("a", {'slots': 2, 'firmware': FIRMWARE})
+    hub.check_in("b", {'slots': 2, 'firmware': FIRMWARE, 'ports': {"1-2": "7g"}})
+    assert placed(hub.submit({'model': "7g"})) == [("assigned", "b")]
+    assert placed(hub.submit({'model': "7g", 'port': "1-1"})) == [("assigned", "a")]
+
+def test_job_pinned_to_an_agent_waits_for_it(hub):
+    hub.check_in("a", {'slots': 1, 'firmware': FIRMWARE})
+    assert placed(hub.submit({'model': "7g", 'agent': "b"})) == [("queued", None)]
+def test_only_the_last_finished_jobs_are_kept(hub, tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, 'KEEP_FINISHED', 2)
+    hub.check_in("a", {'slots': 1, 'firmware': FIRMWARE})
+    jobs = [hub.submit({'model': "7g"}) for _ in range(4)]
+    for job in jobs:
+        hub.check_in("a", {'slots': 1, 'firmware': FIRMWARE,
+                           'results': [{'job': job.id, 'record': {'exit_code': 0}}]})
+    assert sorted(hub.jobs) == [jobs[2].id, jobs[3].id]
+    assert len((tmp_path / "results.jsonl").read_text().splitlines()) == 4
+
+def test_serve_needs_a_token_to_listen_beyond_loopback(monkeypatch):
+    monkeypatch.setattr(coordinator, 'TOKEN', None)
+    assert coordinator.main(["serve", "--host", "0.0.0.0"]) == 2
+    assert [coordinator.loopback(host) for host in ("127.0.0.1", "::1", "::ffff:127.0.0.1", "localhost")] == [True] * 4
+    assert [coordinator.loopback(host) for host in ("0.0.0.0", "192.168.1.20", "bench1", None)] == [False] * 4
+
+# ---- Two local agents ----
+def free_tcp_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until(check, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.2)
+    raise AssertionError("timed out")
+
+@pytest.fixture
+def bench_env(tmp_path):
+    """Environment for main.py with the benchmark's simulated iPod on port 1-1."""
+    saved = dict(os.environ)
+    try:
+        bench = benchmark.Bench(str(tmp_path / "bench"), dict(benchmark.DEFAULT_CONFIG, scale=0.1))
+        bench.setup()
+        bench.reset(benchmark.SCENARIOS["7g-2012"])
+        yield dict(os.environ)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() != 0, reason="agents must run as root")
+def test_two_agents_on_one_machine_split_the_ports(bench_env, tmp_path):
+    url = f"http://127.0.0.1:{free_tcp_port()}"
+    env = dict(bench_env, LEUNBRICK_COORDINATOR_TOKEN="")
+    commands = [[sys.executable, "coordinator.py", "serve", "--port", url.rsplit(':', 1)[1],
+                 "--results", str(tmp_path / "results.jsonl")]]
+    for name, ports in (("bench-a", "1-1"), ("bench-b", "1-2")):
+        commands.append([sys.executable, "main.py", "--agent", url, "--agent-name", name,
+                         "--agent-ports", ports, "--max-jobs", "1"])
+    processes = []
+    try:
+        for index, command in enumerate(commands):
+            with open(tmp_path / f"process-{index}.log", 'w') as log:
+                processes.append(subprocess.Popen(command, cwd=REPO, env=env, stdout=log,
+                                                  stderr=subprocess.STDOUT))
+
+        def agents():
+            try:
+                reply = coordinator.call(url, "GET", "/agents", token=None)
+            except OSError:
+                return None
+            found = {agent['name']: agent for agent in reply['agents']}
+            return found if len(found) == 2 and found["bench-a"]['ports'] else None
+        found = wait_until(agents, 60)
+        assert found["bench-a"]['ports'] == {"1-1": "7g"}
+        assert found["bench-b"]['ports'] == {}
+
+        job_id = coordinator.call(url, "POST", "/jobs", {'model': "7g", 'yes': True, 'usb_timeout': 10},
+                                  token=None)['job']
+
+        def finished():
+            job = coordinator.call(url, "GET", f"/jobs/{job_id}", token=None)['job']
+            return job if job['state'] in ("done", "failed") else None
+        job = wait_until(finished, 120)
+        assert (job['state'], job['agent']) == ("done", "bench-a"), job['record']
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
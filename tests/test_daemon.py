@@ -0,0 +1,70 @@
+"""JobServer's HTTP API: auth, request parsing and how much history it keeps."""
+import asyncio
+import json
+
+import daemon
+
+def run_job(spec, emit):
+    for percent in (25, 50, 75, 100):
+        emit({'event': "progress", 'stage': "wtf_flash", 'percent': percent})
+    return {'result': "ok", 'exit_code': 0}
+
+async def http(port, raw):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(raw)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+def post(body, token=None):
+    auth = f"Authorization: Bearer {token}\r\n" if token else ""
+    return (f"POST /jobs HTTP/1.1\r\nContent-Length: {len(body)}\r\n{auth}\r\n").encode() + body
+
+async def serving(server, scenario):
+    ready = asyncio.get_running_loop().create_future()
+    task = asyncio.ensure_future(server.serve(None, 0, ready=ready.set_result))
+    port = (await ready)[0].sockets[0].getsockname()[1]
+    try:
+        return await scenario(port)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+def test_http_is_read_only_without_a_token():
+    async def scenario(port):
+        assert (await http(port, post(b'{}')))[0] == 403
+        status, reply = await http(port, b"GET /jobs HTTP/1.1\r\n\r\n")
+        return status, reply
+    status, reply = asyncio.run(serving(daemon.JobServer(run_job, token=None), scenario))
+    assert status == 200 and reply['jobs'] == []
+
+def test_token_is_required_on_every_request():
+    async def scenario(port):
+        return [(await http(port, b"GET /health HTTP/1.1\r\n\r\n"))[0],
+                (await http(port, post(b'{}', token="wrong")))[0],
+                (await http(port, post(b'{}', token="sesame")))[0]]
+    assert asyncio.run(serving(daemon.JobServer(run_job, token="sesame"), scenario)) == [401, 401, 202]
+
+def test_bad_content_length_is_a_400():
+    async def scenario(port):
+        return [(await http(port, f"POST /jobs HTTP/1.1\r\nContent-Length: {length}\r\n"
+                                  f"Authorization: Bearer sesame\r\n\r\n".encode()))[0]
+                for length in ("-5", "ten", str(daemon.MAX_REQUEST + 1))]
+    assert asyncio.run(serving(daemon.JobServer(run_job, token="sesame"), scenario)) == [400, 400, 413]
+
+def test_finished_jobs_and_progress_history_are_capped(monkeypatch):
+    monkeypatch.setattr(daemon, 'KEEP_FINISHED', 3)
+    server = daemon.JobServer(run_job, max_jobs=2, token=None)
+
+    async def scenario(port):
+        jobs = [server.submit({}) for _ in range(5)]
+        while not all(job.finished for job in jobs):
+            await asyncio.sleep(0.01)
+        return jobs
+    jobs = asyncio.run(serving(server, scenario))
+    assert sorted(server.jobs) == [3, 4, 5]
+    events = [event['event'] for event in jobs[-1].events]
+    assert events == ["queued", "started", "progress", "finished"]
+    assert jobs[-1].events[2]['percent'] == 100
@@ -0,0 +1,88 @@
+"""delta.generate/apply round trips, and patches that must not apply."""
+import os
+import random
+
+import pytest
+
+import delta
+
+BLOCK = 64
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+def revised(data, rng):
+    """`data` with a few bytes changed, a run inserted and a run dropped."""
+    data = bytearray(data)
+    for _ in range(5):
+        data[rng.randrange(len(data))] ^= 0xff
+    at = rng.randrange(len(data))
+    data[at:at] = os.urandom(300)
+    del data[len(data) // 3:len(data) // 3 + 200]
+    return bytes(data)
+
+def round_trip(tmp_path, source, target):
+    source_path = write(tmp_path / "old.bin", source)
+    target_path = write(tmp_path / "new.bin", target)
+    patch = str(tmp_path / "new.lubdelta")
+    stats = delta.generate(source_path, target_path, patch, block_size=BLOCK)
+    out = tmp_path / "rebuilt.bin"
+    header = delta.apply(source_path, patch, str(out))
+    assert out.read_bytes() == target
+    assert header['target']['size'] == len(target)
+    return stats, patch
+
+def test_revision_round_trips_mostly_as_block_copies(tmp_path):
+    rng = random.Random(7)
+    source = bytes(rng.randrange(256) for _ in range(64 * 1024))
+    target = revised(source, rng)
+    stats, patch = round_trip(tmp_path, source, target)
+    assert stats['copied'] * BLOCK > len(target) * 0.9
+    assert os.path.getsize(patch) < len(target) // 10
+
+def test_empty_source(tmp_path):
+    target = os.urandom(5000)
+    stats, _ = round_trip(tmp_path, b"", target)
+    assert (stats['copied'], stats['literal']) == (0, len(target))
+
+def test_empty_target(tmp_path):
+    stats, _ = round_trip(tmp_path, os.urandom(5000), b"")
+    assert (stats['copied'], stats['literal']) == (0, 0)
+
+@pytest.fixture
+def patch(tmp_path):
+    source = os.urandom(20 * BLOCK)
+    source_path = write(tmp_path / "old.bin", source)
+    target_path = write(tmp_path / "new.bin", source[:10 * BLOCK] + os.urandom(100) + source[10 * BLOCK:])
+    patch_path = str(tmp_path / "new.lubdelta")
+    delta.generate(source_path, target_path, patch_path, block_size=BLOCK)
+    return source_path, patch_path
+
+def corrupt(patch_path, how):
+    data = bytearray(open(patch_path, 'rb').read())
+    if how == "flipped":
+        data[-10] ^= 0xff
+    elif how == "truncated":
+        del data[-20:]
+    elif how == "magic":
+        data[:4] = b"JUNK"
+    with open(patch_path, 'wb') as f:
+        f.write(data)
+
+@pytest.mark.parametrize("how", ["flipped", "truncated", "magic"])
+def test_corrupted_patch_raises_and_leaves_no_output(tmp_path, patch, how):
+    source_path, patch_path = patch
+    corrupt(patch_path, how)
+    out = tmp_path / "rebuilt.bin"
+    out.write_bytes(b"previous version")
+    with pytest.raises(delta.DeltaError):
+        delta.apply(source_path, patch_path, str(out))
+    assert out.read_bytes() == b"previous version"
+    assert not os.path.exists(str(out) + ".part")
+
+def test_patch_only_applies_to_its_own_source(tmp_path, patch):
+    _, patch_path = patch
+    other = write(tmp_path / "other.bin", os.urandom(20 * BLOCK))
+    with pytest.raises(delta.DeltaError, match="different file"):
+        delta.apply(other, patch_path, str(tmp_path / "rebuilt.bin"))
@@ -0,0 +1,79 @@
+"""DfuEngine against the in-memory SimulatedDevice backend."""
+import struct
+
+import pytest
+
+import dfu
+
+def engine(device, **kwargs):
+    # No real sleeping on poll timeouts
+    return dfu.DfuEngine(device, sleep=lambda _seconds: None, **kwargs)
+
+def payload(size):
+    return bytes(range(256)) * (size // 256) + bytes(size % 256)
+
+def test_download_delivers_every_byte_and_manifests():
+    device = dfu.SimulatedDevice(busy_polls=2, transfer_size=1024)
+    data = payload(10_000)
+    stats = engine(device).download("05ac:1234", data, path="1-1")
+    assert bytes(device.received) == data
+    assert device.manifested and device.gone
+    assert stats['bytes'] == len(data)
+    assert stats['blocks'] == device.blocks == 10
+    assert stats['manifest'] == "device reset"
+
+def test_device_that_stays_attached_after_manifest():
+    device = dfu.SimulatedDevice(detach_on_manifest=False)
+    stats = engine(device).download("05ac:1234", payload(5000))
+    assert device.manifested and not device.gone
+    assert stats['manifest'] == "done"
+
+def test_block_size_comes_from_functional_descriptor():
+    device = dfu.SimulatedDevice(transfer_size=512)
+    stats = engine(device).download("05ac:1234", payload(2048))
+    assert stats['block_size'] == 512
+    assert device.blocks == 4
+
+def test_block_size_falls_back_without_descriptor():
+    device = dfu.SimulatedDevice(transfer_size=None)
+    stats = engine(device).download("05ac:1234", payload(4096))
+    assert stats['block_size'] == dfu.DEFAULT_BLOCK_SIZE
+    assert device.blocks == 2
+
+def test_parse_functional_skips_other_descriptors():
+    other = bytes([4, 0x24, 0, 0])
+    functional = struct.pack('<BBBHHH', 9, dfu.DFU_FUNCTIONAL, 0x0B, 0xFF, 2048, 0x0110)
+    assert dfu.parse_functional(other + functional) == 2048
+    assert dfu.parse_functional(other) is None
+    assert dfu.parse_functional(None) is None
+
+def test_error_status_fails_the_download():
+    device = dfu.SimulatedDevice(fail_at_block=3, transfer_size=1024)
+    with pytest.raises(dfu.DfuError, match="errWRITE"):
+        engine(device).download("05ac:1234", payload(8192))
+    assert device.blocks == 3
+
+def test_stall_on_oversized_block():
+    device = dfu.SimulatedDevice(max_block=1024)
+    with pytest.raises(dfu.DfuError, match="stall"):
+        engine(device, block_size=2048).download("05ac:1234", payload(4096))
+
+def test_error_state_is_cleared_before_the_next_download():
+    device = dfu.SimulatedDevice(fail_at_block=0, detach_on_manifest=False)
+    with pytest.raises(dfu.DfuError):
+        engine(device).download("05ac:1234", payload(1024))
+    device.fail_at_block = None
+    engine(device).download("05ac:1234", payload(1024))
+    assert device.manifested
+
+def test_missing_device():
+    with pytest.raises(dfu.DeviceGone):
+        engine(dfu.SimulatedDevice()).download("05ac:1232", payload(1024))
+
+def test_progress_reports_every_block():
+    device = dfu.SimulatedDevice(transfer_size=1000)
+    calls = []
+    engine(device).download("05ac:1234", payload(3500),
+                            progress=lambda sent, total, seconds: calls.append((sent, total, seconds)))
+    assert [(sent, total) for sent, total, _ in calls] == [(1000, 3500), (2000, 3500), (3000, 3500), (3500, 3500)]
+    assert all(seconds >= 0 for _, _, seconds in calls)
@@ -0,0 +1,96 @@
+"""downloader.fetch against a local range-capable server."""
+import hashlib
+import os
+import threading
+
+import pytest
+import requests
+
+import downloader
+
+DATA = os.urandom(3 * downloader.CHUNK_SIZE + 12345)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+@pytest.fixture
+def cache(tmp_path):
+    return downloader.FirmwareCache(str(tmp_path / "cache"))
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_download_then_cache_hit(file_server, cache):
+    file_server.files["/fw.zip"] = DATA
+    path, digest, hit = downloader.fetch(file_server.url("/fw.zip"), cache)
+    assert (digest, hit, read(path)) == (DIGEST, False, DATA)
+    requests_made = len(file_server.requests)
+    assert downloader.fetch(file_server.url("/fw.zip"), cache) == (path, DIGEST, True)
+    assert downloader.fetch("http://127.0.0.1:9/elsewhere.zip", cache, sha256=DIGEST) == (path, DIGEST, True)
+    assert len(file_server.requests) == requests_made
+
+def test_interrupted_download_resumes_with_range(file_server, cache):
+    file_server.files["/fw.zip"] = DATA
+    file_server.cut_after["/fw.zip"] = downloader.CHUNK_SIZE + 100
+    url = file_server.url("/fw.zip")
+    with pytest.raises((requests.RequestException, downloader.DownloadError)):
+        downloader.fetch(url, cache)
+    kept = os.path.getsize(cache.partial_path(url))
+    assert kept >= downloader.CHUNK_SIZE
+
+    path, digest, hit = downloader.fetch(url, cache, sha256=DIGEST)
+    assert (digest, hit, read(path)) == (DIGEST, False, DATA)
+    assert file_server.requests[-1] == ("GET", "/fw.zip", f"bytes={kept}-")
+    assert not os.path.exists(cache.partial_path(url))
+
+def test_changed_file_is_downloaded_from_the_start(file_server, cache):
+    url = file_server.url("/fw.zip")
+    with open(cache.partial_path(url), 'wb') as f:
+        f.write(b"stale bytes of the old release")
+    with open(cache.partial_path(url) + ".etag", 'w') as f:
+        f.write('"v0"')
+    file_server.files["/fw.zip"] = DATA
+    path, digest, _ = downloader.fetch(url, cache)
+    assert (digest, read(path)) == (DIGEST, DATA)
+
+def test_partial_longer_than_the_file_restarts(file_server, cache):
+    url = file_server.url("/fw.zip")
+    file_server.files["/fw.zip"] = DATA
+    with open(cache.partial_path(url), 'wb') as f:
+        f.write(DATA + b"junk")
+    path, digest, _ = downloader.fetch(url, cache)
+    assert (digest, read(path)) == (DIGEST, DATA)
+    assert [byte_range for _, _, byte_range in file_server.requests] == [f"bytes={len(DATA) + 4}-", None]
+
+def test_sha256_mismatch_is_not_stored(file_server, cache):
+    url = file_server.url("/fw.zip")
+    file_server.files["/fw.zip"] = DATA
+    with pytest.raises(downloader.DownloadError, match="SHA-256 mismatch"):
+        downloader.fetch(url, cache, sha256="0" * 64)
+    assert cache.lookup(url) is None
+    assert not os.path.exists(cache.partial_path(url))
+
+def test_concurrent_fetches_of_one_url_share_the_download(file_server, cache):
+    url = file_server.url("/fw.zip")
+    file_server.files["/fw.zip"] = DATA
+    file_server.slow = 0.002
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(downloader.fetch(url, cache))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(hit for _, _, hit in results) == [False, True, True]
+    assert {digest for _, digest, _ in results} == {DIGEST}
+    assert cache.lookup(url) == DIGEST and read(cache.path_for(DIGEST)) == DATA
+    assert [method for method, _, _ in file_server.requests] == ["GET"]
+
+def test_fetch_all_resolves_each_url_on_its_own(file_server, cache):
+    other = os.urandom(54321)
+    file_server.files["/a.zip"] = DATA
+    file_server.files["/b.zip"] = other
+    urls = [file_server.url(name) for name in ("/a.zip", "/b.zip", "/missing.zip")]
+    futures = downloader.fetch_all(urls, cache, hashes={urls[1]: hashlib.sha256(other).hexdigest()})
+    assert read(futures[urls[0]].result()[0]) == DATA
+    assert read(futures[urls[1]].result()[0]) == other
+    with pytest.raises(requests.HTTPError):
+        futures[urls[2]].result()
@@ -0,0 +1,59 @@
+"""Image checks (DFU suffix, IMG1 header) and the index that caches their verdicts."""
+import os
+import struct
+
+import fwindex
+
+DFU_7G, WTF_2015 = 0x1234, 0x124a
+
+def img1(magic=b'8740', body_len=3000, actual_len=None):
+    header = bytearray(fwindex.IMG1_HEADER_LEN)
+    header[:4] = magic
+    header[0x14:0x1c] = struct.pack('<2L', body_len - 200, 200)
+    body = os.urandom(body_len if actual_len is None else actual_len)
+    return bytes(header) + body
+
+def with_suffix(data, pid=DFU_7G):
+    suffix = struct.pack('<4H3sB', 0xFFFF, pid, fwindex.APPLE_VID, 0x0100, b'UFD', 16)
+    data += suffix
+    return data + struct.pack('<L', fwindex.dfu_crc(data))
+
+def test_img1_header_length_and_soc():
+    assert fwindex.check_view(img1(), DFU_7G)[0]
+    ok, kind, reason = fwindex.check_view(img1(actual_len=2999), DFU_7G)
+    assert (ok, kind) == (False, "img1") and "truncated" in reason
+    assert not fwindex.check_view(img1(b'8723'), DFU_7G)[0]
+    assert not fwindex.check_view(img1(), DFU_7G, "WTF.x124a.RELEASE.dfu")[0]
+
+def test_dfu_suffix_crc():
+    image = with_suffix(os.urandom(5000))
+    assert fwindex.check_view(image, DFU_7G)[:2] == (True, "dfu")
+    corrupted = bytearray(image)
+    corrupted[100] ^= 1
+    ok, _, reason = fwindex.check_view(bytes(corrupted), DFU_7G)
+    assert not ok and "CRC mismatch" in reason
+    assert "idProduct" in fwindex.check_view(image, WTF_2015)[2]
+
+def test_verdict_is_cached_by_size_and_mtime(tmp_path):
+    image = tmp_path / "WTF.x1234.RELEASE.dfu"
+    image.write_bytes(img1())
+    index = fwindex.FirmwareIndex(str(tmp_path))
+    first = index.check(str(image), "05ac:1234")
+    assert first['ok'] and not first['cached']
+    assert index.check(str(image), "05ac:1234")['cached']
+    index.save()
+    assert fwindex.FirmwareIndex(str(tmp_path)).check(str(image), "05ac:1234")['cached']
+
+    # Same size, new contents and mtime: checked (and hashed) again
+    image.write_bytes(img1(actual_len=3000))
+    stat = os.stat(image)
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    again = index.check(str(image), "05ac:1234")
+    assert not again['cached'] and again['sha256'] != first['sha256']
+
+def test_check_blob_reuses_the_verdict_of_the_same_hash(tmp_path):
+    index = fwindex.FirmwareIndex(str(tmp_path))
+    data = img1()
+    assert not index.check_blob(memoryview(data), "ab" * 32, DFU_7G)['cached']
+    assert index.check_blob(memoryview(data), "ab" * 32, DFU_7G)['cached']
+    assert not index.check_blob(memoryview(data), "ab" * 32, WTF_2015)['cached']
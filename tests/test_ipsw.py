@@ -0,0 +1,107 @@
+"""ipsw.fetch_member against a local range-capable server serving synthetic IPSWs."""
+import io
+import os
+import struct
+import zipfile
+
+import pytest
+
+import downloader
+import ipsw
+
+MSE = os.urandom(3000) + bytes(60_000)
+BUILD_MANIFEST = b"<plist>" + b"x" * 4000 + b"</plist>"
+
+def make_ipsw(zip64=False, monkeypatch=None):
+    """A small IPSW-shaped zip; zip64 gives every offset, size and the end
+    record their zip64 forms, as a multi-GiB IPSW would have."""
+    if zip64:
+        monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 1000)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr("BuildManifest.plist", BUILD_MANIFEST, zipfile.ZIP_STORED)
+        archive.writestr("Firmware/dfu/iBSS.dfu", os.urandom(5000), zipfile.ZIP_STORED)
+        archive.writestr("Firmware.MSE", MSE, zipfile.ZIP_DEFLATED)
+    data = bytearray(buffer.getvalue())
+    if zip64:
+        monkeypatch.undo()
+        # What the EOCD holds once the real values only fit the zip64 record
+        eocd = len(data) - 22
+        assert data[eocd:eocd + 4] == ipsw.EOCD_SIG
+        data[eocd + 8:eocd + 20] = struct.pack('<2H2L', 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF)
+    return bytes(data)
+
+@pytest.fixture
+def cache(tmp_path):
+    return downloader.FirmwareCache(str(tmp_path / "cache"))
+
+def full_gets(server):
+    return [path for method, path, byte_range in server.requests if method == "GET" and not byte_range]
+
+def test_member_is_extracted_with_range_requests(file_server, cache, tmp_path):
+    file_server.files["/nano.ipsw"] = make_ipsw()
+    dest = str(tmp_path / "firmwares" / "Firmware.MSE")
+    digest, hit = ipsw.fetch_member(file_server.url("/nano.ipsw"), dest, cache)
+    assert not hit
+    with open(dest, 'rb') as f:
+        assert f.read() == MSE
+    assert full_gets(file_server) == []
+
+    requests = len(file_server.requests)
+    os.remove(dest)
+    assert ipsw.fetch_member(file_server.url("/nano.ipsw"), dest, cache) == (digest, True)
+    with open(dest, 'rb') as f:
+        assert f.read() == MSE
+    # Only the HEAD that identifies the archive
+    assert [method for method, _, _ in file_server.requests[requests:]] == ["HEAD"]
+
+def test_stored_member(file_server, cache, tmp_path):
+    file_server.files["/nano.ipsw"] = make_ipsw()
+    dest = str(tmp_path / "BuildManifest.plist")
+    ipsw.fetch_member(file_server.url("/nano.ipsw"), dest, cache, member="BuildManifest.plist")
+    with open(dest, 'rb') as f:
+        assert f.read() == BUILD_MANIFEST
+
+def test_zip64_archive(file_server, cache, tmp_path, monkeypatch):
+    archive = make_ipsw(zip64=True, monkeypatch=monkeypatch)
+    assert zipfile.ZipFile(io.BytesIO(archive)).read("Firmware.MSE") == MSE
+    file_server.files["/nano.ipsw"] = archive
+    remote = ipsw.RemoteFile(file_server.url("/nano.ipsw"))
+    entries = {entry['name']: entry for entry in ipsw.list_entries(remote)}
+    assert entries["Firmware.MSE"]['offset'] > 1000 and entries["Firmware.MSE"]['size'] == len(MSE)
+
+    dest = str(tmp_path / "Firmware.MSE")
+    ipsw.fetch_member(file_server.url("/nano.ipsw"), dest, cache)
+    with open(dest, 'rb') as f:
+        assert f.read() == MSE
+
+def test_crc_mismatch_is_rejected(file_server, cache, tmp_path):
+    archive = bytearray(make_ipsw())
+    # The central directory entry ends the archive, so its name is the last one
+    entry = archive.rfind(b"Firmware.MSE") - 46
+    assert archive[entry:entry + 4] == ipsw.CENTRAL_SIG
+    archive[entry + 16:entry + 20] = b'\xde\xad\xbe\xef'
+    file_server.files["/nano.ipsw"] = bytes(archive)
+    dest = str(tmp_path / "Firmware.MSE")
+    with pytest.raises(ipsw.IpswError, match="CRC/size mismatch"):
+        ipsw.fetch_member(file_server.url("/nano.ipsw"), dest, cache)
+    assert not os.path.exists(dest)
+    assert [name for name in os.listdir(os.path.join(cache.root, "partial")) if not name.endswith(".lock")] == []
+
+def test_head_without_content_length(file_server, cache, tmp_path):
+    archive = make_ipsw()
+    file_server.files["/nano.ipsw"] = archive
+    file_server.head_length = False
+    remote = ipsw.RemoteFile(file_server.url("/nano.ipsw"))
+    assert remote.size == len(archive)
+    assert ("GET", "/nano.ipsw", "bytes=0-0") in file_server.requests
+
+    dest = str(tmp_path / "Firmware.MSE")
+    ipsw.fetch_member(file_server.url("/nano.ipsw"), dest, cache)
+    with open(dest, 'rb') as f:
+        assert f.read() == MSE
+
+def test_not_a_zip(file_server, cache, tmp_path):
+    file_server.files["/nano.ipsw"] = os.urandom(10_000)
+    with pytest.raises(ipsw.IpswError, match="not a zip file"):
+        ipsw.fetch_member(file_server.url("/nano.ipsw"), str(tmp_path / "Firmware.MSE"), cache)
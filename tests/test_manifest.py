@@ -0,0 +1,27 @@
+"""Manifest.resolve: remembered tool paths and when they are looked up again."""
+import manifest
+
+def tool(tmp_path, name):
+    path = tmp_path / name
+    path.write_text("#!/bin/sh\n")
+    return str(path)
+
+def test_remembered_path_is_reused_for_the_same_candidates(tmp_path):
+    first = tool(tmp_path, "dfu-util-a")
+    cache = manifest.Manifest(str(tmp_path / "manifest.json"))
+    assert cache.resolve('dfu-util', [first]) == first
+    cache.save()
+    reloaded = manifest.Manifest(str(tmp_path / "manifest.json"))
+    assert reloaded.resolve('dfu-util', [first]) == first
+    assert not reloaded.dirty
+
+def test_new_candidate_list_is_resolved_again(tmp_path):
+    first, second = tool(tmp_path, "dfu-util-a"), tool(tmp_path, "dfu-util-b")
+    cache = manifest.Manifest(str(tmp_path / "manifest.json"))
+    assert cache.resolve('dfu-util', [first]) == first
+    assert cache.resolve('dfu-util', [second, first]) == second
+
+def test_missing_tool_is_not_remembered(tmp_path):
+    cache = manifest.Manifest(str(tmp_path / "manifest.json"))
+    assert cache.resolve('ipodscsi', [str(tmp_path / "nowhere" / "ipodscsi")]) is None
+    assert 'ipodscsi' not in cache.data['tools']
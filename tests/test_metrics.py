@@ -0,0 +1,47 @@
+"""Metrics: the textfile export under concurrent stages, and the exporter's bind address."""
+import re
+import threading
+import urllib.request
+
+import metrics
+
+SAMPLE = re.compile(r'^[a-z_]+(\{[^}]*\})? -?[0-9.e+]+$|^[a-z_]+_bucket\{[^}]*le="\+Inf"\} [0-9]+$')
+
+def parse(text):
+    """{series line without value: value}; fails on anything that isn't exposition format."""
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP ") or line.startswith("# TYPE "):
+            continue
+        assert SAMPLE.match(line), line
+        name, value = line.rsplit(" ", 1)
+        samples[name] = float(value)
+    return samples
+
+def test_flush_from_many_stage_threads(tmp_path):
+    path = str(tmp_path / "leunbrick.prom")
+    registry = metrics.Metrics(path)
+    threads = [threading.Thread(target=lambda port=f"1-{n}": [
+        registry.stage("wtf_flash", port, 0.5, "ok", nbytes=1 << 20) for _ in range(25)]) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(path) as f:
+        samples = parse(f.read())
+    assert samples['leunbrick_stages_total{stage="wtf_flash",outcome="ok"}'] == 200
+    assert samples['leunbrick_flash_bytes_total{stage="wtf_flash",port="1-3"}'] == 25 << 20
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["leunbrick.prom"]
+
+def test_exporter_listens_on_loopback_by_default():
+    registry = metrics.Metrics(None)
+    registry.device("7g", "ok")
+    server = registry.serve(0)
+    try:
+        host, port = server.server_address[:2]
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            samples = parse(response.read().decode())
+        assert samples['leunbrick_devices_total{model="7g",result="ok"}'] == 1
+    finally:
+        server.shutdown()
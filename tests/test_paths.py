@@ -0,0 +1,28 @@
+"""paths.atomic_write under concurrent writers."""
+import os
+import threading
+
+import paths
+
+def test_concurrent_writes_leave_one_whole_file(tmp_path):
+    target = str(tmp_path / "state" / "index.json")
+    texts = [f"{n}\n" * 50_000 for n in range(8)]
+    threads = [threading.Thread(target=paths.atomic_write, args=(target, text)) for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(target) as f:
+        assert f.read() in texts
+    assert os.listdir(tmp_path / "state") == ["index.json"]
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    target = str(tmp_path / "index.json")
+    paths.atomic_write(target, "old")
+    try:
+        paths.atomic_write(target, None)
+    except TypeError:
+        pass
+    with open(target) as f:
+        assert f.read() == "old"
+    assert os.listdir(tmp_path) == ["index.json"]
@@ -0,0 +1,58 @@
+"""MseWriter against the file-backed EmulatedTarget."""
+import os
+
+import pytest
+
+import failures
+import scsiwrite
+
+def image(blocks):
+    return bytearray(os.urandom(blocks * scsiwrite.BLOCK_SIZE))
+
+def test_batched_write_is_byte_identical(tmp_path):
+    target = scsiwrite.EmulatedTarget(str(tmp_path / "firmware.bin"))
+    payload = image(37)
+    sent = []
+    stats = scsiwrite.MseWriter(target, chunk_blocks=16).write(
+        payload, verify=True, progress=lambda done, total, seconds: sent.append((done, total)))
+    with open(target.path, 'rb') as f:
+        assert f.read() == bytes(payload)
+    assert stats['chunks'] == target.writes == 3
+    assert stats['verified'] is True
+    assert sent[-1] == (len(payload), len(payload))
+    assert target.commands[0] == scsiwrite.repartition_cdb(len(payload))
+    assert target.commands[-1] == scsiwrite.reboot_cdb() and target.rebooted
+
+def test_write_file_goes_through_the_mapping(tmp_path):
+    source = tmp_path / "Firmware.MSE"
+    source.write_bytes(bytes(image(5)))
+    target = scsiwrite.EmulatedTarget(str(tmp_path / "firmware.bin"))
+    scsiwrite.MseWriter(target, chunk_blocks=255).write_file(str(source), verify=True)
+    assert (tmp_path / "firmware.bin").read_bytes() == source.read_bytes()
+
+def test_readback_verify_catches_corruption(tmp_path):
+    class Corrupting(scsiwrite.EmulatedTarget):
+        def read(self, offset, length):
+            data = bytearray(super().read(offset, length))
+            if offset == 0:
+                data[100] ^= 0xFF
+            return bytes(data)
+    target = Corrupting(str(tmp_path / "firmware.bin"))
+    with pytest.raises(scsiwrite.ScsiError) as raised:
+        scsiwrite.MseWriter(target).write(image(20), verify=True)
+    assert not target.rebooted
+    assert failures.classify(str(raised.value)).name == "bad_image"
+
+def test_failed_chunk_is_a_classified_medium_error(tmp_path):
+    target = scsiwrite.EmulatedTarget(str(tmp_path / "firmware.bin"), fail_at_chunk=2)
+    with pytest.raises(scsiwrite.ScsiError) as raised:
+        scsiwrite.MseWriter(target, chunk_blocks=4).write(image(16))
+    assert target.writes == 2
+    failure = failures.classify(str(raised.value))
+    assert failure.name == "scsi_medium" and failure.retryable
+
+def test_image_size_must_be_whole_blocks(tmp_path):
+    target = scsiwrite.EmulatedTarget(str(tmp_path / "firmware.bin"))
+    with pytest.raises(scsiwrite.ScsiError, match="multiple of 4096"):
+        scsiwrite.MseWriter(target).write(bytearray(5000))
+    assert target.commands == []
@@ -0,0 +1,252 @@
+"""Event-driven USB device tracking for Linux.
+
+Reads the current device table straight from sysfs and keeps it up to date
+from kernel uevents (NETLINK_KOBJECT_UEVENT), so waiting for an iPod to
+change mode costs no subprocess and resolves as soon as the kernel has
+enumerated it. Devices are keyed by their sysfs port path ("1-1.2"), which
+is the same notation dfu-util uses for -p.
+
+Block devices are tracked the same way: each /sys/block/<disk> is walked up
+to the USB device it hangs off, so the iPod's disk can be resolved to an
+exact /dev/sdX for the port being flashed as soon as it has media.
+"""
+import os
+import select
+import socket
+import threading
+import time
+
+SYSFS_USB = "/sys/bus/usb/devices"
+SYSFS_BLOCK = "/sys/block"
+APPLE_VENDOR = "05ac"
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+# Used when the netlink socket can't be opened (containers, missing CAP)
+FALLBACK_POLL_INTERVAL = 0.05
+
+def _read_attr(device_dir, name):
+    try:
+        with open(os.path.join(device_dir, name)) as f:
+            return f.read().strip().lower()
+    except OSError:
+        return None
+
+def is_port_path(name):
+    """True for real devices ("1-1.2"), false for root hubs and interfaces."""
+    return '-' in name and ':' not in name
+
+def scan_sysfs(root=SYSFS_USB):
+    """Return {port_path: "vid:pid"} for every USB device currently enumerated."""
+    devices = {}
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return devices
+    for name in names:
+        if not is_port_path(name):
+            continue
+        device_dir = os.path.join(root, name)
+        vid = _read_attr(device_dir, "idVendor")
+        pid = _read_attr(device_dir, "idProduct")
+        if vid and pid:
+            devices[name] = f"{vid}:{pid}"
+    return devices
+
+def usb_device_of(block_dir):
+    """(port_path, vid:pid) of the USB device a /sys/block entry belongs to, or None."""
+    path = os.path.realpath(os.path.join(block_dir, "device"))
+    while path not in ('', os.sep):
+        name = os.path.basename(path)
+        if is_port_path(name):
+            vid = _read_attr(path, "idVendor")
+            pid = _read_attr(path, "idProduct")
+            if vid and pid:
+                return name, f"{vid}:{pid}"
+        path = os.path.dirname(path)
+    return None
+
+def scan_block(root=SYSFS_BLOCK):
+    """Return {"/dev/sdX": (port_path, vid:pid)} for USB disks that have media."""
+    disks = {}
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return disks
+    for name in names:
+        block_dir = os.path.join(root, name)
+        # size stays 0 until the disk has answered READ CAPACITY
+        if _read_attr(block_dir, "size") in (None, "0"):
+            continue
+        usb = usb_device_of(block_dir)
+        if usb:
+            disks[f"/dev/{name}"] = usb
+    return disks
+
+def parse_uevent(data):
+    """Split a raw kernel uevent into (action, fields). Returns None for junk."""
+    parts = data.split(b'\0')
+    if not parts or b'@' not in parts[0]:
+        # libudev re-broadcasts start with "libudev" and carry a binary header
+        return None
+    fields = {}
+    for part in parts[1:]:
+        key, sep, value = part.partition(b'=')
+        if sep:
+            fields[key.decode(errors='replace')] = value.decode(errors='replace')
+    return fields.get('ACTION'), fields
+
+def product_to_vid_pid(product):
+    """Convert a uevent PRODUCT ("5ac/1234/1") into "05ac:1234"."""
+    vid, pid = product.split('/')[:2]
+    return f"{int(vid, 16):04x}:{int(pid, 16):04x}"
+
+class UsbWatcher:
+    """Live {port_path: vid:pid} table with blocking waits on changes."""
+
+    def __init__(self, root=SYSFS_USB, block_root=SYSFS_BLOCK):
+        self.root = root
+        self.block_root = block_root
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.devices = {}
+        self.disks = {}   # /dev/sdX -> (port_path, vid:pid)
+        self.sock = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+            self.sock = sock
+        except (AttributeError, OSError):
+            self.sock = None
+        # Subscribe first, then scan, so nothing enumerating in between is lost
+        with self.changed:
+            self.devices = scan_sysfs(self.root)
+            self.disks = scan_block(self.block_root)
+        self.running = True
+        target = self._event_loop if self.sock else self._poll_loop
+        self.thread = threading.Thread(target=target, name="usbwatch", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _event_loop(self):
+        while self.running:
+            ready, _, _ = select.select([self.sock], [], [], 0.25)
+            if not ready:
+                continue
+            try:
+                data = self.sock.recv(16384)
+            except OSError:
+                continue
+            self.handle_uevent(data)
+
+    def _poll_loop(self):
+        while self.running:
+            devices = scan_sysfs(self.root)
+            disks = scan_block(self.block_root)
+            with self.changed:
+                if devices != self.devices or disks != self.disks:
+                    self.devices = devices
+                    self.disks = disks
+                    self.changed.notify_all()
+            time.sleep(FALLBACK_POLL_INTERVAL)
+
+    def handle_uevent(self, data):
+        parsed = parse_uevent(data)
+        if not parsed:
+            return
+        action, fields = parsed
+        if fields.get('SUBSYSTEM') == 'block' and fields.get('DEVTYPE') == 'disk':
+            # add/remove/change (media) events: sysfs already has the final state
+            disks = scan_block(self.block_root)
+            with self.changed:
+                self.disks = disks
+                self.changed.notify_all()
+            return
+        if fields.get('SUBSYSTEM') != 'usb' or fields.get('DEVTYPE') != 'usb_device':
+            return
+        path = fields.get('DEVPATH', '').rsplit('/', 1)[-1]
+        if not is_port_path(path):
+            return
+        with self.changed:
+            if action == 'add' and 'PRODUCT' in fields:
+                self.devices[path] = product_to_vid_pid(fields['PRODUCT'])
+            elif action == 'remove':
+                self.devices.pop(path, None)
+            else:
+                return
+            self.changed.notify_all()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.devices)
+
+    def find(self, vid_pids, path=None):
+        """Return (port_path, vid_pid) of the first device matching, or None.
+        Call with `changed` held."""
+        wanted = {vid_pid.lower() for vid_pid in vid_pids}
+        for port, vid_pid in sorted(self.devices.items()):
+            if vid_pid in wanted and (path is None or port == path):
+                return port, vid_pid
+        return None
+
+    def find_disks(self, vid_pids=None, path=None):
+        """Disks on matching USB devices: `vid_pids`, or any Apple device when None."""
+        wanted = {vid_pid.lower() for vid_pid in vid_pids} if vid_pids else None
+        return sorted(disk for disk, (port, vid_pid) in self.disks.items()
+                      if (path is None or port == path)
+                      and (vid_pid in wanted if wanted else vid_pid.startswith(APPLE_VENDOR + ':')))
+
+    def wait_for_disks(self, vid_pids=None, timeout=30, path=None):
+        """Block until a matching disk has media. Returns every match ([] on timeout)."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.find_disks(vid_pids, path), timeout)
+            return self.find_disks(vid_pids, path)
+
+    def wait_transition(self, path, old, expected=None, timeout=30):
+        """Wait for the device on `path` to drop off as `old` and come back as
+        one of `expected` (None: only wait for it to drop off).
+
+        Returns {'path', 'vid_pid', 'gone', 'back'} with the seconds until the
+        disconnect and the reconnect, or None if the deadline passes first.
+        A device that already re-enumerated before the call counts at once.
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        if path:
+            dropped = lambda: self.devices.get(path) != old
+        else:
+            dropped = lambda: old not in self.devices.values()
+        with self.changed:
+            if not self.changed.wait_for(dropped, timeout):
+                return None
+            gone = time.monotonic() - started
+            if not expected:
+                return {'path': path, 'vid_pid': None, 'gone': gone, 'back': None}
+            found = self.changed.wait_for(lambda: self.find(expected, path),
+                                          max(0.0, deadline - time.monotonic()))
+            if not found:
+                return None
+            return {'path': found[0], 'vid_pid': found[1], 'gone': gone, 'back': time.monotonic() - started}
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+def get_watcher():
+    """Shared watcher, or None where sysfs isn't available (Windows/macOS)
+    or LEUNBRICK_USBWATCH=0 asks for the lsusb / dfu-util -l polling path."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None and os.path.isdir(SYSFS_USB) and os.environ.get('LEUNBRICK_USBWATCH') != '0':
+            _watcher = UsbWatcher().start()
+        return _watcher